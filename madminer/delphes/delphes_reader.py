@@ -14,7 +14,8 @@ from madminer.utils.interfaces.madminer_hdf5 import (
 from madminer.utils.interfaces.delphes import run_delphes
 from madminer.utils.interfaces.delphes_root import parse_delphes_root_file
 from madminer.utils.interfaces.hepmc import extract_weight_order
-from madminer.utils.interfaces.lhe import parse_lhe_file, extract_nuisance_parameters_from_lhe_file
+from madminer.utils.interfaces.lhe import extract_weights_from_lhe_file, extract_nuisance_parameters_from_lhe_file
+from madminer.utils.various import compile_expression
 from madminer.sampling import combine_and_shuffle
 
 logger = logging.getLogger(__name__)
@@ -527,7 +528,13 @@ class DelphesReader:
         self.cuts_default_pass = []
 
     def analyse_delphes_samples(
-        self, generator_truth=False, delete_delphes_files=False, reference_benchmark=None, parse_lhe_events_as_xml=True
+        self,
+        generator_truth=False,
+        delete_delphes_files=False,
+        reference_benchmark=None,
+        parse_lhe_events_as_xml=None,
+        columnar=False,
+        batch_size=10000,
     ):
         """
         Main function that parses the Delphes samples (ROOT files), checks acceptance and cuts, and extracts
@@ -549,9 +556,21 @@ class DelphesReader:
             * dsigma(x|theta_ref,0) / dsigma(x|theta_sampling(x),0)`. This sets the name of the reference benchmark.
             If None, the first one will be used. Default value: None.
 
-        parse_lhe_events_as_xml : bool, optional
-            Decides whether the LHE events are parsed with an XML parser (more robust, but slower) or a text parser
-            (less robust, faster). Default value: True.
+        parse_lhe_events_as_xml : None, optional
+            Deprecated and ignored. The weights in the LHE files (see `lhe_sample_filenames_for_weights`) are now
+            extracted with a fast scan that does not parse the events. Default value: None.
+
+        columnar : bool, optional
+            If True, the acceptance cuts, the lepton collection, and the observables and cuts are calculated with array
+            operations on the jagged arrays read from the Delphes ROOT file, which is much faster than the default
+            event-by-event analysis. Python objects for the particles of an event are then only created for
+            observables defined through functions and for observables and cuts that cannot be evaluated in this way
+            (for instance because they use conditional expressions, functions like `max()`, `boost_to_com()`, or
+            methods of `MadMinerParticle` other than the basic kinematic properties). Default value: False.
+
+        batch_size : int, optional
+            Number of events that are read from a Delphes ROOT file and analysed at once, which limits the memory
+            needed for large files. Default value: 10000.
 
         Returns
         -------
@@ -560,6 +579,8 @@ class DelphesReader:
         """
 
         # Input
+        if parse_lhe_events_as_xml is not None:
+            logger.warning("The parse_lhe_events_as_xml argument is deprecated and will be ignored")
         if reference_benchmark is None:
             reference_benchmark = self.benchmark_names_phys[0]
         self.reference_benchmark = reference_benchmark
@@ -608,11 +629,12 @@ class DelphesReader:
                 k_factor,
                 lhe_file,
                 lhe_file_for_weights,
-                parse_lhe_events_as_xml,
                 reference_benchmark,
                 sampling_benchmark,
                 weight_labels,
                 sample_syst_names,
+                columnar,
+                batch_size,
             )
 
             # No events?
@@ -687,11 +709,12 @@ class DelphesReader:
         k_factor,
         lhe_file,
         lhe_file_for_weights,
-        parse_lhe_events_as_xml,
         reference_benchmark,
         sampling_benchmark,
         weight_labels,
         sample_syst_names,
+        columnar=False,
+        batch_size=10000,
     ):
         # Relevant systematics
         systematics_used = OrderedDict()
@@ -752,6 +775,8 @@ class DelphesReader:
             acceptance_pt_min_e=self.acceptance_pt_min_e,
             acceptance_pt_min_mu=self.acceptance_pt_min_mu,
             acceptance_pt_min_j=self.acceptance_pt_min_j,
+            columnar=columnar,
+            batch_size=batch_size,
         )
         # No events found?
         if this_observations is None:
@@ -769,12 +794,10 @@ class DelphesReader:
         # Find weights in LHE file
         if lhe_file_for_weights is not None:
             logger.debug("Extracting weights from LHE file")
-            _, this_weights = parse_lhe_file(
+            this_weights = extract_weights_from_lhe_file(
                 filename=lhe_file_for_weights,
                 sampling_benchmark=sampling_benchmark,
                 benchmark_names=self.benchmark_names_phys,
-                observables=OrderedDict(),
-                parse_events_as_xml=parse_lhe_events_as_xml,
                 systematics_dict=systematics_dict,
                 is_background=is_background,
             )
@@ -816,12 +839,13 @@ class DelphesReader:
 
     def _check_python_syntax(self, expression):
         """
-        Evaluates a Python expression to check for syntax errors
+        Compiles a Python expression to check for syntax errors. The compiled code is cached, so the expression is not
+        compiled again for every event.
 
         Parameters
         ----------
         expression : str
-            Python expression to be evaluated. The evaluation raises either SyntaxError or NameError
+            Python expression to be compiled.
 
         Returns
         -------
@@ -829,11 +853,9 @@ class DelphesReader:
         """
 
         try:
-            eval(expression)
+            compile_expression(expression)
         except SyntaxError:
             raise ValueError("The provided Python expression is invalid")
-        except NameError:
-            pass
 
     def _check_sample_observations(self, this_observations):
         """ Sanity checks """
@@ -2,6 +2,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import six
 from collections import OrderedDict
+import multiprocessing
 import numpy as np
 import logging
 
@@ -15,10 +16,24 @@ from madminer.utils.interfaces.lhe import (
     extract_nuisance_parameters_from_lhe_file,
     get_elementary_pdg_ids,
 )
+from madminer.utils.various import compile_expression, get_fork_context
 from madminer.sampling import combine_and_shuffle
 
 logger = logging.getLogger(__name__)
 
+# LHEReader instance and sample setup that forked worker processes use, see LHEReader.analyse_samples
+_shared_analysis_setup = None
+
+
+def _parse_sample_in_worker(args):
+    i_sample, seed = args
+    reader, samples, kwargs = _shared_analysis_setup
+
+    # Forked workers inherit the random state of the main process, so each sample gets its own seed for the smearing
+    np.random.seed(seed)
+
+    return reader._parse_sample(*samples[i_sample], **kwargs)
+
 
 class LHEReader:
     """
@@ -279,7 +294,8 @@ class LHEReader:
             for a documentation of their properties. In addition, `MadMinerParticle` have  properties `charge` and
             `pdg_id`, which return the charge in units of elementary charges (i.e. an electron has `e[0].charge = -1.`),
             and the PDG particle ID. For instance, `"abs(j[0].phi() - j[1].phi())"` defines the azimuthal angle between
-            the two hardest jets.
+            the two hardest jets. Expressions that are not valid Python are reported with a warning as soon as they are
+            added (before, this only showed when the events were parsed); they still fall back to `default` then.
 
         required : bool, optional
             Whether the observable is required. If True, an event will only be retained if this observable is
@@ -296,6 +312,8 @@ class LHEReader:
 
         """
 
+        self._check_python_syntax(definition)
+
         if required:
             logger.debug("Adding required observable %s = %s", name, definition)
         else:
@@ -447,7 +465,9 @@ class LHEReader:
             documentation of their properties. In addition, `MadMinerParticle` have  properties `charge` and `pdg_id`,
             which return the charge in units of elementary charges (i.e. an electron has `e[0].charge = -1.`), and the
             PDG particle ID. For instance, `"len(e) >= 2"` requires at least two electrons passing the cuts,
-            while `"mu[0].charge > 0."` specifies that the hardest muon is positively charged.
+            while `"mu[0].charge > 0."` specifies that the hardest muon is positively charged. Expressions that are not
+            valid Python are reported with a warning as soon as they are added (before, this only showed when the events
+            were parsed); they are still treated according to `pass_if_not_parsed` then.
 
         pass_if_not_parsed : bool, optional
             Whether the cut is passed if the observable cannot be parsed. Default value: False.
@@ -457,6 +477,8 @@ class LHEReader:
             None
 
         """
+        self._check_python_syntax(definition)
+
         logger.debug("Adding cut %s", definition)
 
         self.cuts.append(definition)
@@ -479,7 +501,8 @@ class LHEReader:
             [LorentzVector](http://scikit-hep.org/api/math.html#vector-classes). See the link for a
             documentation of their properties. In addition, `MadMinerParticle` have  properties `charge` and `pdg_id`,
             which return the charge in units of elementary charges (i.e. an electron has `e[0].charge = -1.`), and the
-            PDG particle ID.
+            PDG particle ID. Expressions that are not valid Python are reported with a warning as soon as they are
+            added (before, this only showed when the events were parsed); they still use `value_if_not_parsed` then.
 
             value_if_not_parsed : float, optional
             Value if te efficiency function cannot be parsed. Default value: 1.
@@ -489,6 +512,8 @@ class LHEReader:
             None
 
             """
+        self._check_python_syntax(definition)
+
         logger.debug("Adding efficiency %s", definition)
 
         self.efficiencies.append(definition)
@@ -519,7 +544,15 @@ class LHEReader:
         self.efficiencies = []
         self.efficiencies_default_pass = []
 
-    def analyse_samples(self, reference_benchmark=None, parse_events_as_xml=True):
+    def analyse_samples(
+        self,
+        reference_benchmark=None,
+        parse_events_as_xml=True,
+        columnar=False,
+        batch_size=10000,
+        n_processes=1,
+        cache_directory=None,
+    ):
         """
         Main function that parses the LHE samples, applies detector effects, checks cuts,
         evaulate efficiencies, and extracts the observables and weights.
@@ -536,6 +569,33 @@ class LHEReader:
             Decides whether the LHE events are parsed with an XML parser (more robust, but slower) or a text parser
             (less robust, faster). Default value: True.
 
+        columnar : bool, optional
+            If True, events are processed in batches: the particles of batch_size events are read into flat arrays,
+            and smearing, object identification, observables, cuts, and efficiencies are calculated with array
+            operations for the whole batch. This is much faster than the default event-by-event analysis. Observables,
+            cuts, and efficiencies that cannot be evaluated in this way (for instance because they use conditional
+            expressions, functions like `max()`, or methods of `MadMinerParticle` other than the basic kinematic
+            properties) and observables defined through functions are still evaluated event by event. The random
+            numbers drawn for the smearing differ from the event-by-event analysis. Default value: False.
+
+        batch_size : int, optional
+            Number of events processed at once if columnar is True. Default value: 10000.
+
+        n_processes : None or int, optional
+            If None or larger than 1, the LHE samples are analysed in parallel in a pool of worker processes. If there
+            is only one sample, it is instead split into parts (at event boundaries) that are analysed in parallel.
+            Each sample or part is then smeared with its own random seed (drawn from the numpy random state of the main
+            process). The results are merged in the order in which the samples were added. None means that the number
+            of processes is the number of CPU cores. Default value: 1.
+
+        cache_directory : str or None, optional
+            If not None, the parsed and smeared particles and the weights of each LHE sample are stored in this
+            folder, keyed on the content of the LHE file, the sampling benchmark, and the smearing settings. When the
+            samples are analysed again with the same settings (for instance after adding an observable or changing a
+            cut), the events are read from there, and only the observables, cuts, and efficiencies are calculated.
+            The cached events keep their smearing. This implies columnar=True, and files whose events are not cached
+            yet are parsed in one process. Default value: None.
+
         Returns
         -------
             None
@@ -555,32 +615,24 @@ class LHEReader:
         self.signal_events_per_benchmark = [0 for _ in range(self.n_benchmarks_phys)]
         self.background_events = 0
 
-        for lhe_file, is_background, sampling_benchmark, k_factor, sample_syst_names in zip(
-            self.lhe_sample_filenames,
-            self.sample_is_backgrounds,
-            self.sampling_benchmarks,
-            self.sample_k_factors,
-            self.sample_systematics,
-        ):
-            logger.info(
-                "Analysing LHE sample %s: Calculating %s observables, requiring %s selection cuts, using %s efficiency"
-                " factors, associated with %s",
-                lhe_file,
-                len(self.observables),
-                len(self.cuts),
-                len(self.efficiencies),
-                "no systematics" if sample_syst_names is None else "systematics" + ", ".join(list(sample_syst_names)),
+        samples = list(
+            zip(
+                self.sample_is_backgrounds,
+                self.sample_k_factors,
+                self.lhe_sample_filenames,
+                [parse_events_as_xml for _ in self.lhe_sample_filenames],
+                [reference_benchmark for _ in self.lhe_sample_filenames],
+                self.sampling_benchmarks,
+                self.sample_systematics,
             )
+        )
+        results = self._parse_samples(samples, columnar, batch_size, n_processes, cache_directory)
 
-            this_observations, this_weights, this_n_events = self._parse_sample(
-                is_background,
-                k_factor,
-                lhe_file,
-                parse_events_as_xml,
-                reference_benchmark,
-                sampling_benchmark,
-                sample_syst_names,
-            )
+        for (is_background, _, _, _, _, sampling_benchmark, _), result in zip(samples, results):
+            this_observations, this_weights, this_n_events, systematics_dict = result
+
+            # Store nuisance parameters
+            self._store_nuisance_parameters(systematics_dict)
 
             # No results?
             if this_observations is None:
@@ -645,6 +697,63 @@ class LHEReader:
         if self.background_events > 0:
             logger.info("  %s from backgrounds", self.background_events)
 
+    def _parse_samples(self, samples, columnar, batch_size, n_processes, cache_directory=None):
+        """ Analyses all samples, in parallel if n_processes is None or larger than 1, and yields the results in the
+        order of the samples """
+
+        global _shared_analysis_setup
+
+        if n_processes is None:
+            n_processes = multiprocessing.cpu_count()
+
+        # Files one after another (with several processes, each file is split into parts parsed in parallel)
+        if min(n_processes, len(samples)) <= 1:
+            for sample in samples:
+                self._report_sample(sample)
+                yield self._parse_sample(
+                    *sample,
+                    columnar=columnar,
+                    batch_size=batch_size,
+                    n_processes=n_processes,
+                    cache_directory=cache_directory
+                )
+            return
+        n_processes = min(n_processes, len(samples))
+
+        # Files in parallel
+        for sample in samples:
+            self._report_sample(sample)
+        logger.info("Analysing %s LHE samples in %s processes", len(samples), n_processes)
+
+        _shared_analysis_setup = (
+            self, samples, {"columnar": columnar, "batch_size": batch_size, "cache_directory": cache_directory}
+        )
+        context = get_fork_context()
+        pool = context.Pool(processes=n_processes)
+
+        try:
+            seeds = np.random.randint(0, 2 ** 31 - 1, size=len(samples))
+            results = pool.map(_parse_sample_in_worker, list(zip(range(len(samples)), seeds)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _shared_analysis_setup = None
+
+        for result in results:
+            yield result
+
+    def _report_sample(self, sample):
+        _, _, lhe_file, _, _, _, sample_syst_names = sample
+        logger.info(
+            "Analysing LHE sample %s: Calculating %s observables, requiring %s selection cuts, using %s efficiency"
+            " factors, associated with %s",
+            lhe_file,
+            len(self.observables),
+            len(self.cuts),
+            len(self.efficiencies),
+            "no systematics" if sample_syst_names is None else "systematics" + ", ".join(list(sample_syst_names)),
+        )
+
     def _parse_sample(
         self,
         is_background,
@@ -654,6 +763,10 @@ class LHEReader:
         reference_benchmark,
         sampling_benchmark,
         sample_syst_names,
+        columnar=False,
+        batch_size=10000,
+        n_processes=1,
+        cache_directory=None,
     ):
         # Relevant systematics
         systematics_used = OrderedDict()
@@ -669,25 +782,6 @@ class LHEReader:
         # systematics_dict has structure
         # {systematics_name : {nuisance_parameter_name : ((benchmark0, weight0), (benchmark1, weight1), processing)}}
 
-        # Store nuisance parameters
-        for systematics_name, nuisance_info in six.iteritems(systematics_dict):
-            for nuisance_parameter_name, ((benchmark0, weight0), (benchmark1, weight1), _) in six.iteritems(
-                nuisance_info
-            ):
-                if (
-                    self.nuisance_parameters is not None
-                    and nuisance_parameter_name in self.nuisance_parameters
-                    and (systematics_name, benchmark0, benchmark1) != self.nuisance_parameters[nuisance_parameter_name]
-                ):
-                    raise RuntimeError(
-                        "Inconsistent information for same nuisance parameter {}. Old: {}. New: {}.".format(
-                            nuisance_parameter_name,
-                            self.nuisance_parameters[nuisance_parameter_name],
-                            (systematics_name, benchmark0, benchmark1),
-                        )
-                    )
-                self.nuisance_parameters[nuisance_parameter_name] = (systematics_name, benchmark0, benchmark1)
-
         # Calculate observables and weights in LHE file
         this_observations, this_weights = parse_lhe_file(
             filename=lhe_file,
@@ -708,12 +802,16 @@ class LHEReader:
             k_factor=k_factor,
             parse_events_as_xml=parse_events_as_xml,
             systematics_dict=systematics_dict,
+            columnar=columnar,
+            batch_size=batch_size,
+            n_processes=n_processes,
+            cache_directory=cache_directory,
         )
 
         # No events found?
         if this_observations is None:
             logger.warning("No remaining events in this LHE file, skipping it")
-            return None, None
+            return None, None, 0, systematics_dict
         logger.debug("Found weights %s in LHE file", list(this_weights.keys()))
 
         # Sanity checks
@@ -726,7 +824,38 @@ class LHEReader:
             if key not in self.benchmark_names_phys:  # Only rescale nuisance benchmarks
                 this_weights[key] = reference_weights / sampling_weights * this_weights[key]
 
-        return this_observations, this_weights, n_events
+        return this_observations, this_weights, n_events, systematics_dict
+
+    def _store_nuisance_parameters(self, systematics_dict):
+        for systematics_name, nuisance_info in six.iteritems(systematics_dict):
+            for nuisance_parameter_name, ((benchmark0, weight0), (benchmark1, weight1), _) in six.iteritems(
+                nuisance_info
+            ):
+                if (
+                    self.nuisance_parameters is not None
+                    and nuisance_parameter_name in self.nuisance_parameters
+                    and (systematics_name, benchmark0, benchmark1) != self.nuisance_parameters[nuisance_parameter_name]
+                ):
+                    raise RuntimeError(
+                        "Inconsistent information for same nuisance parameter {}. Old: {}. New: {}.".format(
+                            nuisance_parameter_name,
+                            self.nuisance_parameters[nuisance_parameter_name],
+                            (systematics_name, benchmark0, benchmark1),
+                        )
+                    )
+                self.nuisance_parameters[nuisance_parameter_name] = (systematics_name, benchmark0, benchmark1)
+
+    @staticmethod
+    def _check_python_syntax(expression):
+        """ Compiles a Python expression, so that this only happens once and not for every event. Invalid expressions
+        are only reported, since they fall back to their default values when the events are parsed. """
+
+        if not isinstance(expression, six.string_types):
+            return
+        try:
+            compile_expression(expression)
+        except SyntaxError:
+            logger.warning("Expression %s is not valid Python and will not be parsed", expression)
 
     @staticmethod
     def _check_sample_observations_and_weights(this_observations, this_weights):
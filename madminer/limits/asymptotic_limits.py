@@ -1,11 +1,15 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import hashlib
 import logging
+import multiprocessing
 import numpy as np
+import torch
+from collections import OrderedDict
 from scipy.stats import chi2, poisson
 
 from madminer.analysis import DataAnalyzer
-from madminer.utils.various import mdot, less_logging
+from madminer.utils.various import mdot, less_logging, get_fork_context
 from madminer.ml import ParameterizedRatioEstimator, Ensemble, ScoreEstimator, LikelihoodEstimator, load_estimator
 from madminer.utils.histo import Histo
 from madminer.sampling import SampleAugmenter
@@ -13,6 +17,49 @@ from madminer import sampling
 
 logger = logging.getLogger(__name__)
 
+# Likelihood function (and cache) that forked worker processes use, see
+# AsymptoticLimits._make_parallel_log_likelihood_function
+_shared_log_likelihood_function = None
+_shared_cache = None
+
+
+def _set_shared_log_likelihood_function(function, cache=None):
+    global _shared_log_likelihood_function, _shared_cache
+    _shared_log_likelihood_function = function
+    _shared_cache = cache
+
+
+def _initialize_worker():
+    # One thread per worker, so that the processes do not compete for cores
+    torch.set_num_threads(1)
+
+
+def _calculate_log_likelihood_shard(thetas):
+    # New cache entries are sent back to the main process together with the results
+    keys_before = None if _shared_cache is None else set(_shared_cache.keys())
+    results = _shared_log_likelihood_function(thetas)
+    if keys_before is None:
+        return results, None
+    cache_updates = {key: value for key, value in _shared_cache.items() if key not in keys_before}
+    return results, cache_updates
+
+
+def _make_cache_key(item):
+    if isinstance(item, np.ndarray):
+        item = np.ascontiguousarray(item)
+        return "ndarray", item.shape, item.dtype.str, hashlib.sha1(item.tobytes()).hexdigest()
+    if isinstance(item, (list, tuple)):
+        return tuple([_make_cache_key(element) for element in item])
+    return item
+
+
+def _merge_not_finite_events(event_arrays):
+    # Parameter points that were evaluated together share one array of events, which is only merged once
+    event_arrays = OrderedDict((id(events), events) for events in event_arrays if events is not None)
+    if len(event_arrays) == 0:
+        return None
+    return np.unique(np.concatenate([np.zeros(0, dtype=np.int64)] + list(event_arrays.values())).astype(np.int64))
+
 
 class AsymptoticLimits(DataAnalyzer):
     """
@@ -44,14 +91,36 @@ class AsymptoticLimits(DataAnalyzer):
 
     include_nuisance_parameters : bool, optional
         If True, nuisance parameters are taken into account. Currently not implemented. Default value: False.
+
+    cache : bool, optional
+        If True, the instance works as a limit-setting session: loaded estimators, Asimov data, summary statistics,
+        weighted toy events, fixed adaptive binnings, histograms, the kinematic likelihood evaluated with neural
+        networks, and benchmark cross sections are kept in memory, keyed on the inputs they depend on. Repeated calls
+        of `observed_limits()` or `expected_limits()`, for instance for different luminosities, observed data, or
+        `theta_true`, then only recalculate what has changed. The cache assumes that the MadMiner file and model
+        files do not change on disk; use `clear_cache()` otherwise. Default value: False.
     """
 
-    def __init__(self, filename=None, include_nuisance_parameters=False):
+    def __init__(self, filename=None, include_nuisance_parameters=False, cache=False):
         if include_nuisance_parameters:
             raise NotImplementedError("AsymptoticLimits does not yet support nuisance parameters.")
 
         super(AsymptoticLimits, self).__init__(filename, False, include_nuisance_parameters=False)
 
+        self._cache = {} if cache else None
+
+    def clear_cache(self):
+        """
+        Removes all intermediate results stored when the instance was created with `cache=True`.
+
+        Returns
+        -------
+            None
+
+        """
+        if self._cache is not None:
+            self._cache = {}
+
     def observed_limits(
         self,
         mode,
@@ -77,6 +146,10 @@ class AsymptoticLimits(DataAnalyzer):
         postprocessing=None,
         n_binning_toys=100000,
         thetas_eval=None,
+        x_batchsize=10000,
+        grid_refinements=None,
+        refinement_p_values=None,
+        n_processes=1,
     ):
         """
         Calculates p-values over a grid in parameter space based on a given set of observed events.
@@ -219,6 +292,31 @@ class AsymptoticLimits(DataAnalyzer):
             Manually specifies the parameter point at which the likelihood and p-values are evaluated. If None,
             grid_ranges and resolution are used instead to construct a regular grid. Default value: None.
 
+        x_batchsize : int or None, optional
+            Number of events for which the kinematic log likelihood ratio is evaluated in one go when mode is "ml". The
+            log likelihood ratio is reduced over events batch by batch, and the parameter points are processed in
+            chunks of at most `10**7 / x_batchsize` points, so the memory footprint scales as
+            `n_grid_points + x_batchsize * chunk_size` instead of `n_grid_points * n_events`. If None, all events are
+            evaluated at once. Default value: 10000.
+
+        grid_refinements : int or None, optional
+            If not None, the regular grid given by grid_ranges and grid_resolutions is only the starting point of an
+            adaptive refinement. In each of grid_refinements steps, every grid cell whose corners straddle one of the
+            p-values in refinement_p_values, or that has the best-fit point as a corner, is split into cells of half the
+            size along each dimension, and the likelihood is evaluated at the new points. The returned parameter points
+            are then scattered rather than on a regular grid. Requires grid_ranges and grid_resolutions. Default value:
+            None.
+
+        refinement_p_values : list of float or None, optional
+            p-values of the contours that are resolved by the adaptive grid refinement. If None, [0.32, 0.05] is used.
+            Only has an effect if grid_refinements is not None. Default value: None.
+
+        n_processes : None or int, optional
+            If None or larger than 1, the parameter points are split into shards that are evaluated in parallel by
+            this number of worker processes (None uses the number of CPUs). This covers the histogram construction,
+            the histogram likelihoods, and the neural network evaluation. The workers are forked processes that share
+            the summary statistics, weights, and models with the main process. Default value: 1.
+
         Returns
         -------
         parameter_grid : ndarray
@@ -268,6 +366,10 @@ class AsymptoticLimits(DataAnalyzer):
             postprocessing=postprocessing,
             n_binning_toys=n_binning_toys,
             thetas_eval=thetas_eval,
+            x_batchsize=x_batchsize,
+            grid_refinements=grid_refinements,
+            refinement_p_values=refinement_p_values,
+            n_processes=n_processes,
         )
         return results
 
@@ -297,6 +399,10 @@ class AsymptoticLimits(DataAnalyzer):
         n_asimov=None,
         n_binning_toys=100000,
         thetas_eval=None,
+        x_batchsize=10000,
+        grid_refinements=None,
+        refinement_p_values=None,
+        n_processes=1,
     ):
 
         """
@@ -442,6 +548,31 @@ class AsymptoticLimits(DataAnalyzer):
             Manually specifies the parameter point at which the likelihood and p-values are evaluated. If None,
             grid_ranges and resolution are used instead to construct a regular grid. Default value: None.
 
+        x_batchsize : int or None, optional
+            Number of events for which the kinematic log likelihood ratio is evaluated in one go when mode is "ml". The
+            log likelihood ratio is reduced over events batch by batch, and the parameter points are processed in
+            chunks of at most `10**7 / x_batchsize` points, so the memory footprint scales as
+            `n_grid_points + x_batchsize * chunk_size` instead of `n_grid_points * n_events`. If None, all events are
+            evaluated at once. Default value: 10000.
+
+        grid_refinements : int or None, optional
+            If not None, the regular grid given by grid_ranges and grid_resolutions is only the starting point of an
+            adaptive refinement. In each of grid_refinements steps, every grid cell whose corners straddle one of the
+            p-values in refinement_p_values, or that has the best-fit point as a corner, is split into cells of half the
+            size along each dimension, and the likelihood is evaluated at the new points. The returned parameter points
+            are then scattered rather than on a regular grid. Requires grid_ranges and grid_resolutions. Default value:
+            None.
+
+        refinement_p_values : list of float or None, optional
+            p-values of the contours that are resolved by the adaptive grid refinement. If None, [0.32, 0.05] is used.
+            Only has an effect if grid_refinements is not None. Default value: None.
+
+        n_processes : None or int, optional
+            If None or larger than 1, the parameter points are split into shards that are evaluated in parallel by
+            this number of worker processes (None uses the number of CPUs). This covers the histogram construction,
+            the histogram likelihoods, and the neural network evaluation. The workers are forked processes that share
+            the summary statistics, weights, and models with the main process. Default value: 1.
+
         Returns
         -------
         parameter_grid : ndarray
@@ -466,12 +597,16 @@ class AsymptoticLimits(DataAnalyzer):
         """
 
         logger.info("Generating Asimov data")
-        x_asimov, x_weights = self._asimov_data(
-            theta_true,
-            sample_only_from_closest_benchmark=sample_only_from_closest_benchmark,
-            test_split=test_split,
-            n_asimov=n_asimov,
+        x_asimov, x_weights = self._from_cache(
+            ("asimov data", theta_true, sample_only_from_closest_benchmark, test_split, n_asimov),
+            lambda: self._asimov_data(
+                theta_true,
+                sample_only_from_closest_benchmark=sample_only_from_closest_benchmark,
+                test_split=test_split,
+                n_asimov=n_asimov,
+            ),
         )
+        x_weights = np.copy(x_weights)
         n_observed = luminosity * self._calculate_xsecs([theta_true])[0]
         logger.info("Expected events: %s", n_observed)
         results = self._analyse(
@@ -500,6 +635,10 @@ class AsymptoticLimits(DataAnalyzer):
             postprocessing=postprocessing,
             n_binning_toys=n_binning_toys,
             thetas_eval=thetas_eval,
+            x_batchsize=x_batchsize,
+            grid_refinements=grid_refinements,
+            refinement_p_values=refinement_p_values,
+            n_processes=n_processes,
         )
         return results
 
@@ -556,6 +695,10 @@ class AsymptoticLimits(DataAnalyzer):
         postprocessing=None,
         n_binning_toys=100000,
         thetas_eval=None,
+        x_batchsize=10000,
+        grid_refinements=None,
+        refinement_p_values=None,
+        n_processes=1,
     ):
         logger.info(
             "Calculating p-values for %s expected events in mode %s %s rate information",
@@ -592,32 +735,33 @@ class AsymptoticLimits(DataAnalyzer):
             raise ValueError("thetas_eval and grid_resolutions cannot both be set, make up your mind!")
         elif thetas_eval is None:
             theta_grid, theta_middle = self._make_theta_grid(theta_ranges, theta_resolutions)
-            logger.info("Evaluating likelihood on a regular grid with %s parameter points", theta_grid.shape[0])
+            if grid_refinements:
+                logger.info(
+                    "Evaluating likelihood on a regular grid with %s parameter points and refining it up to %s times",
+                    theta_grid.shape[0],
+                    grid_refinements,
+                )
+            else:
+                logger.info("Evaluating likelihood on a regular grid with %s parameter points", theta_grid.shape[0])
+        elif grid_refinements:
+            raise ValueError("Adaptive grid refinement requires grid_ranges and grid_resolutions, not thetas_eval")
         else:
             assert len(thetas_eval.shape) == 2, "thetas_eval has to be two-dimensional array"
             theta_grid = thetas_eval
             theta_middle = self._find_theta_middle(theta_grid)
             logger.info("Evaluating likelihood on %s user-provided parameter points", theta_grid.shape[0])
 
-        histos = None
-        processed_summary_stats = None
-
-        # Kinematic part
+        # Kinematic part: set up
         if mode == "rate":
-            log_r_kin = 0.0
+            pass
 
         elif mode == "ml":
             assert model_file is not None
             logger.info("Loading kinematic likelihood ratio estimator")
-            model = load_estimator(model_file)
-
-            logger.info("Calculating kinematic log likelihood ratio with estimator")
-            log_r_kin = self._calculate_log_likelihood_ratio_kinematics(x, theta_grid, model, theta_true)
-            log_r_kin = log_r_kin.astype(np.float64)
-            log_r_kin = self._clean_nans(log_r_kin)
-            logger.debug("Raw mean -2 log r: %s", np.mean(-2.0 * log_r_kin, axis=1))
-            log_r_kin = n_events * np.sum(log_r_kin * obs_weights[np.newaxis, :], axis=1)
-            logger.debug("Rescaled -2 log r: %s", -2.0 * log_r_kin)
+            model = self._from_cache(("estimator", model_file), lambda: load_estimator(model_file))
+            ml_cache_key = None
+            if self._cache is not None:
+                ml_cache_key = ("ml", model_file, _make_cache_key(x), _make_cache_key(obs_weights), theta_true)
 
         elif mode in ["histo", "sally", "adaptive-sally", "sallino"]:
             if mode == "histo" and hist_vars is None:
@@ -633,6 +777,7 @@ class AsymptoticLimits(DataAnalyzer):
                 logger.info("Setting up standard summary statistics")
                 summary_function = self._make_summary_statistic_function("observables", observables=hist_vars)
                 processor = self._make_obs_processor(postprocessing=postprocessing)
+                summary_key = ("observables", hist_vars)
 
             elif mode in ["sally", "adaptive-sally", "sallino"]:
                 if score_components is None:
@@ -641,64 +786,208 @@ class AsymptoticLimits(DataAnalyzer):
                     logger.info(
                         "Loading score estimator and setting components %s up as summary statistics", score_components
                     )
-                model = load_estimator(model_file)
+                model = self._from_cache(("estimator", model_file), lambda: load_estimator(model_file))
                 summary_function = self._make_summary_statistic_function(
                     "sally", model=model, observables=score_components
                 )
                 processor = self._make_score_processor(
                     mode, score_components=score_components, thetaref=thetaref, postprocessing=postprocessing
                 )
+                summary_key = ("sally", model_file, score_components)
 
             else:
                 raise RuntimeError("For 'histo' mode, either provide histo_vars or model_file!")
 
             # Calculate summary stats (before SALLINO / adaptive-SALLY transforms)
-            summary_stats = summary_function(x)
+            summary_stats = self._from_cache(
+                ("summary statistics", summary_key, _make_cache_key(x)), lambda: summary_function(x)
+            )
             del x
 
+            # Keys for cached toys, binning, and histograms. The postprocessing function is only known by its id, so
+            # a reference to it is kept in the cache to make sure that the id is not reused by another function
+            processor_key = (mode, score_components, thetaref, id(postprocessing))
+            if self._cache is not None and postprocessing is not None:
+                self._cache[("postprocessing", id(postprocessing))] = postprocessing
+
             # Dimension of summary statistic space
             hist_bins, n_bins_each, n_summary_stats, total_n_bins = self._find_bins(mode, hist_bins, summary_stats)
 
-            # Make histograms
             logger.info(
                 "Creating histograms of %s summary statistics. Using %s bins each, or %s in total.",
                 n_summary_stats,
                 n_bins_each,
                 total_n_bins,
             )
-            histos = self._make_histos(
-                summary_function,
-                hist_bins,
-                theta_grid,
-                n_histo_toys,
-                histo_theta_batchsize=histo_theta_batchsize,
-                weighted_histo=weighted_histo,
-                test_split=test_split,
-                processor=processor,
-                fixed_adaptive_binning=fix_adaptive_binning in ["center", "grid"],
-                theta_binning=theta_middle if fix_adaptive_binning == "center" else None,
-                n_binning_toys=n_binning_toys,
-            )
 
-            # Evaluate histograms
-            logger.info("Calculating kinematic log likelihood with histograms")
-            log_r_kin, processed_summary_stats = self._calculate_log_likelihood_histo(
-                summary_stats, theta_grid, histos, processor=processor, return_observed=return_observed
-            )
-            log_r_kin = log_r_kin.astype(np.float64)
-            log_r_kin = self._clean_nans(log_r_kin)
-            log_r_kin = n_events * np.sum(log_r_kin * obs_weights[np.newaxis, :], axis=1)
+            # Fixed adaptive binning is determined once, so it can be shared by all (parallel / refinement) steps
+            if fix_adaptive_binning in ["center", "grid"]:
+                hist_bins = self._from_cache(
+                    (
+                        "binning",
+                        summary_key,
+                        processor_key,
+                        hist_bins,
+                        theta_grid if fix_adaptive_binning == "grid" else theta_middle,
+                        n_binning_toys,
+                        test_split,
+                    ),
+                    lambda: self._find_fixed_adaptive_binning(
+                        summary_function,
+                        hist_bins,
+                        theta_grid if fix_adaptive_binning == "grid" else None,
+                        theta_binning=theta_middle if fix_adaptive_binning == "center" else None,
+                        test_split=test_split,
+                        processor=processor,
+                        n_binning_toys=n_binning_toys,
+                        toy_data=self._from_cache(
+                            ("binning toys", summary_key, n_binning_toys, test_split),
+                            lambda: self._make_weighted_toy_data(summary_function, n_binning_toys, test_split),
+                        ),
+                    ),
+                )
+
+            # Weighted toy events are drawn once, so all histograms (also in parallel workers) share them
+            toy_data = None
+            if weighted_histo:
+                toy_data = self._from_cache(
+                    ("histogram toys", summary_key, n_histo_toys, test_split),
+                    lambda: self._make_weighted_toy_data(summary_function, n_histo_toys, test_split),
+                )
+            histo_key = ("histos", summary_key, processor_key, hist_bins, n_histo_toys, weighted_histo, test_split)
 
         else:
             raise ValueError("Unknown mode {}, has to be 'ml' or 'histo' or 'xsec'".format(mode))
 
-        # xsec part
-        if include_xsec:
-            logger.info("Calculating rate log likelihood")
-            log_p_xsec = self._calculate_log_likelihood_xsec(n_events, theta_grid, luminosity)
-            logger.debug("Rate -2 log p: %s", -2.0 * log_p_xsec)
+        def calculate_summed_log_likelihood_ratio(thetas):
+            # One result per parameter point, as they are cached separately. All of them share the events with
+            # inf / nan results, which may therefore also contain events that are finite at this parameter point
+            log_r_sum, not_finite_events = self._calculate_summed_log_likelihood_ratio_kinematics(
+                x, obs_weights, thetas, model, theta_true, x_batchsize=x_batchsize
+            )
+            return [(log_r_sum_this_theta, not_finite_events) for log_r_sum_this_theta in log_r_sum]
+
+        def calculate_log_likelihood(thetas):
+            histos, processed_summary_stats, not_finite_events = None, None, None
+
+            # Kinematic part
+            if mode == "rate":
+                log_r_kin = 0.0
+
+            elif mode == "ml":
+                logger.info("Calculating kinematic log likelihood ratio with estimator")
+                results = self._from_cache_per_theta(ml_cache_key, thetas, calculate_summed_log_likelihood_ratio)
+                log_r_kin = n_events * np.asarray([log_r_sum for log_r_sum, _ in results], dtype=np.float64)
+                not_finite_events = _merge_not_finite_events([events for _, events in results])
+                logger.debug("Rescaled -2 log r (before removing inf / nan results): %s", -2.0 * log_r_kin)
+
+            else:
+                # Make histograms
+                histos = self._from_cache_per_theta(
+                    histo_key,
+                    thetas,
+                    lambda thetas_: self._make_histos(
+                        summary_function,
+                        hist_bins,
+                        thetas_,
+                        n_histo_toys,
+                        histo_theta_batchsize=histo_theta_batchsize,
+                        weighted_histo=weighted_histo,
+                        test_split=test_split,
+                        processor=processor,
+                        fixed_adaptive_binning=False,
+                        n_binning_toys=n_binning_toys,
+                        toy_data=toy_data,
+                    ),
+                )
+
+                # Evaluate histograms
+                logger.info("Calculating kinematic log likelihood with histograms")
+                log_r_kin, processed_summary_stats = self._calculate_log_likelihood_histo(
+                    summary_stats, thetas, histos, processor=processor, return_observed=return_observed
+                )
+                log_r_kin = log_r_kin.astype(np.float64)
+                not_finite = ~np.isfinite(log_r_kin)
+                not_finite_events = np.flatnonzero(np.any(not_finite, axis=0))
+                log_r_kin[not_finite] = 0.0
+                log_r_kin = n_events * np.sum(log_r_kin * obs_weights[np.newaxis, :], axis=1)
+
+            # xsec part
+            if include_xsec:
+                logger.info("Calculating rate log likelihood")
+                log_p_xsec = self._calculate_log_likelihood_xsec(n_events, thetas, luminosity)
+                logger.debug("Rate -2 log p: %s", -2.0 * log_p_xsec)
+            else:
+                log_p_xsec = 0.0
+
+            return log_r_kin, log_p_xsec, histos, processed_summary_stats, not_finite_events
+
+        def exclude_not_finite_events(thetas, log_r_kin, not_finite_events, histos):
+            # Events with inf / nan at any parameter point are removed at all parameter points. Every evaluation
+            # only zeroes the inf / nan entries themselves, so that the result does not depend on how the parameter
+            # points were split into shards, refinement steps, or cached subsets; the finite contributions of these
+            # events are subtracted here once all parameter points are known. Cached results can list events that
+            # only have inf / nan results at other parameter points, so the candidates are evaluated again first
+            if not_finite_events is None or len(not_finite_events) == 0:
+                return log_r_kin
+            events = np.asarray(not_finite_events, dtype=np.int64)
+
+            if mode == "ml":
+                log_r_events_sum, not_finite = self._calculate_summed_log_likelihood_ratio_kinematics(
+                    x[events], obs_weights[events], thetas, model, theta_true, x_batchsize=x_batchsize
+                )
+                if len(not_finite) < len(events):
+                    events = events[not_finite]
+                    if len(events) == 0:
+                        return log_r_kin
+                    log_r_events_sum, _ = self._calculate_summed_log_likelihood_ratio_kinematics(
+                        x[events], obs_weights[events], thetas, model, theta_true, x_batchsize=x_batchsize
+                    )
+                logger.warning("Removing %s inf / nan results from calculation", len(events))
+                return log_r_kin - n_events * log_r_events_sum
+
+            log_r_events, _ = self._calculate_log_likelihood_histo(
+                summary_stats[events], thetas, histos, processor=processor
+            )
+            log_r_events = np.asarray(log_r_events, dtype=np.float64)
+            not_finite = ~np.isfinite(log_r_events)
+            is_excluded = np.any(not_finite, axis=0)
+            if not np.any(is_excluded):
+                return log_r_kin
+            logger.warning("Removing %s inf / nan results from calculation", np.sum(is_excluded))
+            log_r_events[not_finite] = 0.0
+            return log_r_kin - n_events * log_r_events[:, is_excluded].dot(obs_weights[events[is_excluded]])
+
+        # Evaluate likelihood, either serially or on shards of the parameter grid in parallel
+        pool = None
+        if n_processes is None or n_processes > 1:
+            evaluate_log_likelihood, pool = self._make_parallel_log_likelihood_function(
+                calculate_log_likelihood, n_processes, cache=self._cache
+            )
         else:
-            log_p_xsec = 0.0
+            evaluate_log_likelihood = calculate_log_likelihood
+
+        try:
+            if grid_refinements:
+                theta_grid, log_r_kin, log_p_xsec, histos, processed_summary_stats = self._refine_theta_grid(
+                    evaluate_log_likelihood,
+                    exclude_not_finite_events,
+                    theta_ranges,
+                    theta_resolutions,
+                    grid_refinements,
+                    refinement_p_values=refinement_p_values,
+                    dof=dof,
+                )
+            else:
+                log_r_kin, log_p_xsec, histos, processed_summary_stats, not_finite_events = evaluate_log_likelihood(
+                    theta_grid
+                )
+                log_r_kin = exclude_not_finite_events(theta_grid, log_r_kin, not_finite_events, histos)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _set_shared_log_likelihood_function(None)
 
         # Combine and get p-values
         logger.info("Calculating p-values")
@@ -718,6 +1007,206 @@ class AsymptoticLimits(DataAnalyzer):
             histo_data = histos
         return theta_grid, p_values, i_ml, log_r_kin, log_p_xsec, histo_data
 
+    @staticmethod
+    def _make_parallel_log_likelihood_function(calculate_log_likelihood, n_processes=None, cache=None):
+        """
+        Wraps calculate_log_likelihood such that the parameter points are split into shards that are evaluated in a
+        pool of worker processes. The workers are forked after calculate_log_likelihood is registered, so they inherit
+        the summary statistics, observation weights and models without copying them (the pages are shared between
+        the processes as long as they are only read). Cache entries created by the workers are merged into cache.
+        """
+
+        if n_processes is None:
+            n_processes = multiprocessing.cpu_count()
+
+        logger.info("Evaluating likelihood on parameter points in parallel, using %s processes", n_processes)
+
+        _set_shared_log_likelihood_function(calculate_log_likelihood, cache)
+        context = get_fork_context()
+        pool = context.Pool(processes=n_processes, initializer=_initialize_worker)
+
+        def evaluate_log_likelihood(thetas):
+            shards = [shard for shard in np.array_split(thetas, n_processes) if len(shard) > 0]
+            logger.debug("Evaluating %s parameter points in %s shards", len(thetas), len(shards))
+            results = []
+            for shard_results, cache_updates in pool.map(_calculate_log_likelihood_shard, shards, chunksize=1):
+                results.append(shard_results)
+                if cache is not None:
+                    cache.update(cache_updates)
+
+            # Gather results
+            if all([np.ndim(result[0]) == 0 for result in results]):
+                log_r_kin = results[0][0]
+            else:
+                log_r_kin = np.concatenate(
+                    [np.broadcast_to(result[0], (len(shard),)) for shard, result in zip(shards, results)]
+                )
+            if all([np.ndim(result[1]) == 0 for result in results]):
+                log_p_xsec = results[0][1]
+            else:
+                log_p_xsec = np.concatenate(
+                    [np.broadcast_to(result[1], (len(shard),)) for shard, result in zip(shards, results)]
+                )
+
+            histos = None
+            if results[0][2] is not None:
+                histos = [histo for result in results for histo in result[2]]
+
+            processed_summary_stats = None
+            if results[0][3] is not None:
+                processed_summary_stats = [result[3] for result in results if len(result[3]) > 0]
+                if len(processed_summary_stats) > 0:
+                    processed_summary_stats = np.concatenate(processed_summary_stats, axis=0)
+                else:
+                    processed_summary_stats = np.asarray([])
+
+            not_finite_events = _merge_not_finite_events([result[4] for result in results])
+
+            return log_r_kin, log_p_xsec, histos, processed_summary_stats, not_finite_events
+
+        return evaluate_log_likelihood, pool
+
+    def _refine_theta_grid(
+        self,
+        calculate_log_likelihood,
+        exclude_not_finite_events,
+        theta_ranges,
+        theta_resolutions,
+        n_refinements,
+        refinement_p_values=None,
+        dof=None,
+    ):
+        """
+        Adaptively refines a regular grid. Starting from the grid given by theta_ranges and theta_resolutions, every
+        grid cell whose corners straddle one of the p-value levels in refinement_p_values, or which has the current MLE
+        as a corner, is split into 2^n_parameters cells of half the size. This is repeated n_refinements times, so
+        the final resolution in the interesting regions is that of a regular grid with
+        (theta_resolutions - 1) * 2^n_refinements + 1 points along each dimension. The events with inf / nan results
+        are removed with exclude_not_finite_events from all points evaluated so far after every step.
+        """
+
+        if refinement_p_values is None:
+            refinement_p_values = [0.32, 0.05]
+        refinement_p_values = np.asarray(refinement_p_values, dtype=np.float64)
+
+        n_parameters = len(theta_ranges)
+        if isinstance(theta_resolutions, int):
+            theta_resolutions = [theta_resolutions for _ in range(n_parameters)]
+        theta_resolutions = np.asarray(theta_resolutions, dtype=np.int64)
+        assert np.all(
+            theta_resolutions >= 2
+        ), "Adaptive grid refinement requires at least two grid points per dimension"
+        theta_min = np.array([theta_min for theta_min, _ in theta_ranges], dtype=np.float64)
+        theta_max = np.array([theta_max for _, theta_max in theta_ranges], dtype=np.float64)
+
+        # Points are labelled by integer indices on the finest lattice
+        finest_step = 2 ** n_refinements
+        n_finest = (theta_resolutions - 1) * finest_step + 1
+        theta_spacing = (theta_max - theta_min) / (n_finest - 1)
+
+        corner_offsets = np.array(np.meshgrid(*[[0, 1] for _ in range(n_parameters)], indexing="ij"))
+        corner_offsets = corner_offsets.reshape(n_parameters, -1).T  # (2^n_parameters, n_parameters)
+        child_offsets = np.array(np.meshgrid(*[[0, 1, 2] for _ in range(n_parameters)], indexing="ij"))
+        child_offsets = child_offsets.reshape(n_parameters, -1).T  # (3^n_parameters, n_parameters)
+
+        point_index = {}  # lattice index tuple -> position in the list of evaluated points
+        all_indices = []
+        all_log_r_kin, all_log_p_xsec, all_histos, all_processed_summary_stats = [], [], [], []
+        all_not_finite_events = set()
+
+        def evaluate(new_indices):
+            new_indices = [idx for idx in new_indices if idx not in point_index]
+            new_indices = list(OrderedDict.fromkeys(new_indices))
+            if len(new_indices) == 0:
+                return
+            thetas = theta_min[np.newaxis, :] + np.asarray(new_indices, dtype=np.float64) * theta_spacing
+            log_r_kin, log_p_xsec, histos, processed_summary_stats, not_finite_events = calculate_log_likelihood(thetas)
+
+            for idx in new_indices:
+                point_index[idx] = len(all_indices)
+                all_indices.append(idx)
+            all_log_r_kin.append(np.broadcast_to(np.asarray(log_r_kin, dtype=np.float64), (len(thetas),)))
+            all_log_p_xsec.append(np.broadcast_to(np.asarray(log_p_xsec, dtype=np.float64), (len(thetas),)))
+            if histos is not None:
+                all_histos.extend(histos)
+            if processed_summary_stats is not None and len(processed_summary_stats) > 0:
+                all_processed_summary_stats.append(processed_summary_stats)
+            if not_finite_events is not None:
+                all_not_finite_events.update(not_finite_events)
+
+        def get_log_r_kin():
+            return exclude_not_finite_events(
+                theta_min[np.newaxis, :] + np.asarray(all_indices, dtype=np.float64) * theta_spacing,
+                np.concatenate(all_log_r_kin),
+                np.array(sorted(all_not_finite_events), dtype=np.int64),
+                all_histos if len(all_histos) > 0 else None,
+            )
+
+        # Initial, coarse grid
+        coarse_each = [np.arange(0, n, finest_step) for n in n_finest]
+        cells = np.array(np.meshgrid(*[each[:-1] for each in coarse_each], indexing="ij"))
+        cells = cells.reshape(n_parameters, -1).T
+        coarse_points = np.array(np.meshgrid(*coarse_each, indexing="ij")).reshape(n_parameters, -1).T
+        evaluate([tuple(idx) for idx in coarse_points])
+        step = finest_step
+
+        for i_refinement in range(n_refinements):
+            # p-values with respect to the current best fit
+            log_r = get_log_r_kin() + np.concatenate(all_log_p_xsec)
+            log_r, i_ml = self._subtract_mle(log_r)
+            p_values = self.asymptotic_p_value(log_r, dof=dof)
+            idx_ml = np.asarray(all_indices[i_ml])
+
+            # Find cells to refine
+            corner_positions = [
+                [point_index[tuple(cell + step * offset)] for offset in corner_offsets] for cell in cells
+            ]
+            corner_p_values = p_values[np.asarray(corner_positions)]  # (n_cells, 2^n_parameters)
+            p_min = np.min(corner_p_values, axis=1)
+            p_max = np.max(corner_p_values, axis=1)
+            straddling = np.any(
+                (p_min[:, np.newaxis] < refinement_p_values[np.newaxis, :])
+                & (p_max[:, np.newaxis] >= refinement_p_values[np.newaxis, :]),
+                axis=1,
+            )
+            contains_mle = np.all((cells <= idx_ml[np.newaxis, :]) & (idx_ml[np.newaxis, :] <= cells + step), axis=1)
+            cells = cells[straddling | contains_mle]
+
+            if len(cells) == 0:
+                logger.info("No grid cells left to refine after %s refinement steps", i_refinement)
+                break
+
+            # Split cells
+            step = step // 2
+            new_points = (cells[:, np.newaxis, :] + step * child_offsets[np.newaxis, :, :]).reshape(-1, n_parameters)
+            n_before = len(all_indices)
+            evaluate([tuple(idx) for idx in new_points])
+            cells = (cells[:, np.newaxis, :] + step * corner_offsets[np.newaxis, :, :]).reshape(-1, n_parameters)
+            logger.info(
+                "Refinement step %s / %s: refined %s cells, evaluated %s new parameter points",
+                i_refinement + 1,
+                n_refinements,
+                len(cells) // 2 ** n_parameters,
+                len(all_indices) - n_before,
+            )
+
+        theta_grid = theta_min[np.newaxis, :] + np.asarray(all_indices, dtype=np.float64) * theta_spacing
+        log_r_kin = get_log_r_kin()
+        log_p_xsec = np.concatenate(all_log_p_xsec)
+        histos = all_histos if len(all_histos) > 0 else None
+        if len(all_processed_summary_stats) > 0:
+            processed_summary_stats = np.concatenate(all_processed_summary_stats, axis=0)
+        else:
+            processed_summary_stats = None
+
+        logger.info(
+            "Evaluated likelihood on %s parameter points, compared to %s on the full regular grid",
+            len(all_indices),
+            np.prod(n_finest),
+        )
+
+        return theta_grid, log_r_kin, log_p_xsec, histos, processed_summary_stats
+
     def _find_bins(self, mode, hist_bins, summary_stats):
         n_summary_stats = summary_stats.shape[1]
         if mode == "adaptive-sally" and n_summary_stats > 2:
@@ -864,9 +1353,13 @@ class AsymptoticLimits(DataAnalyzer):
         start_event, end_event, correction_factor = self._train_test_split(False, test_split)
 
         # Total xsecs for benchmarks
-        xsecs_benchmarks = 0.0
-        for observations, weights in self.event_loader(start=start_event, end=end_event):
-            xsecs_benchmarks += np.sum(weights, axis=0)
+        def calculate_xsecs_benchmarks():
+            xsecs_benchmarks = 0.0
+            for observations, weights in self.event_loader(start=start_event, end=end_event):
+                xsecs_benchmarks += np.sum(weights, axis=0)
+            return xsecs_benchmarks
+
+        xsecs_benchmarks = self._from_cache(("benchmark xsecs", test_split), calculate_xsecs_benchmarks)
 
         # xsecs at thetas
         xsecs = []
@@ -896,7 +1389,7 @@ class AsymptoticLimits(DataAnalyzer):
     @staticmethod
     def _make_theta_grid(theta_ranges, resolutions):
         if isinstance(resolutions, int):
-            resolutions = [resolutions for _ in range(theta_ranges)]
+            resolutions = [resolutions for _ in range(len(theta_ranges))]
         theta_each = []
         theta_middle = []
         for resolution, (theta_min, theta_max) in zip(resolutions, theta_ranges):
@@ -925,20 +1418,19 @@ class AsymptoticLimits(DataAnalyzer):
         fixed_adaptive_binning=True,
         theta_binning=None,
         n_binning_toys=1000,
+        toy_data=None,
     ):
 
-        if fixed_adaptive_binning and (isinstance(x_bins, int) or any([isinstance(x, int) for x in x_bins])):
-            if theta_binning is None:
-                logger.info("Determining fixed adaptive histogram binning for all points on grid")
-                x_bins = self._fixed_adaptive_binning(
-                    n_binning_toys, processor, summary_function, test_split, theta_grid, x_bins
-                )
-            else:
-                logger.info("Determining fixed adaptive histogram binning for theta = %s", theta_binning)
-                x_bins = self._fixed_adaptive_binning(
-                    n_binning_toys, processor, summary_function, test_split, [theta_binning], x_bins
-                )
-            logger.debug("Fixed adaptive binning: %s", x_bins)
+        if fixed_adaptive_binning:
+            x_bins = self._find_fixed_adaptive_binning(
+                summary_function,
+                x_bins,
+                theta_grid,
+                theta_binning=theta_binning,
+                test_split=test_split,
+                processor=processor,
+                n_binning_toys=n_binning_toys,
+            )
 
         if weighted_histo and n_histo_toys is None:
             logger.debug("Generating weighted histo data in batches")
@@ -951,10 +1443,10 @@ class AsymptoticLimits(DataAnalyzer):
                 theta_batch = theta_grid[i_batch * histo_theta_batchsize : (i_batch + 1) * histo_theta_batchsize]
 
                 summary_stats, all_weights = self._make_weighted_histo_data(
-                    summary_function, theta_batch, n_histo_toys, test_split=test_split
+                    summary_function, theta_batch, n_histo_toys, test_split=test_split, toy_data=toy_data
                 )
 
-                for theta, weights in zip(theta_grid, all_weights):
+                for theta, weights in zip(theta_batch, all_weights):
                     if processor is None:
                         data = summary_stats
                     else:
@@ -964,7 +1456,7 @@ class AsymptoticLimits(DataAnalyzer):
         elif weighted_histo:
             logger.debug("Generating weighted histo data")
             summary_stats, all_weights = self._make_weighted_histo_data(
-                summary_function, theta_grid, n_histo_toys, test_split=test_split
+                summary_function, theta_grid, n_histo_toys, test_split=test_split, toy_data=toy_data
             )
 
             logger.debug("Making histograms")
@@ -998,9 +1490,36 @@ class AsymptoticLimits(DataAnalyzer):
 
         return histos
 
-    def _fixed_adaptive_binning(self, n_toys, processor, summary_function, test_split, thetas_binning, x_bins):
+    def _find_fixed_adaptive_binning(
+        self,
+        summary_function,
+        x_bins,
+        theta_grid,
+        theta_binning=None,
+        test_split=0.2,
+        processor=None,
+        n_binning_toys=1000,
+        toy_data=None,
+    ):
+        if isinstance(x_bins, int) or any([isinstance(x, int) for x in x_bins]):
+            if theta_binning is None:
+                logger.info("Determining fixed adaptive histogram binning for all points on grid")
+                x_bins = self._fixed_adaptive_binning(
+                    n_binning_toys, processor, summary_function, test_split, theta_grid, x_bins, toy_data
+                )
+            else:
+                logger.info("Determining fixed adaptive histogram binning for theta = %s", theta_binning)
+                x_bins = self._fixed_adaptive_binning(
+                    n_binning_toys, processor, summary_function, test_split, [theta_binning], x_bins, toy_data
+                )
+            logger.debug("Fixed adaptive binning: %s", x_bins)
+        return x_bins
+
+    def _fixed_adaptive_binning(
+        self, n_toys, processor, summary_function, test_split, thetas_binning, x_bins, toy_data=None
+    ):
         summary_stats, all_weights = self._make_weighted_histo_data(
-            summary_function, thetas_binning, n_toys, test_split=test_split
+            summary_function, thetas_binning, n_toys, test_split=test_split, toy_data=toy_data
         )
         all_weights = np.asarray(all_weights)
         weights = np.mean(all_weights, axis=0)
@@ -1012,7 +1531,7 @@ class AsymptoticLimits(DataAnalyzer):
         x_bins = histo.edges
         return x_bins
 
-    def _make_weighted_histo_data(self, summary_function, thetas, n_toys, test_split=0.2):
+    def _make_weighted_toy_data(self, summary_function, n_toys, test_split=0.2):
         # Get weighted events
         start_event, end_event, _ = self._train_test_split(True, test_split)
         x, weights_benchmarks = self.weighted_events(start_event=start_event, end_event=end_event, n_draws=n_toys)
@@ -1020,6 +1539,14 @@ class AsymptoticLimits(DataAnalyzer):
         # Calculate summary stats
         summary_stats = summary_function(x)
 
+        return summary_stats, weights_benchmarks
+
+    def _make_weighted_histo_data(self, summary_function, thetas, n_toys, test_split=0.2, toy_data=None):
+        # Get weighted events and their summary stats
+        if toy_data is None:
+            toy_data = self._make_weighted_toy_data(summary_function, n_toys, test_split)
+        summary_stats, weights_benchmarks = toy_data
+
         # Calculate weights for thetas
         weights = self._weights(thetas, None, weights_benchmarks)
 
@@ -1113,16 +1640,83 @@ class AsymptoticLimits(DataAnalyzer):
             )
         return log_r
 
+    def _calculate_summed_log_likelihood_ratio_kinematics(
+        self, x_observed, obs_weights, theta_grid, model, theta1=None, x_batchsize=None, max_block_size=10 ** 7
+    ):
+        n_x, n_thetas = len(x_observed), len(theta_grid)
+        if x_batchsize is None or x_batchsize <= 0:
+            x_batchsize = n_x
+        n_batches = max((n_x - 1) // x_batchsize + 1, 1)
+
+        # The parameter points are split into chunks as well, so that at most max_block_size log r values are in
+        # memory at the same time
+        theta_batchsize = max(max_block_size // max(min(x_batchsize, n_x), 1), 1)
+        n_theta_batches = max((n_thetas - 1) // theta_batchsize + 1, 1)
+
+        log_r_sum = np.zeros(n_thetas, dtype=np.float64)
+        log_r_raw_sum = np.zeros(n_thetas, dtype=np.float64)
+        not_finite_events = np.zeros(n_x, dtype=np.bool_)
+
+        for i_batch in range(n_batches):
+            logger.debug("Evaluating kinematic log likelihood ratio for event batch %s / %s", i_batch + 1, n_batches)
+            x_batch = x_observed[i_batch * x_batchsize : (i_batch + 1) * x_batchsize]
+            weights_batch = obs_weights[i_batch * x_batchsize : (i_batch + 1) * x_batchsize]
+
+            for i_theta_batch in range(n_theta_batches):
+                theta_slice = slice(i_theta_batch * theta_batchsize, (i_theta_batch + 1) * theta_batchsize)
+                log_r_batch = self._calculate_log_likelihood_ratio_kinematics(
+                    x_batch, theta_grid[theta_slice], model, theta1
+                )
+                log_r_batch = log_r_batch.astype(np.float64)
+
+                # Only the inf / nan entries are zeroed here. The events are returned, so that the caller can remove
+                # them at all parameter points
+                not_finite = ~np.isfinite(log_r_batch)
+                not_finite_events[i_batch * x_batchsize : (i_batch + 1) * x_batchsize] |= np.any(not_finite, axis=0)
+                log_r_batch[not_finite] = 0.0
+
+                log_r_sum[theta_slice] += log_r_batch.dot(weights_batch)
+                log_r_raw_sum[theta_slice] += np.sum(log_r_batch, axis=1)
+
+        logger.debug("Raw mean -2 log r: %s", -2.0 * log_r_raw_sum / max(n_x, 1))
+
+        # Events with inf / nan results at any of the parameter points
+        return log_r_sum, np.flatnonzero(not_finite_events)
+
+    def _from_cache(self, key, function):
+        if self._cache is None or key is None:
+            return function()
+
+        key = _make_cache_key(key)
+        try:
+            value = self._cache[key]
+            logger.debug("Using cached %s", key[0])
+        except KeyError:
+            value = function()
+            self._cache[key] = value
+        return value
+
+    def _from_cache_per_theta(self, key, thetas, function):
+        """ Like _from_cache, but function(thetas) returns one result per parameter point, which is cached
+        separately """
+
+        if self._cache is None or key is None:
+            return function(thetas)
+
+        key = _make_cache_key(key)
+        theta_keys = [(key, _make_cache_key(theta)) for theta in thetas]
+        missing = [i for i, theta_key in enumerate(theta_keys) if theta_key not in self._cache]
+        logger.debug("Found %s of %s parameter points in cache", len(thetas) - len(missing), len(thetas))
+
+        if len(missing) > 0:
+            values = function(thetas[missing])
+            for i, value in zip(missing, values):
+                self._cache[theta_keys[i]] = value
+
+        return [self._cache[theta_key] for theta_key in theta_keys]
+
     @staticmethod
     def _subtract_mle(log_r):
         i_ml = np.argmax(log_r)
         log_r_subtracted = log_r[:] - log_r[i_ml]
         return log_r_subtracted, i_ml
-
-    @staticmethod
-    def _clean_nans(array):
-        not_finite = np.any(~np.isfinite(array), axis=0)
-        if np.sum(not_finite) > 0:
-            logger.warning("Removing %s inf / nan results from calculation")
-            array[:, not_finite] = 0.0
-        return array
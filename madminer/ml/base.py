@@ -6,7 +6,9 @@ import json
 import numpy as np
 import torch
 
-from ..utils.various import create_missing_folders, load_and_check
+from ..utils.various import create_missing_folders, load_and_check, is_out_of_core, mean_and_std, TransformedMemmap
+from ..utils.ml.models.compiled import compile_model
+from ..utils.ml.models.quantized import quantize_model
 
 try:
     FileNotFoundError
@@ -40,6 +42,9 @@ class Estimator(object):
         self.dropout_prob = dropout_prob
 
         self.model = None
+        self.compiled_model = None
+        self.quantized_model = None
+        self.quantization_deviation = None
         self.n_observables = None
         self.n_parameters = None
         self.x_scaling_means = None
@@ -75,7 +80,100 @@ class Estimator(object):
     def calculate_fisher_information(self, *args, **kwargs):
         raise NotImplementedError
 
-    def save(self, filename, save_model=False):
+    def quantize(self, x=None, theta=None, n_samples=1000, tolerance=0.01):
+
+        """
+        Quantizes the weights of the trained network to int8 for faster evaluation on CPUs (post-training dynamic
+        quantization, see `madminer.utils.ml.models.quantized.quantize_model()`). Only supported for ScoreEstimator
+        and ParameterizedRatioEstimator. The quantized network is used by the evaluation functions when no gradients
+        are requested, unless they are called with quantized=False. Training the estimator again discards it.
+
+        The outputs of the quantized and the original network are compared on a validation sample. If their mean
+        absolute difference, relative to the standard deviation of the original outputs, is larger than tolerance, the
+        quantized network is discarded and the estimator keeps evaluating the original one.
+
+        Parameters
+        ----------
+        x : ndarray or str or None, optional
+            Validation observations, or filename of a pickled numpy array. If None, n_samples points are drawn from a
+            standard normal distribution in the space of the rescaled observables. Default value: None.
+
+        theta : ndarray or str or None, optional
+            Validation parameter points for parameterized ratio estimators, or filename of a pickled numpy array. If
+            None, they are drawn from a standard normal distribution in the space of the rescaled parameters. Default
+            value: None.
+
+        n_samples : int, optional
+            Size of the validation sample if x is None. Default value: 1000.
+
+        tolerance : float, optional
+            Maximal accepted relative deviation of the quantized network. Default value: 0.01.
+
+        Returns
+        -------
+        deviation : float or None
+            Mean absolute difference between quantized and original network outputs, relative to the standard
+            deviation of the original outputs. None if the model type does not support quantization.
+
+        """
+
+        if self.model is None:
+            raise ValueError("No model -- train or load model before quantizing!")
+
+        self.quantized_model, self.quantization_deviation = None, None
+        quantized_model = quantize_model(self.model)
+        if quantized_model is None:
+            return None
+
+        # Accuracy check
+        x, theta = self._quantization_check_inputs(x, theta, n_samples)
+        outputs = self._evaluate_network(self.model, x, theta, run_on_gpu=False)
+        quantized_outputs = self._evaluate_network(quantized_model, x, theta, run_on_gpu=False)
+
+        scale = max(float(np.std(outputs)), 1.0e-12)
+        deviation = float(np.mean(np.abs(quantized_outputs - outputs))) / scale
+        max_deviation = float(np.max(np.abs(quantized_outputs - outputs))) / scale
+        self.quantization_deviation = deviation
+        logger.info(
+            "Quantized network deviates from original network by %.2e on average and by %.2e at most (relative to "
+            "the standard deviation of the outputs)",
+            deviation,
+            max_deviation,
+        )
+
+        if deviation > tolerance:
+            logger.warning(
+                "Deviation %.2e of quantized network is larger than tolerance %.2e, keeping the original network",
+                deviation,
+                tolerance,
+            )
+        else:
+            self.quantized_model = quantized_model
+
+        return deviation
+
+    def compile(self):
+
+        """
+        Compiles the trained model to TorchScript for faster inference. The compiled model is used by the evaluation
+        functions in single precision, except where gradients with respect to the observables are requested.
+        Training the estimator again discards the compiled model.
+
+        Returns
+        -------
+        compiled_model : torch.jit.ScriptModule or None
+            Compiled model, or None if the model type is not supported.
+
+        """
+
+        if self.model is None:
+            raise ValueError("No model -- train or load model before compiling!")
+
+        logger.info("Compiling model to TorchScript")
+        self.compiled_model = compile_model(self.model, self.n_observables, self.n_parameters)
+        return self.compiled_model
+
+    def save(self, filename, save_model=False, save_compiled=False):
 
         """
         Saves the trained model to four files: a JSON file with the settings, a pickled pyTorch state dict
@@ -90,6 +188,11 @@ class Estimator(object):
             If True, the whole model is saved in addition to the state dict. This is not necessary for loading it
             again with Estimator.load(), but can be useful for debugging, for instance to plot the computational graph.
 
+        save_compiled : bool, optional
+            If True, the model is compiled to TorchScript (see `Estimator.compile()`) and saved to '_compiled.pt'.
+            Estimator.load() picks this file up automatically. If False, an existing compiled model with the same
+            filename is deleted, so that it does not replace the model saved here when loading. Default value: False.
+
         Returns
         -------
             None
@@ -127,6 +230,15 @@ class Estimator(object):
             logger.debug("Saving model to %s_model.pt", filename)
             torch.save(self.model, filename + "_model.pt")
 
+        # Save compiled model, or remove a compiled model of a previous save, which load() would otherwise use
+        compiled_model = self.compile() if save_compiled else None
+        if compiled_model is not None:
+            logger.debug("Saving compiled model to %s_compiled.pt", filename)
+            torch.jit.save(compiled_model, filename + "_compiled.pt")
+        elif os.path.exists(filename + "_compiled.pt"):
+            logger.debug("Removing outdated compiled model %s_compiled.pt", filename)
+            os.remove(filename + "_compiled.pt")
+
     def load(self, filename):
 
         """
@@ -168,6 +280,12 @@ class Estimator(object):
         logger.debug("Loading state dictionary from %s_state_dict.pt", filename)
         self.model.load_state_dict(torch.load(filename + "_state_dict.pt", map_location="cpu"))
 
+        # Load compiled model
+        self.compiled_model = None
+        if os.path.exists(filename + "_compiled.pt"):
+            logger.debug("Loading compiled model from %s_compiled.pt", filename)
+            self.compiled_model = torch.jit.load(filename + "_compiled.pt", map_location="cpu")
+
     def initialize_input_transform(self, x, transform=True, overwrite=True):
         if self.x_scaling_stds is not None and self.x_scaling_means is not None and not overwrite:
             logger.info(
@@ -175,8 +293,8 @@ class Estimator(object):
             )
         elif transform:
             logger.info("Setting up input rescaling")
-            self.x_scaling_means = np.mean(x, axis=0)
-            self.x_scaling_stds = np.maximum(np.std(x, axis=0), 1.0e-6)
+            self.x_scaling_means, x_scaling_stds = mean_and_std(x, axis=0)
+            self.x_scaling_stds = np.maximum(x_scaling_stds, 1.0e-6)
         else:
             logger.info("Disabling input rescaling")
             n_parameters = x.shape[0]
@@ -186,7 +304,9 @@ class Estimator(object):
 
     def _transform_inputs(self, x):
         if self.x_scaling_means is not None and self.x_scaling_stds is not None:
-            if isinstance(x, torch.Tensor):
+            if is_out_of_core(x):
+                x_scaled = TransformedMemmap(x, self._transform_inputs)
+            elif isinstance(x, torch.Tensor):
                 x_scaled = x - torch.tensor(self.x_scaling_means, dtype=x.dtype, device=x.device)
                 x_scaled = x_scaled / torch.tensor(self.x_scaling_stds, dtype=x.dtype, device=x.device)
             else:
@@ -239,6 +359,29 @@ class Estimator(object):
     def _create_model(self):
         raise NotImplementedError
 
+    def _evaluate_network(self, model, x, theta=None, run_on_gpu=True):
+        """ Evaluates the network output for rescaled inputs, used to validate quantized networks """
+        raise NotImplementedError
+
+    def _select_quantized_model(self, quantized):
+        """ Returns the quantized model if it is to be used for evaluation: for quantized=True (quantizing the network
+        first if that has not been tried yet), never for quantized=False, and whenever available for quantized=None """
+
+        if quantized and self.quantized_model is None and self.quantization_deviation is None:
+            self.quantize()
+        if quantized is None or quantized:
+            return self.quantized_model
+        return None
+
+    def _quantization_check_inputs(self, x, theta, n_samples):
+        if x is None:
+            x = np.random.normal(size=(n_samples, self.n_observables))
+        else:
+            x = self._transform_inputs(load_and_check(x))
+            if self.features is not None:
+                x = x[:, self.features]
+        return x, None
+
     def calculate_fisher_information(self, x, theta=None, weights=None, n_events=1, sum_events=True):
         """
         Calculates the expected Fisher information matrix based on the kinematic information in a given number of
@@ -316,7 +459,7 @@ class ConditionalEstimator(Estimator):
         self.theta_scaling_means = None
         self.theta_scaling_stds = None
 
-    def save(self, filename, save_model=False):
+    def save(self, filename, save_model=False, save_compiled=False):
 
         """
         Saves the trained model to four files: a JSON file with the settings, a pickled pyTorch state dict
@@ -331,13 +474,18 @@ class ConditionalEstimator(Estimator):
             If True, the whole model is saved in addition to the state dict. This is not necessary for loading it
             again with Estimator.load(), but can be useful for debugging, for instance to plot the computational graph.
 
+        save_compiled : bool, optional
+            If True, the model is compiled to TorchScript (see `Estimator.compile()`) and saved to '_compiled.pt'.
+            Estimator.load() picks this file up automatically. If False, an existing compiled model with the same
+            filename is deleted, so that it does not replace the model saved here when loading. Default value: False.
+
         Returns
         -------
             None
 
         """
 
-        super(ConditionalEstimator, self).save(filename, save_model)
+        super(ConditionalEstimator, self).save(filename, save_model, save_compiled)
 
         # Save param scaling
         if self.theta_scaling_stds is not None and self.theta_scaling_means is not None:
@@ -386,8 +534,8 @@ class ConditionalEstimator(Estimator):
             )
         elif transform:
             logger.info("Setting up parameter rescaling")
-            self.theta_scaling_means = np.mean(theta, axis=0)
-            self.theta_scaling_stds = np.maximum(np.std(theta, axis=0), 1.0e-6)
+            self.theta_scaling_means, theta_scaling_stds = mean_and_std(theta, axis=0)
+            self.theta_scaling_stds = np.maximum(theta_scaling_stds, 1.0e-6)
         else:
             logger.info("Disabling parameter rescaling")
             self.theta_scaling_means = None
@@ -395,7 +543,9 @@ class ConditionalEstimator(Estimator):
 
     def _transform_parameters(self, theta):
         if self.theta_scaling_means is not None and self.theta_scaling_stds is not None:
-            if isinstance(theta, torch.Tensor):
+            if is_out_of_core(theta):
+                theta_scaled = TransformedMemmap(theta, self._transform_parameters)
+            elif isinstance(theta, torch.Tensor):
                 theta_scaled = theta - torch.tensor(self.theta_scaling_means, dtype=theta.dtype, device=theta.device)
                 theta_scaled = theta_scaled / torch.tensor(
                     self.theta_scaling_stds, dtype=theta.dtype, device=theta.device
@@ -407,9 +557,19 @@ class ConditionalEstimator(Estimator):
             theta_scaled = theta
         return theta_scaled
 
+    def _quantization_check_inputs(self, x, theta, n_samples):
+        x, _ = super(ConditionalEstimator, self)._quantization_check_inputs(x, None, n_samples)
+        if theta is None:
+            theta = np.random.normal(size=(len(x), self.n_parameters))
+        else:
+            theta = self._transform_parameters(load_and_check(theta))
+        return x, theta
+
     def _transform_score(self, t_xz, inverse=False):
         if self.theta_scaling_means is not None and self.theta_scaling_stds is not None and t_xz is not None:
-            if inverse:
+            if is_out_of_core(t_xz):
+                t_xz_scaled = TransformedMemmap(t_xz, lambda t: self._transform_score(t, inverse=inverse))
+            elif inverse:
                 t_xz_scaled = t_xz / self.theta_scaling_stds[np.newaxis, :]
             else:
                 t_xz_scaled = t_xz * self.theta_scaling_stds[np.newaxis, :]
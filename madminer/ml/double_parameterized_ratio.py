@@ -72,9 +72,14 @@ class DoubleParameterizedRatioEstimator(ConditionalEstimator):
         memmap=False,
         verbose="some",
         scale_parameters=True,
-        n_workers=8,
+        n_workers=None,
         clip_gradient=None,
         early_stopping_patience=None,
+        checkpoint_path=None,
+        checkpoint_every=1,
+        resume_from=None,
+        callbacks=None,
+        return_profile=False,
     ):
 
         """
@@ -190,6 +195,31 @@ class DoubleParameterizedRatioEstimator(ConditionalEstimator):
         verbose : {"all", "many", "some", "few", "none}, optional
             Determines verbosity of training. Default value: "some".
 
+        n_workers : None, optional
+            Deprecated and ignored. Training batches are now drawn directly from the (block-shuffled) training data
+            instead of through a multi-process torch DataLoader. Default value: None.
+
+        checkpoint_path : str or None, optional
+            If not None, the model, optimizer, learning rate schedule, early stopping, and random number generator
+            state are saved to this file during training, such that an interrupted training can be continued with
+            resume_from. Default value: None.
+
+        checkpoint_every : int, optional
+            Number of epochs between checkpoints. Default value: 1.
+
+        resume_from : str or None, optional
+            Checkpoint file written with checkpoint_path in an earlier call with the same training data and settings.
+            If not None, the training continues after the last epoch stored in this file. Default value: None.
+
+        callbacks : list of TrainingCallback or None, optional
+            Callbacks that are called after every minibatch and every epoch, see
+            `madminer.utils.ml.trainer.TrainingCallback`. Default value: None.
+
+        return_profile : bool, optional
+            If True, a training profile is returned in addition to the losses. It contains the accumulated time spent
+            in each section of the training loop, the peak memory usage, and for every epoch the throughput in samples
+            per second and the fraction of time spent waiting for data. Default value: False.
+
         Returns
         -------
             None
@@ -330,6 +360,8 @@ class DoubleParameterizedRatioEstimator(ConditionalEstimator):
         if self.model is None:
             logger.info("Creating model")
             self._create_model()
+        self.compiled_model = None
+        self.quantized_model, self.quantization_deviation = None, None
 
         # Losses
         loss_functions, loss_labels, loss_weights = get_loss(method + "2", alpha)
@@ -357,6 +389,11 @@ class DoubleParameterizedRatioEstimator(ConditionalEstimator):
             verbose=verbose,
             clip_gradient=clip_gradient,
             early_stopping_patience=early_stopping_patience,
+            checkpoint_path=checkpoint_path,
+            checkpoint_every=checkpoint_every,
+            resume_from=resume_from,
+            callbacks=callbacks,
+            return_profile=return_profile,
         )
         return result
 
@@ -446,6 +483,7 @@ class DoubleParameterizedRatioEstimator(ConditionalEstimator):
                     theta1s=[this_theta1],
                     xs=x,
                     evaluate_score=evaluate_score,
+                    compiled_model=self.compiled_model,
                 )
 
                 all_log_r_hat.append(log_r_hat)
@@ -465,6 +503,7 @@ class DoubleParameterizedRatioEstimator(ConditionalEstimator):
                 theta1s=theta1,
                 xs=x,
                 evaluate_score=evaluate_score,
+                compiled_model=self.compiled_model,
             )
 
         logger.debug("Evaluation done")
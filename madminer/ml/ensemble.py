@@ -3,9 +3,13 @@ from __future__ import absolute_import, division, print_function
 import six
 import logging
 import json
+import multiprocessing
+import os
 import numpy as np
+import torch
 
-from madminer.utils.various import create_missing_folders, load_and_check
+from madminer.utils.various import create_missing_folders, load_and_check, get_fork_context
+from madminer.utils.ml.models.stacked import StackedDenseModel
 from .base import Estimator
 from .double_parameterized_ratio import DoubleParameterizedRatioEstimator
 from .likelihood import LikelihoodEstimator
@@ -20,6 +24,32 @@ except NameError:
 
 logger = logging.getLogger(__name__)
 
+# Estimators and training arguments that forked worker processes use, see Ensemble.train_all
+_shared_training_setup = None
+
+
+def _initialize_training_worker(n_threads):
+    # Limit intra-op parallelism, so that the workers do not compete for cores
+    torch.set_num_threads(n_threads)
+
+
+def _train_estimator_in_worker(args):
+    i, seed = args
+    estimators, kwargs = _shared_training_setup
+    estimator = estimators[i]
+
+    # Forked workers inherit the random state of the main process, so each estimator gets its own seed
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    logger.info("Training estimator %s / %s in ensemble (process %s)", i + 1, len(estimators), os.getpid())
+    estimator.train(**kwargs[i])
+
+    # Only the state dict and the other attributes (scaling, dimensions) are sent back
+    attributes = {key: value for key, value in six.iteritems(estimator.__dict__) if key != "model"}
+    state_dict = {key: value.cpu() for key, value in six.iteritems(estimator.model.state_dict())}
+    return attributes, state_dict
+
 
 class Ensemble:
     """
@@ -56,16 +86,26 @@ class Ensemble:
         'alices2'). Mixing estimators of different types within one of these three categories is supported, but mixing
         estimators from different categories is not and will raise a RuntimeException. Default value: None.
 
+    stacked_evaluation : bool, optional
+        If True, ensembles of ScoreEstimator or ParameterizedRatioEstimator instances with the same dense architecture
+        (and no dropout) are evaluated in a single pass: the weights of all estimators are stacked, each layer is one
+        batched matrix multiplication, and the input rescaling of each estimator is absorbed into its first layer, so
+        that x is loaded and transformed only once. This is used by `evaluate_score()`,
+        `evaluate_log_likelihood_ratio()`, and `calculate_fisher_information()` and runs on the GPU if one is
+        available. Ensembles that cannot be stacked, and evaluations with options the stacked model does not
+        support (such as quantized networks), are evaluated estimator by estimator. Default value: False.
+
     Attributes
     ----------
     estimators : list of Estimator
         The estimators in the form of MLForge instances.
     """
 
-    def __init__(self, estimators=None):
+    def __init__(self, estimators=None, stacked_evaluation=False):
         self.n_parameters = None
         self.n_observables = None
         self.estimator_type = None
+        self.stacked_evaluation = stacked_evaluation
 
         # Initialize estimators
         if estimators is None:
@@ -122,12 +162,17 @@ class Ensemble:
 
         self.estimators[i].train(**kwargs)
 
-    def train_all(self, **kwargs):
+    def train_all(self, n_processes=1, **kwargs):
         """
         Trains all estimators. See `Estimator.train()`.
 
         Parameters
         ----------
+        n_processes : None or int, optional
+            If None or larger than 1, the estimators are trained in parallel in this number of worker processes (None
+            uses the number of CPUs). The CPU threads used by PyTorch are divided between the workers. Training data
+            given as filenames is loaded once before the workers are forked and shared between them. Default value: 1.
+
         kwargs : dict
             Parameters for `Estimator.train()`. If a value in this dict is a list, it has to have length `n_estimators`
             and contain one value of this parameter for each of the estimators. Otherwise the value is used as parameter
@@ -146,14 +191,73 @@ class Ensemble:
 
             assert len(kwargs[key]) == self.n_estimators, "Keyword {} has wrong length {}".format(key, len(value))
 
-        for i, estimator in enumerate(self.estimators):
+        all_kwargs = []
+        for i in range(self.n_estimators):
             kwargs_this_estimator = {}
             for key, value in six.iteritems(kwargs):
                 kwargs_this_estimator[key] = value[i]
+            all_kwargs.append(kwargs_this_estimator)
 
+        if n_processes is None:
+            n_processes = multiprocessing.cpu_count()
+        n_processes = min(n_processes, self.n_estimators)
+
+        if n_processes > 1:
+            self._train_all_parallel(all_kwargs, n_processes)
+            return
+
+        for i, (estimator, kwargs_this_estimator) in enumerate(zip(self.estimators, all_kwargs)):
             logger.info("Training estimator %s / %s in ensemble", i + 1, self.n_estimators)
             estimator.train(**kwargs_this_estimator)
 
+    def _train_all_parallel(self, all_kwargs, n_processes):
+        global _shared_training_setup
+
+        n_threads = max(1, multiprocessing.cpu_count() // n_processes)
+        logger.info("Training in %s processes with %s threads each", n_processes, n_threads)
+
+        # Load data files once, the forked workers then share the arrays
+        all_kwargs = self._load_training_data(all_kwargs)
+
+        _shared_training_setup = (self.estimators, all_kwargs)
+        context = get_fork_context()
+        pool = context.Pool(processes=n_processes, initializer=_initialize_training_worker, initargs=(n_threads,))
+
+        try:
+            seeds = np.random.randint(0, 2 ** 31 - 1, size=self.n_estimators)
+            results = pool.map(_train_estimator_in_worker, list(zip(range(self.n_estimators), seeds)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _shared_training_setup = None
+
+        # Update estimators with the trained weights
+        for estimator, (attributes, state_dict) in zip(self.estimators, results):
+            estimator.__dict__.update(attributes)
+            if estimator.model is None:
+                estimator._create_model()
+            estimator.model.load_state_dict(state_dict)
+
+    @staticmethod
+    def _load_training_data(all_kwargs):
+        loaded = {}
+        all_kwargs_loaded = []
+
+        for kwargs in all_kwargs:
+            memmap_threshold = 1.0 if kwargs.get("memmap", False) else None
+            kwargs_loaded = {}
+            for key, value in six.iteritems(kwargs):
+                if isinstance(value, six.string_types) and value.endswith(".npy") and os.path.isfile(value):
+                    if (value, memmap_threshold) not in loaded:
+                        loaded[(value, memmap_threshold)] = load_and_check(
+                            value, memmap_files_larger_than_gb=memmap_threshold
+                        )
+                    value = loaded[(value, memmap_threshold)]
+                kwargs_loaded[key] = value
+            all_kwargs_loaded.append(kwargs_loaded)
+
+        return all_kwargs_loaded
+
     def evaluate_log_likelihood(self, estimator_weights=None, calculate_covariance=False, **kwargs):
         """
         Estimates the log likelihood from each estimator and returns the ensemble mean (and, if calculate_covariance is
@@ -244,11 +348,13 @@ class Ensemble:
         logger.debug("Estimator weights: %s", estimator_weights)
 
         # Calculate estimator predictions
-        predictions = []
-        for i, estimator in enumerate(self.estimators):
-            logger.debug("Starting evaluation for estimator %s / %s in ensemble", i + 1, self.n_estimators)
-            predictions.append(estimator.evaluate_log_likelihood_ratio(**kwargs)[0])
-        predictions = np.array(predictions)
+        predictions = self._evaluate_stacked_log_likelihood_ratio(**kwargs)
+        if predictions is None:
+            predictions = []
+            for i, estimator in enumerate(self.estimators):
+                logger.debug("Starting evaluation for estimator %s / %s in ensemble", i + 1, self.n_estimators)
+                predictions.append(estimator.evaluate_log_likelihood_ratio(**kwargs)[0])
+            predictions = np.array(predictions)
 
         # Calculate weighted means and covariance matrices
         mean = np.average(predictions, axis=0, weights=estimator_weights)
@@ -298,11 +404,13 @@ class Ensemble:
         logger.debug("Estimator weights: %s", estimator_weights)
 
         # Calculate estimator predictions
-        predictions = []
-        for i, estimator in enumerate(self.estimators):
-            logger.info("Starting evaluation for estimator %s / %s in ensemble", i + 1, self.n_estimators)
-            predictions.append(estimator.evaluate_score(**kwargs))
-        predictions = np.array(predictions)
+        predictions = self._evaluate_stacked_score(**kwargs)
+        if predictions is None:
+            predictions = []
+            for i, estimator in enumerate(self.estimators):
+                logger.info("Starting evaluation for estimator %s / %s in ensemble", i + 1, self.n_estimators)
+                predictions.append(estimator.evaluate_score(**kwargs))
+            predictions = np.array(predictions)
 
         # Calculate weighted means and covariance matrices
         mean = np.average(predictions, axis=0, weights=estimator_weights)
@@ -453,13 +561,17 @@ class Ensemble:
             n_samples = x.shape[0]
 
             # Calculate score predictions
-            score_predictions = []
-            for i, estimator in enumerate(self.estimators):
-                logger.debug("Starting evaluation for estimator %s / %s in ensemble", i + 1, self.n_estimators)
-
-                score_predictions.append(estimator.evaluate_score(x=x, theta=np.array([theta for _ in x])))
-                logger.debug("Estimator %s predicts t(x) = %s for first event", i + 1, score_predictions[-1][0, :])
-            score_predictions = np.array(score_predictions)  # (n_estimators, n_events, n_parameters)
+            score_predictions = self._evaluate_stacked_score(x=x, theta=np.array([theta for _ in x]))
+            if score_predictions is None:
+                score_predictions = []
+                for i, estimator in enumerate(self.estimators):
+                    logger.debug("Starting evaluation for estimator %s / %s in ensemble", i + 1, self.n_estimators)
+
+                    score_predictions.append(estimator.evaluate_score(x=x, theta=np.array([theta for _ in x])))
+                    logger.debug(
+                        "Estimator %s predicts t(x) = %s for first event", i + 1, score_predictions[-1][0, :]
+                    )
+                score_predictions = np.array(score_predictions)  # (n_estimators, n_events, n_parameters)
 
             # Get ensemble mean and ensemble covariance
             score_mean = np.mean(score_predictions, axis=0)  # (n_events, n_parameters)
@@ -516,13 +628,17 @@ class Ensemble:
             n_samples = x.shape[0]
 
             # Calculate score predictions
-            score_predictions = []
-            for i, estimator in enumerate(self.estimators):
-                logger.debug("Starting evaluation for estimator %s / %s in ensemble", i + 1, self.n_estimators)
-
-                score_predictions.append(estimator.evaluate_score(x=x, theta=np.array([theta for _ in x])))
-                logger.debug("Estimator %s predicts t(x) = %s for first event", i + 1, score_predictions[-1][0, :])
-            score_predictions = np.array(score_predictions)  # (n_estimators, n_events, n_parameters)
+            score_predictions = self._evaluate_stacked_score(x=x, theta=np.array([theta for _ in x]))
+            if score_predictions is None:
+                score_predictions = []
+                for i, estimator in enumerate(self.estimators):
+                    logger.debug("Starting evaluation for estimator %s / %s in ensemble", i + 1, self.n_estimators)
+
+                    score_predictions.append(estimator.evaluate_score(x=x, theta=np.array([theta for _ in x])))
+                    logger.debug(
+                        "Estimator %s predicts t(x) = %s for first event", i + 1, score_predictions[-1][0, :]
+                    )
+                score_predictions = np.array(score_predictions)  # (n_estimators, n_events, n_parameters)
 
             # Get ensemble mean and ensemble covariance
             score_mean = np.mean(score_predictions, axis=0)  # (n_events, n_parameters)
@@ -577,7 +693,7 @@ class Ensemble:
 
         return information, covariance
 
-    def save(self, folder, save_model=False):
+    def save(self, folder, save_model=False, save_compiled=False):
         """
         Saves the estimator ensemble to a folder.
 
@@ -591,6 +707,10 @@ class Ensemble:
             again with Ensemble.load(), but can be useful for debugging, for instance to plot the computational
             graph.
 
+        save_compiled : bool, optional
+            If True, each estimator is also saved as a compiled TorchScript model, see `Estimator.save()`. Default
+            value: False.
+
         Returns
         -------
             None
@@ -609,7 +729,7 @@ class Ensemble:
 
         # Save estimators
         for i, estimator in enumerate(self.estimators):
-            estimator.save(folder + "/estimator_" + str(i), save_model=save_model)
+            estimator.save(folder + "/estimator_" + str(i), save_model=save_model, save_compiled=save_compiled)
 
     def load(self, folder):
         """
@@ -698,6 +818,116 @@ class Ensemble:
                     "Ensemble with inconsistent numbers of parameters for different estimators: %s", all_n_observables
                 )
 
+    def _make_stacked_model(self):
+        if not self.stacked_evaluation or self.estimator_type not in ["score", "parameterized_ratio"]:
+            return None, None
+        if any([estimator.model is None for estimator in self.estimators]):
+            return None, None
+
+        model = StackedDenseModel.from_estimators(self.estimators)
+        if model is None:
+            logger.debug("Estimators cannot be stacked, evaluating them one by one")
+            return None, None
+
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        return model.to(device), device
+
+    def _uses_quantized_models(self, quantized):
+        """ Whether the estimators would evaluate their quantized networks, which the stacked model does not use """
+
+        if quantized is None:
+            return any([estimator.quantized_model is not None for estimator in self.estimators])
+        return bool(quantized)
+
+    def _evaluate_stacked_score(self, x, theta=None, nuisance_mode="auto", batch_size=100000, quantized=None, **kwargs):
+        """ Scores of all estimators from one stacked forward pass, or None if the estimators cannot be stacked or the
+        options cannot be honoured by the stacked model """
+
+        if kwargs or self._uses_quantized_models(quantized):
+            return None
+        if self.estimator_type == "score":
+            nuisance_modes = [
+                estimator.nuisance_mode_default if nuisance_mode == "auto" else nuisance_mode
+                for estimator in self.estimators
+            ]
+            if any([mode != "keep" for mode in nuisance_modes]):
+                return None
+        elif nuisance_mode not in ["auto", "keep"]:
+            return None
+
+        model, device = self._make_stacked_model()
+        if model is None:
+            return None
+        logger.debug("Evaluating %s estimators in one stacked pass", self.n_estimators)
+
+        x = load_and_check(x)
+        if self.estimator_type != "score":
+            theta = load_and_check(theta)
+        predictions = []
+        for start in range(0, len(x), batch_size):
+            x_batch = torch.tensor(x[start : start + batch_size], dtype=torch.float, device=device)
+
+            if self.estimator_type == "score":
+                with torch.no_grad():
+                    t_hat = model(x_batch)
+            else:
+                theta_batch = torch.tensor(
+                    theta[np.arange(start, start + len(x_batch)) % len(theta)], dtype=torch.float, device=device
+                )
+                _, t_hat = model.forward_with_score(theta_batch, x_batch)
+
+            predictions.append(t_hat.detach().cpu().numpy())
+
+        return np.concatenate(predictions, axis=1)
+
+    def _evaluate_stacked_log_likelihood_ratio(
+        self, x, theta, test_all_combinations=True, evaluate_score=False, batch_size=100000, quantized=None, **kwargs
+    ):
+        """ Log likelihood ratios of all estimators from one stacked forward pass, or None if the estimators cannot
+        be stacked or the options cannot be honoured by the stacked model """
+
+        if kwargs or self._uses_quantized_models(quantized):
+            return None
+        if self.estimator_type != "parameterized_ratio":
+            return None
+        model, device = self._make_stacked_model()
+        if model is None:
+            return None
+        logger.debug("Evaluating %s estimators in one stacked pass", self.n_estimators)
+
+        x = load_and_check(x)
+        theta = load_and_check(theta)
+
+        if not test_all_combinations:
+            predictions = []
+            for start in range(0, len(x), batch_size):
+                x_batch = torch.tensor(x[start : start + batch_size], dtype=torch.float, device=device)
+                theta_batch = torch.tensor(
+                    theta[np.arange(start, start + len(x_batch)) % len(theta)], dtype=torch.float, device=device
+                )
+                with torch.no_grad():
+                    log_r_hat = model(torch.cat((theta_batch, x_batch), 1))[:, :, 0]
+                predictions.append(log_r_hat.cpu().numpy())
+            return np.concatenate(predictions, axis=1)
+
+        # Grid of thetas and xs, in chunks of at most batch_size network evaluations
+        batch_size = max(1, batch_size // self.n_estimators)
+        x_batch_size = max(1, min(len(x), batch_size))
+        theta_batch_size = max(1, batch_size // x_batch_size)
+        predictions = np.empty((self.n_estimators, len(theta), len(x)), dtype=np.float32)
+        for x_start in range(0, len(x), x_batch_size):
+            x_batch = torch.tensor(x[x_start : x_start + x_batch_size], dtype=torch.float, device=device)
+            for theta_start in range(0, len(theta), theta_batch_size):
+                theta_batch = torch.tensor(
+                    theta[theta_start : theta_start + theta_batch_size], dtype=torch.float, device=device
+                )
+                with torch.no_grad():
+                    log_r_hat, _ = model.forward_grid(theta_batch, x_batch)
+                predictions[
+                    :, theta_start : theta_start + len(theta_batch), x_start : x_start + len(x_batch)
+                ] = log_r_hat.cpu().numpy()
+        return predictions
+
     @staticmethod
     def _get_estimator_type(estimator):
         if not isinstance(estimator, Estimator):
@@ -83,9 +83,14 @@ class LikelihoodEstimator(ConditionalEstimator):
         memmap=False,
         verbose="some",
         scale_parameters=True,
-        n_workers=8,
+        n_workers=None,
         clip_gradient=None,
         early_stopping_patience=None,
+        checkpoint_path=None,
+        checkpoint_every=1,
+        resume_from=None,
+        callbacks=None,
+        return_profile=False,
     ):
 
         """
@@ -168,10 +173,35 @@ class LikelihoodEstimator(ConditionalEstimator):
         verbose : {"all", "many", "some", "few", "none}, optional
             Determines verbosity of training. Default value: "some".
 
+        n_workers : None, optional
+            Deprecated and ignored. Training batches are now drawn directly from the (block-shuffled) training data
+            instead of through a multi-process torch DataLoader. Default value: None.
+
         scale_parameters : bool, optional
             Whether parameters are rescaled to mean zero and unit variance before going into the neural network.
             Default value: True.
 
+        checkpoint_path : str or None, optional
+            If not None, the model, optimizer, learning rate schedule, early stopping, and random number generator
+            state are saved to this file during training, such that an interrupted training can be continued with
+            resume_from. Default value: None.
+
+        checkpoint_every : int, optional
+            Number of epochs between checkpoints. Default value: 1.
+
+        resume_from : str or None, optional
+            Checkpoint file written with checkpoint_path in an earlier call with the same training data and settings.
+            If not None, the training continues after the last epoch stored in this file. Default value: None.
+
+        callbacks : list of TrainingCallback or None, optional
+            Callbacks that are called after every minibatch and every epoch, see
+            `madminer.utils.ml.trainer.TrainingCallback`. Default value: None.
+
+        return_profile : bool, optional
+            If True, a training profile is returned in addition to the losses. It contains the accumulated time spent
+            in each section of the training loop, the peak memory usage, and for every epoch the throughput in samples
+            per second and the fraction of time spent waiting for data. Default value: False.
+
         Returns
         -------
             None
@@ -289,6 +319,8 @@ class LikelihoodEstimator(ConditionalEstimator):
         # Create model
         if self.model is None:
             self._create_model()
+        self.compiled_model = None
+        self.quantized_model, self.quantization_deviation = None, None
 
         # Losses
         loss_functions, loss_labels, loss_weights = get_loss(method, alpha)
@@ -316,6 +348,11 @@ class LikelihoodEstimator(ConditionalEstimator):
             verbose=verbose,
             clip_gradient=clip_gradient,
             early_stopping_patience=early_stopping_patience,
+            checkpoint_path=checkpoint_path,
+            checkpoint_every=checkpoint_every,
+            resume_from=resume_from,
+            callbacks=callbacks,
+            return_profile=return_profile,
         )
         return result
 
@@ -384,7 +421,11 @@ class LikelihoodEstimator(ConditionalEstimator):
                 logger.debug("Starting log likelihood evaluation for thetas %s / %s: %s", i + 1, len(theta), this_theta)
 
                 log_p_hat, t_hat = evaluate_flow_model(
-                    model=self.model, thetas=[this_theta], xs=x, evaluate_score=evaluate_score
+                    model=self.model,
+                    thetas=[this_theta],
+                    xs=x,
+                    evaluate_score=evaluate_score,
+                    compiled_model=self.compiled_model,
                 )
 
                 all_log_p_hat.append(log_p_hat)
@@ -397,7 +438,7 @@ class LikelihoodEstimator(ConditionalEstimator):
             logger.debug("Starting log likelihood evaluation")
 
             all_log_p_hat, all_t_hat = evaluate_flow_model(
-                model=self.model, thetas=theta, xs=x, evaluate_score=evaluate_score
+                model=self.model, thetas=theta, xs=x, evaluate_score=evaluate_score, compiled_model=self.compiled_model
             )
 
         logger.debug("Evaluation done")
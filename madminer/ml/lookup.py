@@ -10,10 +10,32 @@ from .parameterized_ratio import ParameterizedRatioEstimator
 from .score import ScoreEstimator
 
 
-def load_estimator(filename):
+def load_estimator(filename, quantize=False):
+    """
+    Loads a trained estimator or ensemble, inferring its type from the saved settings.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the estimator files (see `Estimator.save()`) or to an ensemble folder (see `Ensemble.save()`).
+
+    quantize : bool, optional
+        If True, the networks are quantized to int8 for faster evaluation on CPUs after loading, see
+        `Estimator.quantize()`. Only supported for score and parameterized ratio estimators. Default value: False.
+
+    Returns
+    -------
+    estimator : Estimator or Ensemble
+        The loaded estimator.
+
+    """
+
     if os.path.isdir(filename):
         model = Ensemble()
         model.load(filename)
+        if quantize:
+            for estimator in model.estimators:
+                estimator.quantize()
 
     else:
         with open(filename + "_settings.json", "r") as f:
@@ -35,5 +57,7 @@ def load_estimator(filename):
             raise RuntimeError("Unknown estimator type {}!".format(estimator_type))
 
         model.load(filename)
+        if quantize:
+            model.quantize()
 
     return model
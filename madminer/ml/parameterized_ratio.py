@@ -6,7 +6,7 @@ from collections import OrderedDict
 import torch
 
 from ..utils.ml.models.ratio import DenseSingleParameterizedRatioModel
-from ..utils.ml.eval import evaluate_ratio_model
+from ..utils.ml.eval import evaluate_ratio_model, evaluate_ratio_model_grid
 from ..utils.ml.utils import get_optimizer, get_loss
 from ..utils.various import load_and_check, shuffle, restrict_samplesize
 from ..utils.ml.trainer import SingleParameterizedRatioTrainer
@@ -70,9 +70,14 @@ class ParameterizedRatioEstimator(ConditionalEstimator):
         memmap=False,
         verbose="some",
         scale_parameters=True,
-        n_workers=8,
+        n_workers=None,
         clip_gradient=None,
         early_stopping_patience=None,
+        checkpoint_path=None,
+        checkpoint_every=1,
+        resume_from=None,
+        callbacks=None,
+        return_profile=False,
     ):
 
         """
@@ -172,10 +177,35 @@ class ParameterizedRatioEstimator(ConditionalEstimator):
         verbose : {"all", "many", "some", "few", "none}, optional
             Determines verbosity of training. Default value: "some".
 
+        n_workers : None, optional
+            Deprecated and ignored. Training batches are now drawn directly from the (block-shuffled) training data
+            instead of through a multi-process torch DataLoader. Default value: None.
+
         scale_parameters : bool, optional
             Whether parameters are rescaled to mean zero and unit variance before going into the neural network.
             Default value: True.
 
+        checkpoint_path : str or None, optional
+            If not None, the model, optimizer, learning rate schedule, early stopping, and random number generator
+            state are saved to this file during training, such that an interrupted training can be continued with
+            resume_from. Default value: None.
+
+        checkpoint_every : int, optional
+            Number of epochs between checkpoints. Default value: 1.
+
+        resume_from : str or None, optional
+            Checkpoint file written with checkpoint_path in an earlier call with the same training data and settings.
+            If not None, the training continues after the last epoch stored in this file. Default value: None.
+
+        callbacks : list of TrainingCallback or None, optional
+            Callbacks that are called after every minibatch and every epoch, see
+            `madminer.utils.ml.trainer.TrainingCallback`. Default value: None.
+
+        return_profile : bool, optional
+            If True, a training profile is returned in addition to the losses. It contains the accumulated time spent
+            in each section of the training loop, the peak memory usage, and for every epoch the throughput in samples
+            per second and the fraction of time spent waiting for data. Default value: False.
+
         Returns
         -------
         results: ndarray
@@ -302,6 +332,8 @@ class ParameterizedRatioEstimator(ConditionalEstimator):
         if self.model is None:
             logger.info("Creating model")
             self._create_model()
+        self.compiled_model = None
+        self.quantized_model, self.quantization_deviation = None, None
 
         # Losses
         loss_functions, loss_labels, loss_weights = get_loss(method, alpha)
@@ -329,10 +361,17 @@ class ParameterizedRatioEstimator(ConditionalEstimator):
             verbose=verbose,
             clip_gradient=clip_gradient,
             early_stopping_patience=early_stopping_patience,
+            checkpoint_path=checkpoint_path,
+            checkpoint_every=checkpoint_every,
+            resume_from=resume_from,
+            callbacks=callbacks,
+            return_profile=return_profile,
         )
         return result
 
-    def evaluate_log_likelihood_ratio(self, x, theta, test_all_combinations=True, evaluate_score=False):
+    def evaluate_log_likelihood_ratio(
+        self, x, theta, test_all_combinations=True, evaluate_score=False, batch_size=100000, quantized=None
+    ):
         """
         Evaluates the log likelihood ratio for given observations x betwen the given parameter point theta and the
         reference hypothesis.
@@ -354,6 +393,16 @@ class ParameterizedRatioEstimator(ConditionalEstimator):
         evaluate_score : bool, optional
             Sets whether in addition to the likelihood ratio the score is evaluated. Default value: False.
 
+        batch_size : int, optional
+            Maximal number of x-theta combinations that are passed through the network at once when
+            test_all_combinations is True. Default value: 100000.
+
+        quantized : bool or None, optional
+            If True, the int8-quantized network is evaluated (see `Estimator.quantize()`, which is called first if
+            necessary). If False, the original network is evaluated. If None, the quantized network is used if the
+            estimator has one. The quantized network does not support gradients, so with evaluate_score=True the
+            original network is always used. Default value: None.
+
         Returns
         -------
         log_likelihood_ratio : ndarray
@@ -385,18 +434,44 @@ class ParameterizedRatioEstimator(ConditionalEstimator):
         all_log_r_hat = []
         all_t_hat = []
 
-        if test_all_combinations:
+        # The quantized network runs on the CPU and without gradients
+        quantized_model = None
+        if not evaluate_score:
+            quantized_model = self._select_quantized_model(quantized)
+        elif quantized:
+            logger.info("Quantized network does not support score evaluation, using original network")
+        model = self.model if quantized_model is None else quantized_model
+        compiled_model = self.compiled_model if quantized_model is None else None
+        run_on_gpu = quantized_model is None
+
+        if test_all_combinations and isinstance(self.model, DenseSingleParameterizedRatioModel):
+            logger.debug("Starting ratio evaluation for %s x-theta combinations", len(theta) * len(x))
+
+            # The x part of the first layer is calculated once and shared between all thetas
+            all_log_r_hat, all_t_hat = evaluate_ratio_model_grid(
+                model=model,
+                thetas=theta,
+                xs=x,
+                evaluate_score=evaluate_score,
+                run_on_gpu=run_on_gpu,
+                batch_size=batch_size,
+            )
+            all_t_hat = self._transform_score(all_t_hat, inverse=True)
+
+        elif test_all_combinations:
             logger.debug("Starting ratio evaluation for %s x-theta combinations", len(theta) * len(x))
 
             for i, this_theta in enumerate(theta):
                 logger.debug("Starting ratio evaluation for thetas %s / %s: %s", i + 1, len(theta), this_theta)
                 _, log_r_hat, t_hat, _ = evaluate_ratio_model(
-                    model=self.model,
+                    model=model,
                     method_type="parameterized_ratio",
                     theta0s=[this_theta],
                     theta1s=None,
                     xs=x,
                     evaluate_score=evaluate_score,
+                    run_on_gpu=run_on_gpu,
+                    compiled_model=compiled_model,
                 )
 
                 t_hat = self._transform_score(t_hat, inverse=True)
@@ -410,12 +485,14 @@ class ParameterizedRatioEstimator(ConditionalEstimator):
         else:
             logger.debug("Starting ratio evaluation")
             _, all_log_r_hat, all_t_hat, _ = evaluate_ratio_model(
-                model=self.model,
+                model=model,
                 method_type="parameterized_ratio",
                 theta0s=theta,
                 theta1s=None,
                 xs=x,
                 evaluate_score=evaluate_score,
+                run_on_gpu=run_on_gpu,
+                compiled_model=compiled_model,
             )
 
             all_t_hat = self._transform_score(all_t_hat, inverse=True)
@@ -517,6 +594,12 @@ class ParameterizedRatioEstimator(ConditionalEstimator):
     def evaluate(self, *args, **kwargs):
         return self.evaluate_log_likelihood_ratio(*args, **kwargs)
 
+    def _evaluate_network(self, model, x, theta=None, run_on_gpu=True):
+        _, log_r_hat, _, _ = evaluate_ratio_model(
+            model=model, method_type="parameterized_ratio", theta0s=theta, xs=x, run_on_gpu=run_on_gpu
+        )
+        return log_r_hat
+
     def _create_model(self):
         self.model = DenseSingleParameterizedRatioModel(
             n_observables=self.n_observables,
@@ -66,9 +66,14 @@ class ScoreEstimator(Estimator):
         limit_samplesize=None,
         memmap=False,
         verbose="some",
-        n_workers=8,
+        n_workers=None,
         clip_gradient=None,
         early_stopping_patience=None,
+        checkpoint_path=None,
+        checkpoint_every=1,
+        resume_from=None,
+        callbacks=None,
+        return_profile=False,
     ):
 
         """
@@ -131,6 +136,31 @@ class ScoreEstimator(Estimator):
         verbose : {"all", "many", "some", "few", "none}, optional
             Determines verbosity of training. Default value: "some".
 
+        n_workers : None, optional
+            Deprecated and ignored. Training batches are now drawn directly from the (block-shuffled) training data
+            instead of through a multi-process torch DataLoader. Default value: None.
+
+        checkpoint_path : str or None, optional
+            If not None, the model, optimizer, learning rate schedule, early stopping, and random number generator
+            state are saved to this file during training, such that an interrupted training can be continued with
+            resume_from. Default value: None.
+
+        checkpoint_every : int, optional
+            Number of epochs between checkpoints. Default value: 1.
+
+        resume_from : str or None, optional
+            Checkpoint file written with checkpoint_path in an earlier call with the same training data and settings.
+            If not None, the training continues after the last epoch stored in this file. Default value: None.
+
+        callbacks : list of TrainingCallback or None, optional
+            Callbacks that are called after every minibatch and every epoch, see
+            `madminer.utils.ml.trainer.TrainingCallback`. Default value: None.
+
+        return_profile : bool, optional
+            If True, a training profile is returned in addition to the losses. It contains the accumulated time spent
+            in each section of the training loop, the peak memory usage, and for every epoch the throughput in samples
+            per second and the fraction of time spent waiting for data. Default value: False.
+
         Returns
         -------
             None
@@ -234,6 +264,8 @@ class ScoreEstimator(Estimator):
         if self.model is None:
             logger.info("Creating model")
             self._create_model()
+        self.compiled_model = None
+        self.quantized_model, self.quantization_deviation = None, None
 
         # Losses
         loss_functions, loss_labels, loss_weights = get_loss(method, None)
@@ -261,6 +293,11 @@ class ScoreEstimator(Estimator):
             verbose=verbose,
             clip_gradient=clip_gradient,
             early_stopping_patience=early_stopping_patience,
+            checkpoint_path=checkpoint_path,
+            checkpoint_every=checkpoint_every,
+            resume_from=resume_from,
+            callbacks=callbacks,
+            return_profile=return_profile,
         )
         return result
 
@@ -314,7 +351,7 @@ class ScoreEstimator(Estimator):
 
         logger.debug("Nuisance profiling matrix:/n%s", self.nuisance_project_matrix)
 
-    def evaluate_score(self, x, theta=None, nuisance_mode="auto"):
+    def evaluate_score(self, x, theta=None, nuisance_mode="auto", quantized=None):
         """
         Evaluates the score.
 
@@ -334,6 +371,11 @@ class ScoreEstimator(Estimator):
             the n-dimensional profiled score. For "project", it is the n-dimensional projected score, i.e. ignoring
             the nuisance parameters.
 
+        quantized : bool or None, optional
+            If True, the int8-quantized network is evaluated (see `Estimator.quantize()`, which is called first if
+            necessary). If False, the original network is evaluated. If None, the quantized network is used if the
+            estimator has one. Default value: None.
+
         Returns
         -------
         score : ndarray
@@ -361,7 +403,11 @@ class ScoreEstimator(Estimator):
 
         # Evaluation
         logger.debug("Starting score evaluation")
-        t_hat = evaluate_local_score_model(model=self.model, xs=x)
+        quantized_model = self._select_quantized_model(quantized)
+        if quantized_model is not None:
+            t_hat = evaluate_local_score_model(model=quantized_model, xs=x, run_on_gpu=False)
+        else:
+            t_hat = evaluate_local_score_model(model=self.model, xs=x, compiled_model=self.compiled_model)
 
         # Treatment of nuisance paramters
         if nuisance_mode == "keep":
@@ -405,8 +451,8 @@ class ScoreEstimator(Estimator):
         )
         return fisher_information
 
-    def save(self, filename, save_model=False):
-        super(ScoreEstimator, self).save(filename, save_model)
+    def save(self, filename, save_model=False, save_compiled=False):
+        super(ScoreEstimator, self).save(filename, save_model, save_compiled)
 
         # Also save Fisher information information for profiling / projections
         if self.nuisance_profile_matrix is not None and self.nuisance_project_matrix is not None:
@@ -436,6 +482,9 @@ class ScoreEstimator(Estimator):
             self.nuisance_profile_matrix = None
             self.nuisance_project_matrix = None
 
+    def _evaluate_network(self, model, x, theta=None, run_on_gpu=True):
+        return evaluate_local_score_model(model=model, xs=x, run_on_gpu=run_on_gpu)
+
     def _create_model(self):
         self.model = DenseLocalScoreModel(
             n_observables=self.n_observables,
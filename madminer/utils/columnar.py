@@ -0,0 +1,545 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import six
+import numpy as np
+from collections import OrderedDict
+import logging
+
+from madminer.utils.particle import MadMinerParticle
+from madminer.utils.various import compile_expression, eval_expression
+
+logger = logging.getLogger(__name__)
+
+
+class ParticleColumns(object):
+    """ One particle (or sum of particles) per event, stored as arrays with one entry per event. Mirrors the
+    properties of MadMinerParticle / scikit-hep's LorentzVector that are used in observable definitions. """
+
+    def __init__(self, px, py, pz, e, charge=None, pdgid=None, spin=None, tau_tag=None, b_tag=None, t_tag=None):
+        n = len(px)
+        self.px = px
+        self.py = py
+        self.pz = pz
+        self.e = e
+        self.charge = np.full(n, np.nan) if charge is None else charge
+        self.pdgid = np.full(n, np.nan) if pdgid is None else pdgid
+        self.spin = np.full(n, np.nan) if spin is None else spin
+        self.tau_tag = np.zeros(n, dtype=np.bool_) if tau_tag is None else tau_tag
+        self.b_tag = np.zeros(n, dtype=np.bool_) if b_tag is None else b_tag
+        self.t_tag = np.zeros(n, dtype=np.bool_) if t_tag is None else t_tag
+
+    # Components
+    @property
+    def x(self):
+        return self.px
+
+    @property
+    def y(self):
+        return self.py
+
+    @property
+    def z(self):
+        return self.pz
+
+    @property
+    def t(self):
+        return self.e
+
+    # Derived quantities, with the same conventions as LorentzVector
+    @property
+    def perp2(self):
+        return self.px ** 2 + self.py ** 2
+
+    @property
+    def pt(self):
+        return np.sqrt(self.perp2)
+
+    @property
+    def perp(self):
+        return self.pt
+
+    @property
+    def p(self):
+        return np.sqrt(self.px ** 2 + self.py ** 2 + self.pz ** 2)
+
+    @property
+    def mag2(self):
+        return self.e ** 2 - (self.px ** 2 + self.py ** 2 + self.pz ** 2)
+
+    @property
+    def mag(self):
+        mag2 = self.mag2
+        return np.where(mag2 >= 0.0, np.sqrt(np.abs(mag2)), -np.sqrt(np.abs(mag2)))
+
+    @property
+    def m(self):
+        return self.mag
+
+    @property
+    def mass(self):
+        return self.mag
+
+    @property
+    def eta(self):
+        costheta = self.costheta()
+        inside = np.abs(costheta) < 1.0
+        safe_costheta = np.where(inside, costheta, 0.0)
+        eta = -0.5 * np.log((1.0 - safe_costheta) / (1.0 + safe_costheta))
+        return np.where(inside, eta, np.where(self.pz > 0.0, 10e10, -10e10))
+
+    @property
+    def rapidity(self):
+        return 0.5 * np.log((self.e + self.pz) / (self.e - self.pz))
+
+    @property
+    def et(self):
+        return self.e * (self.pt / self.p)
+
+    @property
+    def transversemass2(self):
+        return self.e ** 2 - self.pz ** 2
+
+    @property
+    def transversemass(self):
+        mt2 = self.transversemass2
+        return np.where(mt2 >= 0.0, np.sqrt(np.abs(mt2)), -np.sqrt(np.abs(mt2)))
+
+    @property
+    def mt(self):
+        return self.transversemass
+
+    @property
+    def mt2(self):
+        return self.transversemass2
+
+    @property
+    def beta(self):
+        return self.p / self.e
+
+    def phi(self, deg=False):
+        phi = np.arctan2(self.py, self.px)
+        return np.degrees(phi) if deg else phi
+
+    def costheta(self):
+        p = self.p
+        return np.where(p == 0.0, 1.0, self.pz / np.where(p == 0.0, 1.0, p))
+
+    def theta(self, deg=False):
+        theta = np.arccos(self.costheta())
+        return np.degrees(theta) if deg else theta
+
+    def deltaphi(self, other):
+        return np.mod(self.phi() - other.phi() + np.pi, 2.0 * np.pi) - np.pi
+
+    def deltaeta(self, other):
+        return self.eta - other.eta
+
+    def __add__(self, other):
+        if not isinstance(other, ParticleColumns):
+            return NotImplemented
+        return ParticleColumns(
+            self.px + other.px,
+            self.py + other.py,
+            self.pz + other.pz,
+            self.e + other.e,
+            charge=self.charge + other.charge,
+            tau_tag=self.tau_tag | other.tau_tag,
+            b_tag=self.b_tag | other.b_tag,
+            t_tag=self.t_tag | other.t_tag,
+        )
+
+    def __sub__(self, other):
+        if not isinstance(other, ParticleColumns):
+            return NotImplemented
+        return ParticleColumns(
+            self.px - other.px,
+            self.py - other.py,
+            self.pz - other.pz,
+            self.e - other.e,
+            charge=self.charge - other.charge,
+            tau_tag=self.tau_tag | other.tau_tag,
+            b_tag=self.b_tag | other.b_tag,
+            t_tag=self.t_tag | other.t_tag,
+        )
+
+    def to_particle(self, i):
+        """ Returns the entry for event i as MadMinerParticle """
+
+        particle = MadMinerParticle()
+        particle.setpxpypze(float(self.px[i]), float(self.py[i]), float(self.pz[i]), float(self.e[i]))
+        if np.isfinite(self.pdgid[i]):
+            particle.set_pdgid(int(self.pdgid[i]))
+            particle.set_spin(float(self.spin[i]))
+        return particle
+
+
+class JaggedParticles(object):
+    """ A variable number of particles per event, stored as flat arrays of the particle properties together with the
+    index of the event each particle belongs to. The particles of each event are stored contiguously. Charge and tags
+    follow from the PDG ids, unless tau and b tags (for instance from a detector simulation) are given. """
+
+    def __init__(self, px, py, pz, e, pdgid, event_index, n_events, spin=None, tau_tag=None, b_tag=None):
+        self.px = np.asarray(px, dtype=np.float64)
+        self.py = np.asarray(py, dtype=np.float64)
+        self.pz = np.asarray(pz, dtype=np.float64)
+        self.e = np.asarray(e, dtype=np.float64)
+        self.pdgid = np.asarray(pdgid, dtype=np.int64)
+        self.spin = np.zeros(len(self.px)) if spin is None else np.asarray(spin, dtype=np.float64)
+        self.event_index = np.asarray(event_index, dtype=np.int64)
+        self.n_events = n_events
+
+        self.counts = np.bincount(self.event_index, minlength=n_events)
+        self.offsets = np.zeros(n_events + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(self.counts)
+
+        self.charge, self.tau_tag, self.b_tag, self.t_tag = _particle_id_properties(self.pdgid)
+        if tau_tag is not None:
+            self.tau_tag = np.asarray(tau_tag, dtype=np.bool_)
+        if b_tag is not None:
+            self.b_tag = np.asarray(b_tag, dtype=np.bool_)
+
+    @property
+    def pt(self):
+        return np.sqrt(self.px ** 2 + self.py ** 2)
+
+    def __len__(self):
+        return len(self.px)
+
+    def select(self, mask):
+        """ Returns the particles for which mask is True, keeping their order """
+
+        return JaggedParticles(
+            self.px[mask],
+            self.py[mask],
+            self.pz[mask],
+            self.e[mask],
+            self.pdgid[mask],
+            self.event_index[mask],
+            self.n_events,
+            spin=self.spin[mask],
+            tau_tag=self.tau_tag[mask],
+            b_tag=self.b_tag[mask],
+        )
+
+    def sorted_by_pt(self):
+        """ Returns the particles sorted by descending pT within each event (stable, like sorted(reverse=True)) """
+
+        order = np.lexsort((-self.pt, self.event_index))
+        return self.select(order)
+
+    def sum(self, mask=None):
+        """ Returns the four-momentum sum of all particles (for which mask is True) in each event as arrays
+        px, py, pz, e """
+
+        weights = np.ones(len(self)) if mask is None else mask.astype(np.float64)
+        return tuple(
+            np.bincount(self.event_index, weights=weights * component, minlength=self.n_events)
+            for component in (self.px, self.py, self.pz, self.e)
+        )
+
+    def get(self, i):
+        """ Returns the i-th particle of each event (counting from the end for negative i) as ParticleColumns,
+        together with a mask of the events that have such a particle. For the other events all properties are
+        zero. """
+
+        if i >= 0:
+            valid = self.counts > i
+            index = self.offsets[:-1] + i
+        else:
+            valid = self.counts >= -i
+            index = self.offsets[1:] + i
+        if len(self) == 0:
+            valid = np.zeros(self.n_events, dtype=np.bool_)
+        index = np.where(valid, index, 0)
+
+        if len(self) == 0:
+            return ParticleColumns(*[np.zeros(self.n_events) for _ in range(4)]), valid
+
+        columns = ParticleColumns(
+            np.where(valid, self.px[index], 0.0),
+            np.where(valid, self.py[index], 0.0),
+            np.where(valid, self.pz[index], 0.0),
+            np.where(valid, self.e[index], 0.0),
+            charge=np.where(valid, self.charge[index], 0.0),
+            pdgid=np.where(valid, self.pdgid[index], 0),
+            spin=np.where(valid, self.spin[index], 0.0),
+            tau_tag=valid & self.tau_tag[index],
+            b_tag=valid & self.b_tag[index],
+            t_tag=valid & self.t_tag[index],
+        )
+        return columns, valid
+
+    def to_particles(self, i_event):
+        """ Returns the particles in event i_event as list of MadMinerParticle """
+
+        particles = []
+        for k in range(self.offsets[i_event], self.offsets[i_event + 1]):
+            particle = MadMinerParticle()
+            particle.setpxpypze(float(self.px[k]), float(self.py[k]), float(self.pz[k]), float(self.e[k]))
+            particle.set_pdgid(int(self.pdgid[k]))
+            particle.set_spin(float(self.spin[k]))
+            particle.set_tags(bool(self.tau_tag[k]), bool(self.b_tag[k]), bool(self.t_tag[k]))
+            particles.append(particle)
+        return particles
+
+
+class _BoundJaggedParticles(object):
+    """ Wrapper for JaggedParticles during the evaluation of an expression that records which events have all the
+    particles that are accessed """
+
+    def __init__(self, particles, valid):
+        self._particles = particles
+        self._valid = valid
+
+    def __getitem__(self, i):
+        if not isinstance(i, six.integer_types):
+            raise TypeError("Only integer indices are supported in vectorized expressions")
+        columns, valid = self._particles.get(i)
+        self._valid &= valid
+        return columns
+
+    def __iter__(self):
+        # Without this, iteration would fall back to __getitem__ with ever larger indices and never stop
+        raise TypeError("Loops over a particle collection are not supported in vectorized expressions")
+
+    def __len__(self):
+        raise TypeError("len() of a particle collection is not a number in vectorized expressions")
+
+
+def _vectorized_len(obj):
+    if isinstance(obj, _BoundJaggedParticles):
+        return obj._particles.counts
+    return len(obj)
+
+
+def _vectorized_math_commands():
+    return {
+        "acos": np.arccos,
+        "asin": np.arcsin,
+        "atan": np.arctan,
+        "atan2": np.arctan2,
+        "ceil": np.ceil,
+        "cos": np.cos,
+        "cosh": np.cosh,
+        "exp": np.exp,
+        "floor": np.floor,
+        "log": np.log,
+        "pi": np.pi,
+        "pow": np.power,
+        "sin": np.sin,
+        "sinh": np.sinh,
+        "sqrt": np.sqrt,
+        "tan": np.tan,
+        "tanh": np.tanh,
+        "len": _vectorized_len,
+    }
+
+
+class ExpressionNotVectorizable(Exception):
+    pass
+
+
+def evaluate_expression(code, objects, n_events):
+    """
+    Evaluates a compiled observable, cut, or efficiency expression for a batch of events at once.
+
+    Parameters
+    ----------
+    code : code object
+        Expression compiled with `compile(definition, "<string>", "eval")`.
+
+    objects : dict
+        Objects available in the expression. JaggedParticles are accessed like lists of particles, ParticleColumns
+        like single particles, and arrays with shape (n_events,) like numbers. The math functions of the per-event
+        evaluation are replaced by their numpy counterparts.
+
+    n_events : int
+        Number of events.
+
+    Returns
+    -------
+    values : ndarray
+        Result with shape (n_events,) and dtype float.
+
+    valid : ndarray
+        Boolean mask with shape (n_events,). It is False for events in which a particle that does not exist was
+        accessed, where the per-event evaluation raises an IndexError. Where valid is True but the value is not a
+        finite number (which the per-event evaluation may instead signal with an exception), the expression should
+        be evaluated per event.
+
+    Raises
+    ------
+    NameError
+        If the expression uses a name that is not defined. This does not depend on the event.
+
+    ExpressionNotVectorizable
+        If the expression cannot be evaluated for the whole batch, for instance because it uses a property of
+        MadMinerParticle that is not implemented in ParticleColumns, or control flow that depends on the event.
+
+    """
+
+    valid = np.ones(n_events, dtype=np.bool_)
+    namespace = {}
+    for key, value in six.iteritems(objects):
+        namespace[key] = _BoundJaggedParticles(value, valid) if isinstance(value, JaggedParticles) else value
+    namespace.update(_vectorized_math_commands())
+
+    try:
+        with np.errstate(all="ignore"):
+            values = eval(code, namespace)
+            values = np.broadcast_to(np.asarray(values, dtype=np.float64), (n_events,))
+    except NameError:
+        raise
+    except Exception as e:
+        raise ExpressionNotVectorizable(str(e))
+
+    return values, valid
+
+
+def evaluate_batch_expression(definition, objects, event_variables, n_events, mask=None):
+    """
+    Evaluates an observable, cut, or efficiency expression for a batch of events, where possible in one go with
+    `evaluate_expression()`, and otherwise (or for events where the result is not finite) event by event.
+
+    Parameters
+    ----------
+    definition : str
+        Python expression.
+
+    objects : dict
+        Objects available in the expression for the whole batch, see `evaluate_expression()`.
+
+    event_variables : callable
+        Function that takes the index of an event and returns the variables for the per-event evaluation of the
+        expression as a dict (with MadMinerParticle instances, the math commands are added by `eval_expression()`).
+
+    n_events : int
+        Number of events.
+
+    mask : ndarray or None, optional
+        If not None, only the events for which mask is True are evaluated one by one. Default value: None.
+
+    Returns
+    -------
+    values : ndarray
+        Result with shape (n_events,) and dtype float.
+
+    valid : ndarray
+        Boolean mask with shape (n_events,) of the events where the evaluation succeeded.
+
+    """
+
+    try:
+        code = compile_expression(definition)
+    except SyntaxError:
+        return np.full(n_events, np.nan), np.zeros(n_events, dtype=np.bool_)
+
+    try:
+        values, valid = evaluate_expression(code, objects, n_events)
+        values = np.array(values)
+        redo = valid & ~np.isfinite(values)
+    except NameError:
+        return np.full(n_events, np.nan), np.zeros(n_events, dtype=np.bool_)
+    except ExpressionNotVectorizable as e:
+        logger.debug("Evaluating %s event by event: %s", definition, e)
+        values = np.full(n_events, np.nan)
+        valid = np.ones(n_events, dtype=np.bool_)
+        redo = np.ones(n_events, dtype=np.bool_)
+
+    if mask is not None:
+        redo &= mask
+    for i_event in np.where(redo)[0]:
+        try:
+            values[i_event] = eval_expression(code, event_variables(i_event))
+        except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
+            valid[i_event] = False
+
+    return values, valid
+
+
+class EventVariables(object):
+    """
+    Per-event variables for observables defined through functions and for expressions that cannot be evaluated for
+    the whole batch.
+
+    Parameters
+    ----------
+    get_objects : callable
+        Function that takes the index of an event and returns the objects of this event as a dict, like the
+        `_get_objects()` functions of the readers. It is called at most once per event.
+
+    """
+
+    def __init__(self, get_objects):
+        self.get_objects = get_objects
+        self.columns = OrderedDict()
+        self._cache = {}
+
+    def __call__(self, i_event):
+        if i_event not in self._cache:
+            self._cache[i_event] = self.get_objects(i_event)
+
+        # Values that are only known later, e.g. observables that cuts depend on
+        variables = self._cache[i_event]
+        for key, values in six.iteritems(self.columns):
+            variables[key] = values[i_event]
+        return variables
+
+
+def evaluate_batch_function(function, event_variables, n_events, argument_names):
+    """
+    Evaluates an observable defined through a function event by event.
+
+    Parameters
+    ----------
+    function : callable
+        Observable function. A RuntimeError marks the observable as not valid in this event.
+
+    event_variables : EventVariables
+        Per-event variables.
+
+    n_events : int
+        Number of events.
+
+    argument_names : list of str
+        Names of the variables that are passed to the function as positional arguments.
+
+    Returns
+    -------
+    values : ndarray
+        Result with shape (n_events,) and dtype float.
+
+    valid : ndarray
+        Boolean mask with shape (n_events,) of the events where the evaluation succeeded.
+
+    """
+
+    values = np.full(n_events, np.nan)
+    valid = np.ones(n_events, dtype=np.bool_)
+    for i_event in range(n_events):
+        variables = event_variables(i_event)
+        try:
+            values[i_event] = function(*[variables[name] for name in argument_names])
+        except RuntimeError:
+            valid[i_event] = False
+    return values, valid
+
+
+def _particle_id_properties(pdgids):
+    """ Returns charge, tau tag, b tag, t tag arrays for an array of PDG ids, as set by MadMinerParticle.set_pdgid() """
+
+    charge = np.zeros(len(pdgids))
+    tau_tag = np.zeros(len(pdgids), dtype=np.bool_)
+    b_tag = np.zeros(len(pdgids), dtype=np.bool_)
+    t_tag = np.zeros(len(pdgids), dtype=np.bool_)
+
+    for pdgid in np.unique(pdgids):
+        particle = MadMinerParticle()
+        particle.set_pdgid(int(pdgid))
+        mask = pdgids == pdgid
+        charge[mask] = particle.charge
+        tau_tag[mask] = particle.tau_tag
+        b_tag[mask] = particle.b_tag
+        t_tag[mask] = particle.t_tag
+
+    return charge, tau_tag, b_tag, t_tag
@@ -8,7 +8,15 @@ import os
 import logging
 
 from madminer.utils.particle import MadMinerParticle
-from madminer.utils.various import math_commands
+from madminer.utils.various import eval_expression, compile_expression
+from madminer.utils.columnar import (
+    JaggedParticles,
+    ParticleColumns,
+    EventVariables,
+    evaluate_batch_expression,
+    evaluate_batch_function,
+    ExpressionNotVectorizable,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -31,8 +39,13 @@ def parse_delphes_root_file(
     acceptance_eta_max_a=None,
     acceptance_eta_max_j=None,
     delete_delphes_sample_file=False,
+    columnar=False,
+    batch_size=10000,
 ):
-    """ Extracts observables and weights from a Delphes ROOT file """
+    """ Extracts observables and weights from a Delphes ROOT file. The events are read and analysed in batches of
+    batch_size events. If columnar is True, acceptance cuts, object definitions, observables and cuts are calculated
+    with array operations on the jagged arrays of a batch, and MadMinerParticle instances are only created for
+    observables defined through functions and for expressions that cannot be evaluated in this way. """
 
     logger.debug("Parsing Delphes file %s", delphes_sample_file)
 
@@ -72,117 +85,49 @@ def parse_delphes_root_file(
         n_events = _get_n_events(tree)
         logger.debug("Found %s events", n_events)
 
-    # Get all particle properties
-    if use_generator_truth:
-        photons_all_events = _get_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [22])
-        electrons_all_events = _get_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [11, -11])
-        muons_all_events = _get_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [13, -13])
-        leptons_all_events = _get_particles_truth_leptons(
-            tree, acceptance_pt_min_e, acceptance_eta_max_e, acceptance_pt_min_mu, acceptance_eta_max_mu
-        )
-        jets_all_events = _get_particles_truth_jets(tree, acceptance_pt_min_j, acceptance_eta_max_j)
-        met_all_events = _get_particles_truth_met(tree)
-
+    # Calculate observables and cuts
+    if columnar:
+        calculate_observables_and_cuts = _calculate_observables_and_cuts_columnar
     else:
-        photons_all_events = _get_particles_photons(tree, acceptance_pt_min_a, acceptance_eta_max_a)
-        electrons_all_events = _get_particles_charged(
-            tree, "Electron", 0.000511, -11, acceptance_pt_min_e, acceptance_eta_max_e
-        )
-        muons_all_events = _get_particles_charged(tree, "Muon", 0.105, -13, acceptance_pt_min_mu, acceptance_eta_max_mu)
-        leptons_all_events = _get_particles_leptons(
-            tree, acceptance_pt_min_e, acceptance_eta_max_e, acceptance_pt_min_mu, acceptance_eta_max_mu
-        )
-        jets_all_events = _get_particles_jets(tree, acceptance_pt_min_j, acceptance_eta_max_j)
-        met_all_events = _get_particles_met(tree)
-
-    # Prepare variables
-    def get_objects(ievent):
-        visible_momentum = MadMinerParticle()
-        for p in (
-            electrons_all_events[ievent]
-            + jets_all_events[ievent]
-            + muons_all_events[ievent]
-            + photons_all_events[ievent]
-        ):
-            visible_momentum += p
-        all_momentum = visible_momentum + met_all_events[ievent][0]
-
-        objects = math_commands()
-        objects.update(
-            {
-                "e": electrons_all_events[ievent],
-                "j": jets_all_events[ievent],
-                "a": photons_all_events[ievent],
-                "mu": muons_all_events[ievent],
-                "l": leptons_all_events[ievent],
-                "met": met_all_events[ievent][0],
-                "visible": visible_momentum,
-                "all": all_momentum,
-                "boost_to_com": lambda momentum: momentum.boost(all_momentum.boost_vector()),
-            }
+        calculate_observables_and_cuts = _calculate_observables_and_cuts
+
+    observable_batches = OrderedDict((obs_name, []) for obs_name in observables)
+    cut_batches = [[] for _ in cuts]
+
+    for entry_start in range(0, n_events, batch_size):
+        entry_stop = min(entry_start + batch_size, n_events)
+        logger.debug("  Analysing events %s to %s", entry_start, entry_stop)
+
+        this_observable_values, this_cut_values = calculate_observables_and_cuts(
+            _TreeBatch(tree, entry_start, entry_stop),
+            entry_stop - entry_start,
+            observables,
+            observables_defaults,
+            cuts,
+            cuts_default_pass,
+            use_generator_truth,
+            acceptance_pt_min_e,
+            acceptance_pt_min_mu,
+            acceptance_pt_min_a,
+            acceptance_pt_min_j,
+            acceptance_eta_max_e,
+            acceptance_eta_max_mu,
+            acceptance_eta_max_a,
+            acceptance_eta_max_j,
         )
 
-        return objects
+        for obs_name, values_this_observable in six.iteritems(this_observable_values):
+            observable_batches[obs_name].append(values_this_observable)
+        for batches_this_cut, values_this_cut in zip(cut_batches, this_cut_values):
+            batches_this_cut.append(values_this_cut)
 
-    # Observations
     observable_values = OrderedDict()
+    for obs_name, batches_this_observable in six.iteritems(observable_batches):
+        observable_values[obs_name] = np.concatenate(batches_this_observable + [np.zeros(0, dtype=np.float)])
 
-    for obs_name, obs_definition in six.iteritems(observables):
-        values_this_observable = []
+        logger.debug("  First 10 values for observable %s:\n%s", obs_name, observable_values[obs_name][:10])
 
-        # Loop over events
-        for event in range(n_events):
-            variables = get_objects(event)
-
-            if isinstance(obs_definition, six.string_types):
-                try:
-                    values_this_observable.append(eval(obs_definition, variables))
-                except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
-                    default = observables_defaults[obs_name]
-                    if default is None:
-                        default = np.nan
-                    values_this_observable.append(default)
-            else:
-                try:
-                    values_this_observable.append(
-                        obs_definition(
-                            leptons_all_events[event],
-                            photons_all_events[event],
-                            jets_all_events[event],
-                            met_all_events[event][0],
-                        )
-                    )
-                except RuntimeError:
-                    default = observables_defaults[obs_name]
-                    if default is None:
-                        default = np.nan
-                    values_this_observable.append(default)
-
-        values_this_observable = np.array(values_this_observable, dtype=np.float)
-        observable_values[obs_name] = values_this_observable
-
-        logger.debug("  First 10 values for observable %s:\n%s", obs_name, values_this_observable[:10])
-
-    # Cuts
-    cut_values = []
-
-    for cut, default_pass in zip(cuts, cuts_default_pass):
-        values_this_cut = []
-
-        # Loop over events
-        for event in range(n_events):
-            variables = get_objects(event)
-
-            for obs_name in observable_values:
-                variables[obs_name] = observable_values[obs_name][event]
-
-            try:
-                values_this_cut.append(eval(cut, variables))
-            except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
-                values_this_cut.append(default_pass)
-
-        values_this_cut = np.array(values_this_cut, dtype=np.bool)
-        cut_values.append(values_this_cut)
+    cut_values = [np.concatenate(batches_this_cut + [np.zeros(0, dtype=np.bool)]) for batches_this_cut in cut_batches]
 
     # Check for existence of required observables
     combined_filter = None
@@ -246,6 +191,238 @@ def parse_delphes_root_file(
     return observable_values, weights_dict, combined_filter
 
 
+def _calculate_observables_and_cuts(
+    tree,
+    n_events,
+    observables,
+    observables_defaults,
+    cuts,
+    cuts_default_pass,
+    use_generator_truth,
+    acceptance_pt_min_e,
+    acceptance_pt_min_mu,
+    acceptance_pt_min_a,
+    acceptance_pt_min_j,
+    acceptance_eta_max_e,
+    acceptance_eta_max_mu,
+    acceptance_eta_max_a,
+    acceptance_eta_max_j,
+):
+    """ Calculates observables and cuts event by event, with the particles of each event as MadMinerParticle
+    instances """
+
+    # Get all particle properties
+    if use_generator_truth:
+        photons_all_events = _get_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [22])
+        electrons_all_events = _get_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [11, -11])
+        muons_all_events = _get_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [13, -13])
+        leptons_all_events = _get_particles_truth_leptons(
+            tree, acceptance_pt_min_e, acceptance_eta_max_e, acceptance_pt_min_mu, acceptance_eta_max_mu
+        )
+        jets_all_events = _get_particles_truth_jets(tree, acceptance_pt_min_j, acceptance_eta_max_j)
+        met_all_events = _get_particles_truth_met(tree)
+
+    else:
+        photons_all_events = _get_particles_photons(tree, acceptance_pt_min_a, acceptance_eta_max_a)
+        electrons_all_events = _get_particles_charged(
+            tree, "Electron", 0.000511, -11, acceptance_pt_min_e, acceptance_eta_max_e
+        )
+        muons_all_events = _get_particles_charged(tree, "Muon", 0.105, -13, acceptance_pt_min_mu, acceptance_eta_max_mu)
+        leptons_all_events = _get_particles_leptons(
+            tree, acceptance_pt_min_e, acceptance_eta_max_e, acceptance_pt_min_mu, acceptance_eta_max_mu
+        )
+        jets_all_events = _get_particles_jets(tree, acceptance_pt_min_j, acceptance_eta_max_j)
+        met_all_events = _get_particles_met(tree)
+
+    # Observables and cuts, with the objects of each event built once
+    observable_values = OrderedDict((obs_name, np.zeros(n_events, dtype=np.float)) for obs_name in observables)
+    cut_values = [np.zeros(n_events, dtype=np.bool) for _ in cuts]
+
+    for event in range(n_events):
+        variables = _get_objects(
+            electrons_all_events[event],
+            jets_all_events[event],
+            photons_all_events[event],
+            muons_all_events[event],
+            leptons_all_events[event],
+            met_all_events[event][0],
+        )
+
+        for obs_name, obs_definition in six.iteritems(observables):
+            if isinstance(obs_definition, six.string_types):
+                try:
+                    value = eval_expression(compile_expression(obs_definition), variables)
+                except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
+                    value = observables_defaults[obs_name]
+            else:
+                try:
+                    value = obs_definition(variables["l"], variables["a"], variables["j"], variables["met"])
+                except RuntimeError:
+                    value = observables_defaults[obs_name]
+            observable_values[obs_name][event] = np.nan if value is None else value
+
+        for obs_name, values_this_observable in six.iteritems(observable_values):
+            variables[obs_name] = values_this_observable[event]
+
+        for i_cut, (cut, default_pass) in enumerate(zip(cuts, cuts_default_pass)):
+            try:
+                cut_values[i_cut][event] = bool(eval_expression(compile_expression(cut), variables))
+            except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
+                cut_values[i_cut][event] = bool(default_pass)
+
+    return observable_values, cut_values
+
+
+def _calculate_observables_and_cuts_columnar(
+    tree,
+    n_events,
+    observables,
+    observables_defaults,
+    cuts,
+    cuts_default_pass,
+    use_generator_truth,
+    acceptance_pt_min_e,
+    acceptance_pt_min_mu,
+    acceptance_pt_min_a,
+    acceptance_pt_min_j,
+    acceptance_eta_max_e,
+    acceptance_eta_max_mu,
+    acceptance_eta_max_a,
+    acceptance_eta_max_j,
+):
+    """ Calculates observables and cuts for all events at once, with the particles stored as JaggedParticles """
+
+    # Get all particle properties
+    if use_generator_truth:
+        photons = _get_jagged_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [22])
+        electrons = _get_jagged_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [11, -11])
+        muons = _get_jagged_particles_truth(tree, acceptance_pt_min_a, acceptance_eta_max_a, [13, -13])
+        leptons = _get_jagged_particles_truth_leptons(
+            tree, acceptance_pt_min_e, acceptance_eta_max_e, acceptance_pt_min_mu, acceptance_eta_max_mu
+        )
+        jets = _get_jagged_particles_jets(tree, "GenJet", acceptance_pt_min_j, acceptance_eta_max_j)
+        met = _get_jagged_particles_met(tree, "GenMissingET")
+
+    else:
+        photons = _get_jagged_particles_photons(tree, acceptance_pt_min_a, acceptance_eta_max_a)
+        electrons = _get_jagged_particles_charged(
+            tree, "Electron", 0.000511, -11, acceptance_pt_min_e, acceptance_eta_max_e
+        )
+        muons = _get_jagged_particles_charged(tree, "Muon", 0.105, -13, acceptance_pt_min_mu, acceptance_eta_max_mu)
+        leptons = _merge_jagged_particles(muons, electrons)
+        jets = _get_jagged_particles_jets(tree, "Jet", acceptance_pt_min_j, acceptance_eta_max_j)
+        met = _get_jagged_particles_met(tree, "MissingET")
+
+    objects = _get_columnar_objects(electrons, jets, photons, muons, leptons, met)
+    event_variables = EventVariables(
+        lambda i_event: _get_event_objects(i_event, electrons, jets, photons, muons, leptons, met)
+    )
+
+    # Observations
+    observable_values = OrderedDict()
+
+    for obs_name, obs_definition in six.iteritems(observables):
+        if isinstance(obs_definition, six.string_types):
+            values, valid = evaluate_batch_expression(obs_definition, objects, event_variables, n_events)
+        else:
+            values, valid = evaluate_batch_function(obs_definition, event_variables, n_events, ["l", "a", "j", "met"])
+
+        default = observables_defaults[obs_name]
+        if default is None:
+            default = np.nan
+        observable_values[obs_name] = np.where(valid, values, default).astype(np.float)
+
+    # Cuts
+    cut_objects = dict(objects)
+    for obs_name, values_this_observable in six.iteritems(observable_values):
+        cut_objects[obs_name] = values_this_observable
+        event_variables.columns[obs_name] = values_this_observable
+
+    cut_values = []
+
+    for cut, default_pass in zip(cuts, cuts_default_pass):
+        values, valid = evaluate_batch_expression(cut, cut_objects, event_variables, n_events)
+        values_this_cut = np.where(valid, values != 0.0, bool(default_pass))
+        cut_values.append(values_this_cut)
+
+    return observable_values, cut_values
+
+
+def _get_objects(electrons, jets, photons, muons, leptons, met):
+    """ Returns the variables for observables and cuts in one event """
+
+    visible_momentum = MadMinerParticle()
+    for p in electrons + jets + muons + photons:
+        visible_momentum += p
+    all_momentum = visible_momentum + met
+
+    # The math commands are provided by eval_expression()
+    objects = {
+        "e": electrons,
+        "j": jets,
+        "a": photons,
+        "mu": muons,
+        "l": leptons,
+        "met": met,
+        "visible": visible_momentum,
+        "all": all_momentum,
+        "boost_to_com": lambda momentum: momentum.boost(all_momentum.boost_vector()),
+    }
+
+    return objects
+
+
+def _get_columnar_objects(electrons, jets, photons, muons, leptons, met):
+    """ Columnar version of _get_objects() for all events, given as JaggedParticles """
+
+    met, _ = met.get(0)
+
+    visible_momentum = [0.0, 0.0, 0.0, 0.0]
+    for particles in (electrons, jets, muons, photons):
+        visible_momentum = [total + component for total, component in zip(visible_momentum, particles.sum())]
+    visible_momentum = ParticleColumns(*visible_momentum)
+    all_momentum = visible_momentum + met
+
+    objects = {
+        "e": electrons,
+        "j": jets,
+        "a": photons,
+        "mu": muons,
+        "l": leptons,
+        "met": met,
+        "visible": visible_momentum,
+        "all": all_momentum,
+        "boost_to_com": _boost_to_com_columnar,
+    }
+
+    return objects
+
+
+def _boost_to_com_columnar(momentum):
+    raise ExpressionNotVectorizable("boost_to_com() is only available event by event")
+
+
+def _get_event_objects(i_event, electrons, jets, photons, muons, leptons, met):
+    """ Returns the variables of _get_objects() for one event, given the particles of all events as JaggedParticles """
+
+    electrons, jets, photons, muons, leptons, met = [
+        particles.to_particles(i_event) for particles in (electrons, jets, photons, muons, leptons, met)
+    ]
+    return _get_objects(electrons, jets, photons, muons, leptons, met[0])
+
+
+class _TreeBatch(object):
+    """ Gives access to the arrays of a range of events in a Delphes tree """
+
+    def __init__(self, tree, entry_start, entry_stop):
+        self.tree = tree
+        self.entry_start = entry_start
+        self.entry_stop = entry_stop
+
+    def array(self, name):
+        return self.tree.array(name, entrystart=self.entry_start, entrystop=self.entry_stop)
+
+
 def _get_n_events(tree):
     es = tree.array("Event")
     n_events = len(es)
@@ -344,6 +521,9 @@ def _get_particles_leptons(tree, pt_min_e, eta_max_e, pt_min_mu, eta_max_mu):
         event_pts = event_pts[order]
         event_etas = event_etas[order]
         event_phis = event_phis[order]
+        event_masses = event_masses[order]
+        event_charges = event_charges[order]
+        event_pdgid_positive_charges = event_pdgid_positive_charges[order]
 
         # Create particles
         for pt, eta, phi, mass, charge, pdgid_positive_charge in zip(
@@ -561,3 +741,161 @@ def _get_particles_met(tree):
         all_particles.append(event_particles)
 
     return all_particles
+
+
+def _get_jagged_particles(
+    pts, etas, phis, pdgids, pt_min=None, eta_max=None, masses=None, energies=None, tau_tags=None, b_tags=None
+):
+    """ Builds JaggedParticles from jagged arrays (one entry per event) of pT, eta, phi, PDG id, and either mass or
+    energy, keeping the particles that pass the acceptance cuts. PDG ids, masses, and tags can also be single
+    numbers. """
+
+    n_events = len(pts)
+    event_index = np.repeat(np.arange(n_events), pts.counts)
+    pt, eta, phi = [_flatten(values) for values in (pts, etas, phis)]
+
+    accepted = np.ones(len(pt), dtype=np.bool_)
+    if pt_min is not None:
+        accepted &= ~(pt < pt_min)
+    if eta_max is not None:
+        accepted &= ~(np.abs(eta) > eta_max)
+
+    # Same kinematics as MadMinerParticle.setptetaphim() and setptetaphie()
+    px = pt * np.cos(phi)
+    py = pt * np.sin(phi)
+    pz = pt * np.sinh(eta)
+    if energies is not None:
+        e = _flatten(energies, len(pt))
+    else:
+        m = _flatten(masses, len(pt))
+        e = np.sqrt(px ** 2 + py ** 2 + pz ** 2 + np.where(m > 0.0, m ** 2, -(m ** 2)))
+
+    particles = JaggedParticles(
+        px,
+        py,
+        pz,
+        e,
+        _flatten(pdgids, len(pt)),
+        event_index,
+        n_events,
+        tau_tag=None if tau_tags is None else _flatten(tau_tags, len(pt)) >= 1,
+        b_tag=None if b_tags is None else _flatten(b_tags, len(pt)) >= 1,
+    )
+    return particles.select(accepted)
+
+
+def _flatten(values, n=None):
+    """ Returns the content of a jagged array as flat float array, or repeats a single number n times """
+    if np.isscalar(values):
+        return np.full(n, values, dtype=np.float64)
+    if hasattr(values, "flatten"):
+        values = values.flatten()
+    return np.asarray(values, dtype=np.float64)
+
+
+def _merge_jagged_particles(*collections):
+    """ Combines several JaggedParticles into one, sorted by descending pT in each event """
+
+    merged = JaggedParticles(
+        *[
+            np.concatenate([getattr(particles, key) for particles in collections])
+            for key in ("px", "py", "pz", "e", "pdgid", "event_index")
+        ],
+        n_events=collections[0].n_events,
+        tau_tag=np.concatenate([particles.tau_tag for particles in collections]),
+        b_tag=np.concatenate([particles.b_tag for particles in collections])
+    )
+    return merged.sorted_by_pt()
+
+
+def _get_jagged_particles_truth(tree, pt_min, eta_max, included_pdgids=None):
+    pdgids = tree.array("Particle.PID")
+    particles = _get_jagged_particles(
+        tree.array("Particle.PT"),
+        tree.array("Particle.Eta"),
+        tree.array("Particle.Phi"),
+        pdgids,
+        pt_min,
+        eta_max,
+        energies=tree.array("Particle.E"),
+    )
+    if included_pdgids is not None:
+        particles = particles.select(np.isin(particles.pdgid, included_pdgids))
+    return particles
+
+
+def _get_jagged_particles_truth_leptons(tree, pt_min_e, eta_max_e, pt_min_mu, eta_max_mu):
+    pdgids = _flatten(tree.array("Particle.PID"))
+    electrons = np.isin(pdgids, [11, -11])
+    pt_min = np.where(
+        electrons, -np.inf if pt_min_e is None else pt_min_e, -np.inf if pt_min_mu is None else pt_min_mu
+    )
+    eta_max = np.where(
+        electrons, np.inf if eta_max_e is None else eta_max_e, np.inf if eta_max_mu is None else eta_max_mu
+    )
+
+    particles = _get_jagged_particles(
+        tree.array("Particle.PT"),
+        tree.array("Particle.Eta"),
+        tree.array("Particle.Phi"),
+        pdgids,
+        pt_min,
+        eta_max,
+        energies=tree.array("Particle.E"),
+    )
+    return particles.select(np.isin(particles.pdgid, [11, 13, -11, -13]))
+
+
+def _get_jagged_particles_charged(tree, name, mass, pdgid_positive_charge, pt_min, eta_max):
+    charges = _flatten(tree.array(name + ".Charge"))
+    return _get_jagged_particles(
+        tree.array(name + ".PT"),
+        tree.array(name + ".Eta"),
+        tree.array(name + ".Phi"),
+        np.where(charges >= 0.0, pdgid_positive_charge, -pdgid_positive_charge),
+        pt_min,
+        eta_max,
+        masses=mass,
+    )
+
+
+def _get_jagged_particles_photons(tree, pt_min, eta_max):
+    return _get_jagged_particles(
+        tree.array("Photon.PT"),
+        tree.array("Photon.Eta"),
+        tree.array("Photon.Phi"),
+        22,
+        pt_min,
+        eta_max,
+        energies=tree.array("Photon.E"),
+    )
+
+
+def _get_jagged_particles_jets(tree, name, pt_min, eta_max):
+    try:
+        tau_tags = tree.array(name + ".TauTag")
+    except KeyError:
+        logger.warning("Did not find tau-tag information for %s in Delphes ROOT file.", name)
+        tau_tags = 0
+    try:
+        b_tags = tree.array(name + ".BTag")
+    except KeyError:
+        logger.warning("Did not find b-tag information for %s in Delphes ROOT file.", name)
+        b_tags = 0
+
+    return _get_jagged_particles(
+        tree.array(name + ".PT"),
+        tree.array(name + ".Eta"),
+        tree.array(name + ".Phi"),
+        9,
+        pt_min,
+        eta_max,
+        masses=tree.array(name + ".Mass"),
+        tau_tags=tau_tags,
+        b_tags=b_tags,
+    )
+
+
+def _get_jagged_particles_met(tree, name):
+    mets = tree.array(name + ".MET")
+    return _get_jagged_particles(mets, np.zeros_like(_flatten(mets)), tree.array(name + ".Phi"), 0, masses=0.0)
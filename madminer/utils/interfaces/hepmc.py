@@ -1,22 +1,15 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import gzip
+import io
 import os
-from io import open
 import logging
-from madminer.utils.various import call_command
 
 logger = logging.getLogger(__name__)
 
 
 def extract_weight_order(filename, default_weight_label=None):
-    # Untar event file
-    new_filename, extension = os.path.splitext(filename)
-    if extension == ".gz":
-        if not os.path.exists(new_filename):
-            call_command("gunzip -c {} > {}".format(filename, new_filename))
-        filename = new_filename
-
-    with open(filename, encoding="latin-1") as file:
+    with _open_hepmc_file(filename) as file:
         for line in file:
             terms = line.replace('"', "").split()
 
@@ -53,3 +46,10 @@ def extract_weight_order(filename, default_weight_label=None):
     logger.debug("Did not find weight labels in HepMC file")
 
     return [default_weight_label]
+
+
+def _open_hepmc_file(filename):
+    # Compressed event files are decompressed on the fly while reading
+    if os.path.splitext(filename)[1] == ".gz":
+        return io.TextIOWrapper(gzip.open(filename, "rb"), encoding="latin-1")
+    return io.open(filename, encoding="latin-1")
@@ -3,7 +3,15 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import six
 import numpy as np
 from collections import OrderedDict
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
 import os
+import re
+import shutil
 import logging
 
 try:
@@ -15,11 +23,33 @@ except ImportError:
 
     use_celementtree = False
 
-from madminer.utils.various import call_command, approx_equal, math_commands
+from madminer.utils.various import (
+    approx_equal,
+    eval_expression,
+    compile_expression,
+    create_missing_folders,
+    get_fork_context,
+)
 from madminer.utils.particle import MadMinerParticle
+from madminer.utils.columnar import (
+    JaggedParticles,
+    ParticleColumns,
+    EventVariables,
+    evaluate_batch_expression,
+    evaluate_batch_function,
+)
 
 logger = logging.getLogger(__name__)
 
+# LHE file and parsing setup that forked worker processes use, see _parse_lhe_events_parallel
+_shared_event_parsing_setup = None
+
+# Header information of the LHE files read in this process, see _get_lhe_file_header
+_lhe_file_headers = {}
+
+# Version of the format of cached events, see _iterate_smeared_event_batches
+_event_cache_version = 1
+
 
 def parse_lhe_file(
     filename,
@@ -40,8 +70,19 @@ def parse_lhe_file(
     k_factor=1.0,
     parse_events_as_xml=True,
     systematics_dict=None,
+    columnar=False,
+    batch_size=10000,
+    n_processes=1,
+    cache_directory=None,
 ):
-    """ Extracts observables and weights from a LHE file """
+    """ Extracts observables and weights from a LHE file. With columnar=True, batches of batch_size events are read
+    into flat arrays, and smearing, object reconstruction, observables, cuts, and efficiencies are calculated for
+    each batch at once. Expressions that cannot be evaluated this way fall back to the per-event evaluation. With
+    n_processes=None or > 1, the file is split into byte ranges at event boundaries, which are parsed in parallel
+    worker processes (each with its own random seed for the smearing). With a cache_directory, the events are always
+    processed in the columnar way, and the parsed and smeared particles and the weights are stored in this folder
+    (keyed on the file content, the sampling benchmark, and the smearing settings), so that analysing the same file
+    again only has to calculate the observables, cuts, and efficiencies. """
 
     logger.debug("Parsing LHE file %s", filename)
 
@@ -70,64 +111,250 @@ def parse_lhe_file(
     if efficiencies_default_pass is None:
         efficiencies_default_pass = {key: 1.0 for key in six.iterkeys(efficiencies)}
 
-    # Untar and open LHE file
-    run_card = None
-    for elem in _untar_and_parse_lhe_file(filename):
-        if elem.tag == "MGRunCard":
-            run_card = elem.text
-            break
-        else:
-            continue
+    # Header information (read once and cached), if necessary rescale by number of events
+    header = _get_lhe_file_header(filename)
+    k_factor = _normalize_k_factor(k_factor, header)
+
+    # Cache of parsed events
+    cache_path = None
+    if cache_directory is not None:
+        create_missing_folders([cache_directory])
+        cache_path = _get_event_cache_path(
+            cache_directory,
+            header,
+            sampling_benchmark,
+            energy_resolutions,
+            pt_resolutions,
+            eta_resolutions,
+            phi_resolutions,
+        )
+        columnar = True
+
+    # Loop over events, in parallel over parts of the file if n_processes is None or larger than 1
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    if n_processes > 1 and multiprocessing.current_process().daemon:
+        logger.debug("Cannot start worker processes from a daemonic process, parsing LHE file in one process")
+        n_processes = 1
+    if n_processes > 1 and cache_path is not None:
+        logger.debug("Cached events are read and written in one process")
+        n_processes = 1
+
+    event_parsing_kwargs = {
+        "observables": observables,
+        "observables_required": observables_required,
+        "observables_defaults": observables_defaults,
+        "cuts": cuts,
+        "cuts_default_pass": cuts_default_pass,
+        "efficiencies": efficiencies,
+        "efficiencies_default_pass": efficiencies_default_pass,
+        "energy_resolutions": energy_resolutions,
+        "pt_resolutions": pt_resolutions,
+        "eta_resolutions": eta_resolutions,
+        "phi_resolutions": phi_resolutions,
+        "parse_events_as_xml": parse_events_as_xml,
+        "columnar": columnar,
+        "batch_size": batch_size,
+        "n_events_total": header.n_events if header.n_events is not None else header.n_events_runcard,
+        "cache_path": cache_path,
+    }
+
+    if n_processes > 1:
+        results = _parse_lhe_events_parallel(filename, sampling_benchmark, n_processes, event_parsing_kwargs)
+    else:
+        results = [_parse_lhe_events(filename, sampling_benchmark, **event_parsing_kwargs)]
 
-    # Figure out event weighting
-    weight_norm_is_average = None
-    n_events_runcard = None
-    for line in run_card.splitlines():
-        # Remove run card comments
-        try:
-            line, _ = line.split("!")
-        except:
-            pass
+    (
+        observations_all_events,
+        weights_all_events,
+        weight_names_all_events,
+        n_events_with_negative_weights,
+        pass_cuts,
+        fail_cuts,
+        pass_efficiencies,
+        fail_efficiencies,
+        avg_efficiencies,
+        n_events,
+    ) = _merge_lhe_event_results(results, columnar)
+    header.set_n_events(n_events)
 
-        # Separate in keys and values
-        try:
-            value, key = line.split("=")
-        except:
-            continue
+    # Check results
+    n_events_pass = _report_parse_results(
+        avg_efficiencies,
+        cuts,
+        efficiencies,
+        fail_cuts,
+        fail_efficiencies,
+        n_events_with_negative_weights,
+        observations_all_events,
+        pass_cuts,
+        pass_efficiencies,
+    )
 
-        # Remove spaces
-        value = value.strip()
-        key = key.strip()
+    if n_events_pass == 0:
+        logger.warning("  No observations remaining!")
+        return None, None
 
-        # Parse entries
-        if key == "nevents":
-            n_events_runcard = float(value)
-        if key == "event_norm":
-            weight_norm_is_average = value == "average"
+    # Reformat observations to OrderedDicts with entries {observable_name : (n_events,)}
+    if columnar:
+        observations_all_events = observations_all_events.T
+    else:
+        observations_all_events = list(map(list, zip(*observations_all_events)))  # transposes to (n_obs, n_events)
+    observations_dict = OrderedDict()
+    for key, values in zip(observables.keys(), observations_all_events):
+        observations_dict[key] = np.asarray(values)
 
-            logger.debug(
-                "Found entry event_norm = %s in LHE header. Interpreting this as weight_norm_is_average " "= %s.",
-                value,
-                weight_norm_is_average,
-            )
+    # Reformat weights, add k-factors, and re-organize them for background events and nuisance benchmarks
+    output_weights = _organize_weights(
+        np.array(weights_all_events),
+        weight_names_all_events,
+        sampling_benchmark,
+        benchmark_names,
+        is_background,
+        k_factor,
+        systematics_dict,
+    )
+
+    return observations_dict, output_weights
+
+
+def extract_weights_from_lhe_file(
+    filename, sampling_benchmark, benchmark_names, is_background=False, k_factor=1.0, systematics_dict=None
+):
+    """ Extracts only the weights of all events from a LHE file, with the same output as parse_lhe_file. The events
+    are not parsed: the event weights and the <wgt> entries are found with regular expressions in large blocks of the
+    file and written into a preallocated array. """
+
+    logger.debug("Extracting weights from LHE file %s", filename)
+
+    if k_factor is None:
+        k_factor = 1.0
+    if systematics_dict is None:
+        systematics_dict = OrderedDict()
+    if is_background and benchmark_names is None:
+        raise RuntimeError("Parsing background LHE files required benchmark names to be provided.")
+
+    header = _get_lhe_file_header(filename)
+    k_factor = _normalize_k_factor(k_factor, header)
+
+    weights_all_events, weight_names_all_events = _scan_lhe_weights(
+        filename, sampling_benchmark, header.n_events if header.n_events is not None else header.n_events_runcard
+    )
+    header.set_n_events(len(weights_all_events))
 
-    if weight_norm_is_average is None:
+    n_events_with_negative_weights = np.sum(np.any(weights_all_events < 0.0, axis=1))
+    if n_events_with_negative_weights > 0:
+        logger.warning("  %s events contain negative weights", n_events_with_negative_weights)
+
+    return _organize_weights(
+        weights_all_events,
+        weight_names_all_events,
+        sampling_benchmark,
+        benchmark_names,
+        is_background,
+        k_factor,
+        systematics_dict,
+    )
+
+
+def _normalize_k_factor(k_factor, header):
+    if header.weight_norm_is_average is None:
         logger.warning(
             "Cannot read weight normalization mode (entry 'event_norm') from LHE file header. MadMiner "
             "will continue assuming that events are properly normalized. Please check this!"
         )
 
-    # If necessary, rescale by number of events
-    if weight_norm_is_average:
-        if n_events_runcard is None:
+    if header.weight_norm_is_average:
+        if header.n_events_runcard is None:
             raise RuntimeError(
                 "LHE weights have to be normalized, but MadMiner cannot read number of events (entry "
                 "'nevents') from LHE file header."
             )
 
-        k_factor = k_factor / n_events_runcard
+        k_factor = k_factor / header.n_events_runcard
+
+    return k_factor
+
+
+def _organize_weights(
+    weights_all_events,
+    weight_names_all_events,
+    sampling_benchmark,
+    benchmark_names,
+    is_background,
+    k_factor,
+    systematics_dict,
+):
+    # Add k-factors to weights
+    weights_all_events = k_factor * weights_all_events  # (n_events, n_weights)
+    weights_all_events = OrderedDict(zip(weight_names_all_events, weights_all_events.T))
+
+    # Background events
+    if is_background:
+        for benchmark_name in benchmark_names:
+            weights_all_events[benchmark_name] = weights_all_events[sampling_benchmark]
+
+    # Re-organize weights again -- necessary for background events and nuisance benchmarks
+    output_weights = OrderedDict()
+    for benchmark_name in benchmark_names:
+        if is_background:
+            output_weights[benchmark_name] = weights_all_events[sampling_benchmark]
+        else:
+            output_weights[benchmark_name] = weights_all_events[benchmark_name]
+    for syst_name, syst_data in six.iteritems(systematics_dict):
+        for (
+            nuisance_param_name,
+            ((nuisance_benchmark0, weight_name0), (nuisance_benchmark1, weight_name1), processing),
+        ) in six.iteritems(syst_data):
+            # Store first benchmark associated with nuisance param
+            if weight_name0 is None:
+                weight_name0 = sampling_benchmark
+            if processing is None:
+                output_weights[nuisance_benchmark0] = weights_all_events[weight_name0]
+            elif isinstance(processing, float):
+                output_weights[nuisance_benchmark0] = processing * weights_all_events[weight_name0]
+            else:
+                raise RuntimeError("Unknown nuisance processiing {}".format(processing))
 
-    # Loop over events
+            # Store second benchmark associated with nuisance param
+            if nuisance_benchmark1 is None or weight_name1 is None:
+                continue
+            if processing is None:
+                output_weights[nuisance_benchmark1] = weights_all_events[weight_name1]
+            elif isinstance(processing, float):
+                output_weights[nuisance_benchmark1] = processing * weights_all_events[weight_name1]
+            else:
+                raise RuntimeError("Unknown nuisance processing {}".format(processing))
+
+    return output_weights
+
+
+def _parse_lhe_events(
+    filename,
+    sampling_benchmark,
+    observables,
+    observables_required,
+    observables_defaults,
+    cuts,
+    cuts_default_pass,
+    efficiencies,
+    efficiencies_default_pass,
+    energy_resolutions,
+    pt_resolutions,
+    eta_resolutions,
+    phi_resolutions,
+    parse_events_as_xml=True,
+    columnar=False,
+    batch_size=10000,
+    n_events_total=None,
+    byte_range=None,
+    cache_path=None,
+):
+    """ Parses the events in a LHE file, or only those in the byte range (start, end) of the (uncompressed) file, and
+    returns the observations and weights of the events that pass all cuts and efficiencies, the weight names, the
+    cut and efficiency statistics, and the number of parsed events """
+
+    n_events = 0
     n_events_with_negative_weights = 0
     pass_cuts = [0 for _ in cuts]
     fail_cuts = [0 for _ in cuts]
@@ -139,12 +366,76 @@ def parse_lhe_file(
     weights_all_events = []
     weight_names_all_events = None
 
-    # Option one: XML parsing
-    if parse_events_as_xml:
-        events = _untar_and_parse_lhe_file(filename, ["event"])
+    # Option one: columnar parsing of batches of events
+    if columnar:
+        for batch in _iterate_smeared_event_batches(
+            filename,
+            sampling_benchmark,
+            batch_size,
+            parse_events_as_xml,
+            byte_range,
+            energy_resolutions,
+            pt_resolutions,
+            eta_resolutions,
+            phi_resolutions,
+            cache_path,
+        ):
+            particles, particles_smeared, met_noise, weights, weight_names, global_event_data = batch
+            if (n_events + len(weights)) // 100000 > n_events // 100000:
+                logger.info("  Processing event %d/%d", n_events + len(weights), n_events_total)
+            n_events += len(weights)
+
+            if weight_names_all_events is None:
+                weight_names_all_events = weight_names
+            elif weight_names != weight_names_all_events:
+                raise RuntimeError(
+                    "Inconsistent weights in LHE file: {} vs {}".format(weight_names, weight_names_all_events)
+                )
+
+            n_events_with_negative_weights, observations, weights = _parse_event_batch(
+                avg_efficiencies,
+                cuts,
+                cuts_default_pass,
+                efficiencies,
+                efficiencies_default_pass,
+                fail_cuts,
+                fail_efficiencies,
+                n_events_with_negative_weights,
+                observables,
+                observables_defaults,
+                observables_required,
+                particles,
+                particles_smeared,
+                met_noise,
+                pass_cuts,
+                pass_efficiencies,
+                weight_names_all_events,
+                weights,
+                global_event_data=global_event_data,
+            )
+
+            # Store results of events that pass everything
+            observations_all_events.append(observations)
+            weights_all_events.append(weights)
+
+        observations_all_events = (
+            np.concatenate(observations_all_events, axis=0)
+            if len(observations_all_events) > 0
+            else np.zeros((0, len(observables)))
+        )
+        weights_all_events = (
+            np.concatenate(weights_all_events, axis=0)
+            if len(weights_all_events) > 0
+            else np.zeros((0, 0 if weight_names_all_events is None else len(weight_names_all_events)))
+        )
+
+    # Option two: XML parsing
+    elif parse_events_as_xml:
+        events = _untar_and_parse_lhe_file(filename, ["event"], byte_range)
         for i_event, event in enumerate(events):
             if (i_event + 1) % 100000 == 0:
-                logger.info("  Processing event %d/%d", i_event + 1, n_events_runcard)
+                logger.info("  Processing event %d/%d", i_event + 1, n_events_total)
+            n_events += 1
 
             # Parse event
             particles, weights, global_event_data = _parse_xml_event(event, sampling_benchmark)
@@ -181,12 +472,15 @@ def parse_lhe_file(
             observations_all_events.append(observations)
             weights_all_events.append(weights)
 
-    # Option two: text parsing
+    # Option three: text parsing
     else:
         # Iterate over events in LHE file
-        for i_event, (particles, weights) in enumerate(_parse_txt_events(filename, sampling_benchmark)):
+        for i_event, (particles, weights, global_event_data) in enumerate(
+            _parse_txt_events(filename, sampling_benchmark, byte_range)
+        ):
             if (i_event + 1) % 100000 == 0:
-                logger.info("  Processing event %d/%d", i_event + 1, n_events_runcard)
+                logger.info("  Processing event %d/%d", i_event + 1, n_events_total)
+            n_events += 1
 
             n_events_with_negative_weights, observations, pass_all, weight_names_all_events, weights = _parse_event(
                 avg_efficiencies,
@@ -209,6 +503,7 @@ def parse_lhe_file(
                 pt_resolutions,
                 weight_names_all_events,
                 weights,
+                global_event_data=global_event_data,
                 print_event=i_event + 1 if i_event < 20 else 0,
             )
 
@@ -220,72 +515,128 @@ def parse_lhe_file(
             observations_all_events.append(observations)
             weights_all_events.append(weights)
 
-    # Check results
-    n_events_pass = _report_parse_results(
-        avg_efficiencies,
-        cuts,
-        efficiencies,
-        fail_cuts,
-        fail_efficiencies,
-        n_events_with_negative_weights,
+    return (
         observations_all_events,
+        weights_all_events,
+        weight_names_all_events,
+        n_events_with_negative_weights,
         pass_cuts,
+        fail_cuts,
         pass_efficiencies,
+        fail_efficiencies,
+        avg_efficiencies,
+        n_events,
     )
 
-    if n_events_pass == 0:
-        logger.warning("  No observations remaining!")
-        return None, None
 
-    # Reformat observations to OrderedDicts with entries {observable_name : (n_events,)}
-    observations_all_events = list(map(list, zip(*observations_all_events)))  # transposes to (n_observables, n_events)
-    observations_dict = OrderedDict()
-    for key, values in zip(observables.keys(), observations_all_events):
-        observations_dict[key] = np.asarray(values)
+def _parse_lhe_events_parallel(filename, sampling_benchmark, n_processes, kwargs):
+    """ Splits the LHE file into byte ranges at event boundaries and parses them in parallel. For compressed files, the
+    byte ranges refer to the decompressed stream. """
 
-    # Reformat weights and add k-factors to weights
-    weights_all_events = np.array(weights_all_events)  # (n_events, n_weights)
-    weights_all_events = k_factor * weights_all_events
-    weights_all_events = OrderedDict(zip(weight_names_all_events, weights_all_events.T))
+    global _shared_event_parsing_setup
 
-    # Background events
-    if is_background:
-        for benchmark_name in benchmark_names:
-            weights_all_events[benchmark_name] = weights_all_events[sampling_benchmark]
+    byte_ranges = _find_event_byte_ranges(filename, n_processes)
+    if len(byte_ranges) <= 1:
+        return [_parse_lhe_events(filename, sampling_benchmark, byte_range=None, **kwargs)]
+    logger.info("Parsing LHE file in %s parts in parallel", len(byte_ranges))
 
-    # Re-organize weights again -- necessary for background events and nuisance benchmarks
-    output_weights = OrderedDict()
-    for benchmark_name in benchmark_names:
-        if is_background:
-            output_weights[benchmark_name] = weights_all_events[sampling_benchmark]
-        else:
-            output_weights[benchmark_name] = weights_all_events[benchmark_name]
-    for syst_name, syst_data in six.iteritems(systematics_dict):
-        for (
-            nuisance_param_name,
-            ((nuisance_benchmark0, weight_name0), (nuisance_benchmark1, weight_name1), processing),
-        ) in six.iteritems(syst_data):
-            # Store first benchmark associated with nuisance param
-            if weight_name0 is None:
-                weight_name0 = sampling_benchmark
-            if processing is None:
-                output_weights[nuisance_benchmark0] = weights_all_events[weight_name0]
-            elif isinstance(processing, float):
-                output_weights[nuisance_benchmark0] = processing * weights_all_events[weight_name0]
-            else:
-                raise RuntimeError("Unknown nuisance processiing {}".format(processing))
+    _shared_event_parsing_setup = (filename, sampling_benchmark, byte_ranges, kwargs)
+    context = get_fork_context()
+    pool = context.Pool(processes=len(byte_ranges))
 
-            # Store second benchmark associated with nuisance param
-            if nuisance_benchmark1 is None or weight_name1 is None:
-                continue
-            if processing is None:
-                output_weights[nuisance_benchmark1] = weights_all_events[weight_name1]
-            elif isinstance(processing, float):
-                output_weights[nuisance_benchmark1] = processing * weights_all_events[weight_name1]
-            else:
-                raise RuntimeError("Unknown nuisance processing {}".format(processing))
+    try:
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=len(byte_ranges))
+        results = pool.map(_parse_lhe_events_in_worker, list(zip(range(len(byte_ranges)), seeds)), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _shared_event_parsing_setup = None
 
-    return observations_dict, output_weights
+    return results
+
+
+def _parse_lhe_events_in_worker(args):
+    i_range, seed = args
+    filename, sampling_benchmark, byte_ranges, kwargs = _shared_event_parsing_setup
+
+    # Forked workers inherit the random state of the main process, so each part gets its own seed for the smearing
+    np.random.seed(seed)
+
+    return _parse_lhe_events(filename, sampling_benchmark, byte_range=byte_ranges[i_range], **kwargs)
+
+
+def _merge_lhe_event_results(results, columnar):
+    observations_all_events = []
+    weights_all_events = []
+    weight_names_all_events = None
+    n_events = 0
+    n_events_with_negative_weights = 0
+    pass_cuts, fail_cuts, pass_efficiencies, fail_efficiencies, avg_efficiencies = None, None, None, None, None
+
+    for result in results:
+        (
+            observations,
+            weights,
+            weight_names,
+            n_negative,
+            this_pass_cuts,
+            this_fail_cuts,
+            this_pass_efficiencies,
+            this_fail_efficiencies,
+            this_avg_efficiencies,
+            this_n_events,
+        ) = result
+
+        if weight_names is not None:
+            if weight_names_all_events is None:
+                weight_names_all_events = weight_names
+            elif weight_names != weight_names_all_events:
+                raise RuntimeError(
+                    "Inconsistent weights in LHE file: {} vs {}".format(weight_names, weight_names_all_events)
+                )
+
+        if columnar:
+            if len(observations) > 0:
+                observations_all_events.append(observations)
+                weights_all_events.append(weights)
+        else:
+            observations_all_events += observations
+            weights_all_events += weights
+
+        n_events += this_n_events
+        n_events_with_negative_weights += n_negative
+        if pass_cuts is None:
+            pass_cuts, fail_cuts = this_pass_cuts, this_fail_cuts
+            pass_efficiencies, fail_efficiencies, avg_efficiencies = (
+                this_pass_efficiencies,
+                this_fail_efficiencies,
+                this_avg_efficiencies,
+            )
+        else:
+            pass_cuts = [a + b for a, b in zip(pass_cuts, this_pass_cuts)]
+            fail_cuts = [a + b for a, b in zip(fail_cuts, this_fail_cuts)]
+            pass_efficiencies = [a + b for a, b in zip(pass_efficiencies, this_pass_efficiencies)]
+            fail_efficiencies = [a + b for a, b in zip(fail_efficiencies, this_fail_efficiencies)]
+            avg_efficiencies = [a + b for a, b in zip(avg_efficiencies, this_avg_efficiencies)]
+
+    if columnar:
+        observations_all_events = (
+            np.concatenate(observations_all_events, axis=0) if len(observations_all_events) > 0 else np.zeros((0, 0))
+        )
+        weights_all_events = np.concatenate(weights_all_events, axis=0) if len(weights_all_events) > 0 else None
+
+    return (
+        observations_all_events,
+        weights_all_events,
+        weight_names_all_events,
+        n_events_with_negative_weights,
+        pass_cuts,
+        fail_cuts,
+        pass_efficiencies,
+        fail_efficiencies,
+        avg_efficiencies,
+        n_events,
+    )
 
 
 def _report_parse_results(
@@ -410,7 +761,7 @@ def _parse_observations(observables, observables_defaults, observables_required,
     for obs_name, obs_definition in six.iteritems(observables):
         if isinstance(obs_definition, six.string_types):
             try:
-                observations.append(eval(obs_definition, variables))
+                observations.append(eval_expression(compile_expression(obs_definition), variables))
             except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
                 if observables_required[obs_name]:
                     pass_all_observation = False
@@ -445,7 +796,7 @@ def _parse_efficiencies(
     pass_all_efficiencies = True
     for i_efficiency, (efficiency, default_pass) in enumerate(zip(efficiencies, efficiencies_default_pass)):
         try:
-            efficiency_result = eval(efficiency, variables)
+            efficiency_result = eval_expression(compile_expression(efficiency), variables)
             if efficiency_result > 0.0:
                 pass_efficiencies[i_efficiency] += 1
                 total_efficiency *= efficiency_result
@@ -454,38 +805,157 @@ def _parse_efficiencies(
                 fail_efficiencies[i_efficiency] += 1
                 pass_all_efficiencies = False
 
-        except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
-            if default_pass > 0.0:
-                pass_efficiencies[i_efficiency] += 1
-                total_efficiency *= default_pass
-                avg_efficiencies[i_efficiency] += default_pass
-            else:
-                fail_efficiencies[i_efficiency] += 1
-                pass_all_efficiencies = False
-    return pass_all_efficiencies, total_efficiency
+        except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
+            if default_pass > 0.0:
+                pass_efficiencies[i_efficiency] += 1
+                total_efficiency *= default_pass
+                avg_efficiencies[i_efficiency] += default_pass
+            else:
+                fail_efficiencies[i_efficiency] += 1
+                pass_all_efficiencies = False
+    return pass_all_efficiencies, total_efficiency
+
+
+def _parse_cuts(cuts, cuts_default_pass, fail_cuts, observables, observations, pass_all_cuts, pass_cuts, variables):
+    # Objects for cuts
+    for obs_name, obs_value in zip(observables.keys(), observations):
+        variables[obs_name] = obs_value
+    # Check cuts
+    for i_cut, (cut, default_pass) in enumerate(zip(cuts, cuts_default_pass)):
+        try:
+            cut_result = eval_expression(compile_expression(cut), variables)
+            if cut_result:
+                pass_cuts[i_cut] += 1
+            else:
+                fail_cuts[i_cut] += 1
+                pass_all_cuts = False
+
+        except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
+            if default_pass:
+                pass_cuts[i_cut] += 1
+            else:
+                fail_cuts[i_cut] += 1
+                pass_all_cuts = False
+    return pass_all_cuts
+
+
+def _parse_event_batch(
+    avg_efficiencies,
+    cuts,
+    cuts_default_pass,
+    efficiencies,
+    efficiencies_default_pass,
+    fail_cuts,
+    fail_efficiencies,
+    n_events_with_negative_weights,
+    observables,
+    observables_defaults,
+    observables_required,
+    particles,
+    particles_smeared,
+    met_noise,
+    pass_cuts,
+    pass_efficiencies,
+    weight_names,
+    weights,
+    global_event_data=None,
+):
+    """ Columnar version of _parse_event() for a batch of events, given the true and smeared particles and the MET
+    noise. Returns the observations and weights of the events that pass all cuts and efficiencies. """
+
+    n_events = len(weights)
+
+    # Negative weights?
+    n_events_with_negative_weights = _report_negative_weights_batch(
+        n_events_with_negative_weights, weights, weight_names
+    )
+
+    # Objects in events
+    objects = _get_columnar_objects(
+        particles_smeared, particles, global_event_data=global_event_data, met_noise=met_noise
+    )
+    event_variables = EventVariables(lambda i_event: _get_event_objects(i_event, objects))
+
+    # Observables
+    observations = np.zeros((n_events, len(observables)))
+    pass_all_observation = np.ones(n_events, dtype=np.bool_)
+    for i_obs, (obs_name, obs_definition) in enumerate(six.iteritems(observables)):
+        if isinstance(obs_definition, six.string_types):
+            values, valid = evaluate_batch_expression(obs_definition, objects, event_variables, n_events)
+        else:
+            values, valid = evaluate_batch_function(
+                obs_definition, event_variables, n_events, ["p_truth", "l", "a", "j", "met"]
+            )
+
+        if observables_required[obs_name]:
+            pass_all_observation &= valid
 
+        default = observables_defaults[obs_name]
+        if default is None:
+            default = np.nan
+        observations[:, i_obs] = np.where(valid, values, default)
 
-def _parse_cuts(cuts, cuts_default_pass, fail_cuts, observables, observations, pass_all_cuts, pass_cuts, variables):
-    # Objects for cuts
-    for obs_name, obs_value in zip(observables.keys(), observations):
-        variables[obs_name] = obs_value
-    # Check cuts
+    # Cuts
+    pass_all_cuts = np.ones(n_events, dtype=np.bool_)
+    cut_objects = dict(objects)
+    for obs_name, values in zip(observables.keys(), observations.T):
+        cut_objects[obs_name] = values
+        event_variables.columns[obs_name] = values
     for i_cut, (cut, default_pass) in enumerate(zip(cuts, cuts_default_pass)):
-        try:
-            cut_result = eval(cut, variables)
-            if cut_result:
-                pass_cuts[i_cut] += 1
-            else:
-                fail_cuts[i_cut] += 1
-                pass_all_cuts = False
+        values, valid = evaluate_batch_expression(cut, cut_objects, event_variables, n_events, pass_all_observation)
+        cut_result = np.where(valid, values != 0.0, bool(default_pass))
+        pass_cuts[i_cut] += int(np.sum(pass_all_observation & cut_result))
+        fail_cuts[i_cut] += int(np.sum(pass_all_observation & ~cut_result))
+        pass_all_cuts &= cut_result
 
-        except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
-            if default_pass:
-                pass_cuts[i_cut] += 1
-            else:
-                fail_cuts[i_cut] += 1
-                pass_all_cuts = False
-    return pass_all_cuts
+    # Efficiencies
+    selected = pass_all_observation & pass_all_cuts
+    total_efficiency = np.ones(n_events)
+    pass_all_efficiencies = np.ones(n_events, dtype=np.bool_)
+    for i_efficiency, (efficiency, default_pass) in enumerate(zip(efficiencies, efficiencies_default_pass)):
+        values, valid = evaluate_batch_expression(efficiency, cut_objects, event_variables, n_events, selected)
+        efficiency_result = np.where(valid, values, default_pass)
+        passed = efficiency_result > 0.0
+        pass_efficiencies[i_efficiency] += int(np.sum(selected & passed))
+        fail_efficiencies[i_efficiency] += int(np.sum(selected & ~passed))
+        avg_efficiencies[i_efficiency] += float(np.sum(efficiency_result[selected & passed]))
+        total_efficiency = np.where(passed, total_efficiency * efficiency_result, total_efficiency)
+        pass_all_efficiencies &= passed
+
+    pass_all = selected & pass_all_efficiencies
+    weights = weights[pass_all] * total_efficiency[pass_all, np.newaxis]
+
+    return n_events_with_negative_weights, observations[pass_all], weights
+
+
+def _get_event_objects(i_event, objects):
+    """ Returns the variables of _get_objects() for one event, given the objects of _get_columnar_objects() """
+
+    global_event_data = {
+        key: float(value[i_event]) for key, value in six.iteritems(objects) if isinstance(value, np.ndarray)
+    }
+    variables = _get_objects(
+        objects["p"].to_particles(i_event),
+        objects["p_truth"].to_particles(i_event),
+        met_resolution=None,
+        global_event_data=global_event_data,
+    )
+    variables["met"] = objects["met"].to_particle(i_event)
+    return variables
+
+
+def _report_negative_weights_batch(n_events_with_negative_weights, weights, weight_names):
+    events_with_negative_weights = np.where(np.any(weights < 0.0, axis=1))[0]
+    n_warnings = max(0, 3 - n_events_with_negative_weights)
+    for k, i_event in enumerate(events_with_negative_weights[:n_warnings]):
+        logger.warning(
+            "Found %s negative weights in event. Weights: %s",
+            np.sum(weights[i_event] < 0.0),
+            OrderedDict(zip(weight_names, weights[i_event])),
+        )
+        if n_events_with_negative_weights + k + 1 == 3:
+            logger.warning("Skipping warnings about negative weights from now on...")
+    return n_events_with_negative_weights + len(events_with_negative_weights)
 
 
 def extract_nuisance_parameters_from_lhe_file(filename, systematics):
@@ -504,16 +974,8 @@ def extract_nuisance_parameters_from_lhe_file(filename, systematics):
     # Parse scale factors from strings in systematics
     logger.debug("Systematics setup: %s", systematics)
 
-    # Untar and parse LHE file
-    initrwgts = _untar_and_parse_lhe_file(filename, ["initrwgt"])
-
-    # Find weight groups
-    weight_groups = []
-    try:
-        for initrwgt in initrwgts:
-            weight_groups += initrwgt.findall("weightgroup")
-    except KeyError as e:
-        raise RuntimeError("Could not find weight groups in LHE file!\n%s", e)
+    # Find weight groups (read once from the LHE header and cached)
+    weight_groups = _get_lhe_file_header(filename).weight_groups
     # if len(weight_groups) == 0:
     #     raise RuntimeError("Zero weight groups in LHE file!")
     logger.debug("%s weight groups", len(weight_groups))
@@ -733,10 +1195,11 @@ def _parse_xml_event(event, sampling_benchmark):
     return particles, weights, global_event_data
 
 
-def _parse_txt_events(filename, sampling_benchmark):
+def _parse_txt_events(filename, sampling_benchmark, byte_range=None):
     # Initialize weights and momenta
     weights = OrderedDict()
     particles = []
+    global_event_data = {}
 
     # Some tags so that we know where in the event we are
     do_tag = False
@@ -749,96 +1212,579 @@ def _parse_txt_events(filename, sampling_benchmark):
     reset_event = False
 
     # Loop through lines in Event
-    with open(filename, "r") as file:
-        for line in file.readlines():
-            # Clean up line
+    for line in _read_lhe_lines(filename, byte_range):
+        # Clean up line
+        try:
+            line = line.split("#")[0]
+        except:
+            pass
+        line = line.strip()
+        elements = line.split()
+
+        # Skip empty/commented out lines
+        if len(line) == 0 or len(elements) == 0:
+            continue
+
+        # End of LHE file
+        elif line == "</LesHouchesEvents>":
+            return
+
+        # Beginning of event
+        elif line == "<event>":
+            # Initialize weights and momenta
+            weights = OrderedDict()
+            particles = []
+            global_event_data = {}
+
+            # Some tags so that we know where in the event we are
+            do_tag = True
+            do_momenta = False
+            do_reweight = False
+
+        # End of event
+        elif line == "</event>":
+            n_events += 1
+            yield particles, weights, global_event_data
+
+            # Reset weights and momenta
+            weights = OrderedDict()
+            particles = []
+            global_event_data = {}
+
+            # Some tags so that we know where in the event we are
+            do_tag = False
+            do_momenta = False
+            do_reweight = False
+
+        # Beginning of unimportant block
+        elif line == "<mgrwt>":
+            do_tag = False
+            do_momenta = False
+            do_reweight = False
+
+        # Beginning of weight block
+        elif line == "<rwgt>":
+            do_tag = False
+            do_momenta = False
+            do_reweight = True
+
+        # End of weight block
+        elif line == "</rwgt>":
+            do_tag = False
+            do_momenta = False
+            do_reweight = False
+
+        # Read tag -> first weight and global event data
+        elif do_tag:
+            global_event_data["n_particles"] = float(elements[0])
+            weights[sampling_benchmark] = float(elements[2])
+            global_event_data["scale"] = float(elements[3])
+            global_event_data["alpha_qed"] = float(elements[4])
+            global_event_data["alpha_qcd"] = float(elements[5])
+
+            do_tag = False
+            do_momenta = True
+            do_reweight = False
+
+        # Read Momenta and store as 4-vector
+        elif do_momenta:
+            status = int(elements[1])
+            if status == 1:
+                pdgid = int(elements[0])
+                px = float(elements[6])
+                py = float(elements[7])
+                pz = float(elements[8])
+                e = float(elements[9])
+                spin = float(elements[12])
+                particle = MadMinerParticle()
+                particle.setpxpypze(px, py, pz, e)
+                particle.set_pdgid(pdgid)
+                particle.set_spin(spin)
+                particles.append(particle)
+
+        # Read reweighted weights
+        elif do_reweight:
+            rwgtid = line[line.find("<") + 1 : line.find(">")].split("=")[1][1:-1]
+            rwgtval = float(line[line.find(">") + 1 : line.find("<", line.find("<") + 1)])
+            weights[rwgtid] = rwgtval
+
+
+def _iterate_smeared_event_batches(
+    filename,
+    sampling_benchmark,
+    batch_size,
+    parse_events_as_xml,
+    byte_range,
+    energy_resolutions,
+    pt_resolutions,
+    eta_resolutions,
+    phi_resolutions,
+    cache_path=None,
+):
+    """ Yields batches of events as tuples (particles, smeared particles, MET noise, weights, weight names, global
+    event data). With a cache_path, the batches are read from the cache if it exists, and are otherwise written to it
+    after all events have been parsed. Cached events keep their smearing. """
+
+    if cache_path is not None and os.path.exists(os.path.join(cache_path, "events.json")):
+        logger.info("  Reading parsed events from cache %s", cache_path)
+        for batch in _load_cached_event_batches(cache_path):
+            yield batch
+        return
+
+    # Events are written into a temporary folder, which is renamed once it is complete
+    temp_path = None
+    if cache_path is not None:
+        temp_path = "{}.tmp{}".format(cache_path, os.getpid())
+        create_missing_folders([temp_path])
+
+    try:
+        met_resolution = pt_resolutions["met"]
+    except (TypeError, IndexError):
+        met_resolution = None
+
+    try:
+        n_batches, weight_names = 0, None
+        for particles, weights, weight_names, global_event_data in _parse_event_batches(
+            filename, sampling_benchmark, batch_size, parse_events_as_xml, byte_range
+        ):
+            particles_smeared = _smear_particle_columns(
+                particles, energy_resolutions, pt_resolutions, eta_resolutions, phi_resolutions
+            )
+            met_noise = _draw_met_noise(particles_smeared, met_resolution)
+            batch = particles, particles_smeared, met_noise, weights, weight_names, global_event_data
+
+            if temp_path is not None:
+                _save_cached_event_batch(
+                    temp_path, n_batches, particles, particles_smeared, met_noise, weights, global_event_data
+                )
+                n_batches += 1
+
+            yield batch
+
+        if temp_path is not None:
+            with open(os.path.join(temp_path, "events.json"), "w") as file:
+                json.dump({"n_batches": n_batches, "weight_names": weight_names}, file)
             try:
-                line = line.split("#")[0]
-            except:
-                pass
-            line = line.strip()
-            elements = line.split()
+                os.rename(temp_path, cache_path)
+                logger.debug("Saved parsed events in cache %s", cache_path)
+            except OSError:
+                logger.debug("Could not save parsed events in cache %s", cache_path)
+
+    finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def _get_event_cache_path(
+    cache_directory, header, sampling_benchmark, energy_resolutions, pt_resolutions, eta_resolutions, phi_resolutions
+):
+    # Cached events depend on the file content, the name of the first weight, and the smearing
+    settings = [_event_cache_version, header.content_hash, sampling_benchmark]
+    for resolutions in [energy_resolutions, pt_resolutions, eta_resolutions, phi_resolutions]:
+        if resolutions is None:
+            settings.append(None)
+        else:
+            settings.append(sorted((str(key), value) for key, value in six.iteritems(resolutions)))
+    key = hashlib.sha1(repr(settings).encode("utf-8")).hexdigest()
+
+    return os.path.join(cache_directory, "{}_{}".format(os.path.basename(header.filename), key[:16]))
+
+
+def _save_cached_event_batch(path, i_batch, particles, particles_smeared, met_noise, weights, global_event_data):
+    arrays = {
+        "weights": weights,
+        "n_events": np.array(particles.n_events),
+        "met_noise_x": met_noise[0],
+        "met_noise_y": met_noise[1],
+    }
+    for prefix, these_particles in [("particles", particles), ("particles_smeared", particles_smeared)]:
+        for key in ["px", "py", "pz", "e", "pdgid", "event_index", "spin"]:
+            arrays["{}_{}".format(prefix, key)] = getattr(these_particles, key)
+    for key, values in six.iteritems(global_event_data):
+        arrays["global_{}".format(key)] = values
+
+    np.savez(os.path.join(path, "batch_{}.npz".format(i_batch)), **arrays)
+
+
+def _load_cached_event_batches(path):
+    with open(os.path.join(path, "events.json"), "r") as file:
+        info = json.load(file)
+    weight_names = [str(weight_name) for weight_name in info["weight_names"]]
+
+    for i_batch in range(info["n_batches"]):
+        with np.load(os.path.join(path, "batch_{}.npz".format(i_batch))) as data:
+            n_events = int(data["n_events"])
+            particles, particles_smeared = [
+                JaggedParticles(
+                    data[prefix + "_px"],
+                    data[prefix + "_py"],
+                    data[prefix + "_pz"],
+                    data[prefix + "_e"],
+                    data[prefix + "_pdgid"],
+                    data[prefix + "_event_index"],
+                    n_events,
+                    spin=data[prefix + "_spin"],
+                )
+                for prefix in ["particles", "particles_smeared"]
+            ]
+            met_noise = data["met_noise_x"], data["met_noise_y"]
+            global_event_data = {key[7:]: data[key] for key in data.files if key.startswith("global_")}
+            weights = data["weights"]
+
+        yield particles, particles_smeared, met_noise, weights, weight_names, global_event_data
+
+
+def _parse_event_batches(filename, sampling_benchmark, batch_size, parse_events_as_xml=True, byte_range=None):
+    """ Reads batches of events and yields for each batch the final-state particles as JaggedParticles, the weights
+    with shape (n_events, n_weights), the weight names, and a dict of global event data arrays """
+
+    if parse_events_as_xml:
+        events = _iterate_xml_event_blocks(filename, byte_range)
+    else:
+        events = _iterate_txt_event_blocks(filename, byte_range)
+
+    tag_lines, particle_lines, n_particle_lines, weights, weight_names = [], [], [], [], None
+
+    for tag_line, this_particle_lines, this_weights in events:
+        # Same semantics as the per-event parsers (a weight with the id of the sampling benchmark overwrites the
+        # first weight)
+        event_weights = OrderedDict()
+        event_weights[sampling_benchmark] = float(tag_line[2])
+        for weight_id, weight_value in this_weights:
+            event_weights[weight_id] = weight_value
+        if weight_names is None:
+            weight_names = list(event_weights.keys())
+
+        tag_lines.append(tag_line[:6])
+        particle_lines += this_particle_lines
+        n_particle_lines.append(len(this_particle_lines))
+        weights.append(list(event_weights.values()))
+
+        if len(tag_lines) >= batch_size:
+            yield _make_event_batch(tag_lines, particle_lines, n_particle_lines, weights, weight_names)
+            tag_lines, particle_lines, n_particle_lines, weights = [], [], [], []
+
+    if len(tag_lines) > 0:
+        yield _make_event_batch(tag_lines, particle_lines, n_particle_lines, weights, weight_names)
+
+
+def _make_event_batch(tag_lines, particle_lines, n_particle_lines, weights, weight_names):
+    n_events = len(tag_lines)
+
+    # Global event data from tag lines
+    tags = np.array(tag_lines, dtype=np.float64).reshape((n_events, 6))
+    global_event_data = {
+        "n_particles": tags[:, 0],
+        "scale": tags[:, 3],
+        "alpha_qed": tags[:, 4],
+        "alpha_qcd": tags[:, 5],
+    }
+
+    # Particle table with columns pdgid, status, mothers, colors, px, py, pz, E, m, lifetime, spin
+    particle_data = np.array(particle_lines, dtype=np.float64).reshape((-1, 13))
+    event_index = np.repeat(np.arange(n_events), n_particle_lines)
+    final_state = particle_data[:, 1] == 1
+    particles = JaggedParticles(
+        px=particle_data[final_state, 6],
+        py=particle_data[final_state, 7],
+        pz=particle_data[final_state, 8],
+        e=particle_data[final_state, 9],
+        pdgid=particle_data[final_state, 0],
+        event_index=event_index[final_state],
+        n_events=n_events,
+        spin=particle_data[final_state, 12],
+    )
+
+    weights = np.array(weights, dtype=np.float64)
+    if weights.ndim != 2 or weights.shape[1] != len(weight_names):
+        raise RuntimeError("Inconsistent number of weights in LHE events")
+
+    return particles, weights, weight_names, global_event_data
+
 
-            # Skip empty/commented out lines
-            if len(line) == 0 or len(elements) == 0:
+def _iterate_xml_event_blocks(filename, byte_range=None):
+    """ Yields the tag line, particle lines (as lists of the first 13 entries), and (weight id, weight) pairs for each
+    event, using the XML parser """
+
+    for event in _untar_and_parse_lhe_file(filename, ["event"], byte_range):
+        tag_line = None
+        particle_lines = []
+        for line in event.text.splitlines():
+            elements = line.split()
+            if len(elements) < 2:
                 continue
+            if tag_line is None:
+                tag_line = elements
+            elif len(elements) >= 13:
+                particle_lines.append(elements[:13])
+        assert tag_line is not None
+
+        weights = []
+        if event.find("rwgt") is not None:
+            for weight in event.find("rwgt").findall("wgt"):
+                weights.append((weight.attrib["id"], float(weight.text)))
+
+        yield tag_line, particle_lines, weights
+
+
+def _iterate_txt_event_blocks(filename, byte_range=None):
+    """ Yields the tag line, particle lines (as lists of the first 13 entries), and (weight id, weight) pairs for each
+    event, parsing the file as text """
+
+    tag_line = None
+    particle_lines = []
+    weights = []
+    do_momenta = False
+    do_reweight = False
+
+    for line in _read_lhe_lines(filename, byte_range):
+        line = line.split("#")[0].strip()
+        if len(line) == 0:
+            continue
+
+        if line == "</LesHouchesEvents>":
+            return
+        elif line == "<event>":
+            tag_line = None
+            particle_lines = []
+            weights = []
+            do_momenta = True
+            do_reweight = False
+        elif line == "</event>":
+            yield tag_line, particle_lines, weights
+            do_momenta = False
+            do_reweight = False
+        elif line == "<rwgt>":
+            do_momenta = False
+            do_reweight = True
+        elif line == "</rwgt>":
+            do_momenta = False
+            do_reweight = False
+        elif do_reweight:
+            rwgtid = line[line.find("<") + 1 : line.find(">")].split("=")[1][1:-1]
+            rwgtval = float(line[line.find(">") + 1 : line.find("<", line.find("<") + 1)])
+            weights.append((rwgtid, rwgtval))
+        elif line.startswith("<"):  # Other blocks, e.g. <mgrwt>
+            do_momenta = False
+        elif do_momenta and tag_line is None:
+            tag_line = line.split()
+        elif do_momenta:
+            elements = line.split()
+            if len(elements) >= 13:
+                particle_lines.append(elements[:13])
+
+
+# Event weight in the first line of an event, weights in the reweighting block, and complete events
+_event_weight_pattern = re.compile(br"<event(?:\s[^>]*)?>\s*\S+\s+\S+\s+(\S+)")
+_reweight_pattern = re.compile(br"<wgt\s+id\s*=\s*['\"]([^'\"]*)['\"][^>]*>\s*(\S+?)\s*</wgt>")
+_event_pattern = re.compile(br"<event(?:\s[^>]*)?>.*?</event>", re.DOTALL)
+
+
+def _scan_lhe_weights(filename, sampling_benchmark, n_events_expected=None, block_size=2 ** 24):
+    """ Returns the weights of all events in a LHE file as array with shape (n_events, n_weights) together with the
+    weight names, in the same order as the event parsers. The file is read in large blocks of complete events, in
+    which the weights are found with regular expressions. """
+
+    weights = None
+    weight_names, columns, reweight_ids = None, None, None
+    n_events = 0
+
+    with _open_lhe_file(filename, binary=True) as file:
+        remainder = b""
+        while True:
+            data = file.read(block_size)
+            block = remainder + data
+            if data:
+                end = block.rfind(b"</event>")
+                if end < 0:
+                    remainder = block
+                    continue
+                end += len(b"</event>")
+                block, remainder = block[:end], block[end:]
+
+            event_weights = _event_weight_pattern.findall(block)
+            n_block = len(event_weights)
+            if n_block > 0:
+                reweights = _reweight_pattern.findall(block)
+
+                # Weight names from the first event
+                if weight_names is None:
+                    first_event = _event_pattern.search(block).group(0)
+                    reweight_ids = [weight_id for weight_id, _ in _reweight_pattern.findall(first_event)]
+                    weight_names, columns = _get_weight_columns(sampling_benchmark, reweight_ids)
+                    weights = np.empty((max(int(n_events_expected or 0), n_block), len(weight_names)))
+
+                # All events have to have the same reweighting block
+                if [weight_id for weight_id, _ in reweights] != reweight_ids * n_block:
+                    raise RuntimeError(
+                        "Inconsistent weights in LHE file: not all events have the weights {}".format(weight_names)
+                    )
+                block_weights = np.empty((n_block, 1 + len(reweight_ids)))
+                block_weights[:, 0] = np.array(event_weights, dtype=np.float64)
+                block_weights[:, 1:] = np.array([value for _, value in reweights], dtype=np.float64).reshape(
+                    n_block, len(reweight_ids)
+                )
+                block_weights = block_weights[:, columns]
+
+                if n_events + n_block > len(weights):
+                    new_weights = np.empty((max(2 * len(weights), n_events + n_block), len(weight_names)))
+                    new_weights[:n_events] = weights[:n_events]
+                    weights = new_weights
+                weights[n_events : n_events + n_block] = block_weights
+                n_events += n_block
+
+            if not data:
+                break
+
+    if weights is None:
+        return np.zeros((0, 1)), [sampling_benchmark]
+    return weights[:n_events], weight_names
 
-            # End of LHE file
-            elif line == "</LesHouchesEvents>":
+
+def _get_weight_columns(sampling_benchmark, reweight_ids):
+    # Same order as the OrderedDicts in the event parsers: the event weight (column 0) is stored as the sampling
+    # benchmark, followed by the reweighting weights (columns 1, 2, ...), which can overwrite it
+    columns = OrderedDict([(sampling_benchmark, 0)])
+    for i, weight_id in enumerate(reweight_ids):
+        columns[weight_id.decode("utf-8")] = i + 1
+    return list(columns.keys()), list(columns.values())
+
+
+def _find_event_byte_ranges(filename, n_ranges):
+    """ Splits an LHE file into up to n_ranges byte ranges (start, end) of similar size. Each range starts at an <event>
+    tag and contains only complete events, the last one ends after the last </event> tag. For compressed files, the
+    positions refer to the decompressed stream. """
+
+    if _is_gzip_file(filename):
+        return _find_event_byte_ranges_in_gzip_file(filename, n_ranges)
+
+    with open(filename, "rb") as file:
+        file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            first = _find_event_start(file_map, 0)
+            end = file_map.rfind(b"</event>")
+            if first < 0 or end < first:
+                return []
+            end += len(b"</event>")
+
+            boundaries = [first]
+            for i in range(1, n_ranges):
+                position = _find_event_start(file_map, max(boundaries[-1] + 1, first + (end - first) * i // n_ranges))
+                if position < 0 or position >= end:
+                    break
+                boundaries.append(position)
+        finally:
+            file_map.close()
+
+    boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _find_event_byte_ranges_in_gzip_file(filename, n_ranges, step=2 ** 20):
+    # The decompressed size is only known after decompressing the whole file, so in a single pass we remember the
+    # first event start after every multiple of step bytes and the end of the last event, and then pick boundaries
+    starts, end = [], -1
+    offset, buffer, mark = 0, b"", 0
+    overlap = len(b"</event>")
+
+    with gzip.open(filename, "rb") as file:
+        while True:
+            chunk = file.read(step)
+            buffer += chunk
+
+            while True:
+                position = _find_event_start(buffer, max(mark - offset, 0))
+                if position < 0 or (chunk and position + len(b"<event ") > len(buffer)):
+                    break
+                starts.append(offset + position)
+                mark = (offset + position) // step * step + step
+
+            position = buffer.rfind(b"</event>")
+            if position >= 0:
+                end = offset + position + len(b"</event>")
+
+            if not chunk:
+                break
+            keep = min(overlap, len(buffer))
+            offset += len(buffer) - keep
+            buffer = buffer[len(buffer) - keep :]
+
+    if not starts or end < starts[0]:
+        return []
+
+    first = starts[0]
+    boundaries = [first]
+    for i in range(1, n_ranges):
+        target = max(boundaries[-1] + 1, first + (end - first) * i // n_ranges)
+        candidates = [start for start in starts if target <= start < end]
+        if not candidates:
+            break
+        boundaries.append(candidates[0])
+
+    boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _find_event_start(file_map, position):
+    # Finds the next <event> or <event ...> tag (but not e.g. <eventgroup>)
+    while True:
+        position = file_map.find(b"<event", position)
+        if position < 0 or file_map[position + 6 : position + 7] in (b">", b" ", b"\t", b"\n", b"\r"):
+            return position
+        position += 6
+
+
+def _read_lhe_lines(filename, byte_range=None):
+    """ Yields the lines of a (possibly compressed) text file, or only those in the byte range (start, end) """
+
+    if byte_range is None:
+        with _open_lhe_file(filename) as file:
+            for line in file:
+                yield line
+        return
+
+    start, end = byte_range
+    with _open_lhe_file(filename, binary=True) as file:
+        file.seek(start)
+        position = start
+        for line in file:
+            if position >= end:
                 return
+            position += len(line)
+            yield line.decode("utf-8", "replace")
 
-            # Beginning of event
-            elif line == "<event>":
-                # Initialize weights and momenta
-                weights = OrderedDict()
-                particles = []
-
-                # Some tags so that we know where in the event we are
-                do_tag = True
-                do_momenta = False
-                do_reweight = False
-
-            # End of event
-            elif line == "</event>":
-                n_events += 1
-                yield particles, weights
-
-                # Reset weights and momenta
-                weights = OrderedDict()
-                particles = []
-
-                # Some tags so that we know where in the event we are
-                do_tag = False
-                do_momenta = False
-                do_reweight = False
-
-            # Beginning of unimportant block
-            elif line == "<mgrwt>":
-                do_tag = False
-                do_momenta = False
-                do_reweight = False
-
-            # Beginning of weight block
-            elif line == "<rwgt>":
-                do_tag = False
-                do_momenta = False
-                do_reweight = True
-
-            # End of weight block
-            elif line == "</rwgt>":
-                do_tag = False
-                do_momenta = False
-                do_reweight = False
-
-            # Read tag -> first weight
-            elif do_tag:
-                weights[sampling_benchmark] = float(elements[2])
-
-                do_tag = False
-                do_momenta = True
-                do_reweight = False
-
-            # Read Momenta and store as 4-vector
-            elif do_momenta:
-                status = int(elements[1])
-                if status == 1:
-                    pdgid = int(elements[0])
-                    px = float(elements[6])
-                    py = float(elements[7])
-                    pz = float(elements[8])
-                    e = float(elements[9])
-                    spin = float(elements[12])
-                    particle = MadMinerParticle()
-                    particle.setpxpypze(px, py, pz, e)
-                    particle.set_pdgid(pdgid)
-                    particle.set_spin(spin)
-                    particles.append(particle)
-
-            # Read reweighted weights
-            elif do_reweight:
-                rwgtid = line[line.find("<") + 1 : line.find(">")].split("=")[1][1:-1]
-                rwgtval = float(line[line.find(">") + 1 : line.find("<", line.find("<") + 1)])
-                weights[rwgtid] = rwgtval
+
+class _ByteRangeReader(object):
+    """ File-like object that reads the bytes between start and end of a (possibly compressed) file, with a prefix and
+    suffix """
+
+    def __init__(self, filename, start, end, prefix=b"", suffix=b""):
+        self._file = _open_lhe_file(filename, binary=True)
+        self._file.seek(start)
+        self._remaining = end - start
+        self._buffer = prefix
+        self._suffix = suffix
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._buffer) + self._remaining + len(self._suffix or b"")
+
+        if len(self._buffer) < size and self._remaining > 0:
+            data = self._file.read(min(size - len(self._buffer), self._remaining))
+            self._remaining -= len(data)
+            if len(data) == 0:
+                self._remaining = 0
+            self._buffer += data
+        if len(self._buffer) < size and self._remaining == 0 and self._suffix is not None:
+            self._buffer += self._suffix
+            self._suffix = None
+            self._file.close()
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._file.close()
 
 
 def _parse_lhe_file_with_bad_chars(filename):
@@ -852,21 +1798,205 @@ def _parse_lhe_file_with_bad_chars(filename):
                 yield line
 
 
-def _untar_and_parse_lhe_file(filename, tags=None):
-    # Untar event file
-    new_filename, extension = os.path.splitext(filename)
-    if extension == ".gz":
-        if not os.path.exists(new_filename):
-            call_command("gunzip -c {} > {}".format(filename, new_filename))
-        filename = new_filename
+def _get_lhe_file_header(filename):
+    """ Returns the header information of a LHE file, which is read only once per process """
 
-    for event, elem in ET.iterparse(filename):
-        if tags and elem.tag not in tags:
-            continue
+    key = os.path.abspath(filename)
+    header = _lhe_file_headers.get(key)
+    if header is None or header.file_key != _get_file_key(filename):
+        header = _LHEFileHeader(filename)
+        _lhe_file_headers[key] = header
+    return header
+
+
+class _LHEFileHeader(object):
+    """
+    Header information of a LHE file: the run card entries that determine the weight normalization, the weight group
+    definitions, and, once all events have been parsed, the number of events. Only the header is read from the file,
+    up to the first event. The results are stored in a small sidecar file next to the LHE file, which is used instead
+    as long as the size and modification time of the LHE file do not change.
+    """
+
+    version = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file_key = _get_file_key(filename)
+        self.sidecar_filename = filename + ".header.json"
+
+        self.n_events_runcard = None
+        self.weight_norm_is_average = None
+        self.weight_group_strings = []
+        self.n_events = None
+        self._content_hash = None
+
+        if self._load():
+            logger.debug("Loaded LHE header information from %s", self.sidecar_filename)
         else:
-            yield elem
+            self._read()
+            self._save()
+
+    @property
+    def weight_groups(self):
+        return [ET.fromstring(weight_group) for weight_group in self.weight_group_strings]
+
+    @property
+    def content_hash(self):
+        if self._content_hash is None:
+            self._content_hash = _hash_file(self.filename)
+            self._save()
+        return self._content_hash
+
+    def set_n_events(self, n_events):
+        if n_events != self.n_events:
+            self.n_events = n_events
+            self._save()
+
+    def _read(self):
+        logger.debug("Reading header of LHE file %s", self.filename)
+
+        # The header ends where the first event starts
+        header_lines = []
+        with _open_lhe_file(self.filename, binary=True) as file:
+            for line in file:
+                position = _find_event_start(line, 0)
+                if position >= 0:
+                    header_lines.append(line[:position])
+                    break
+                header_lines.append(line)
+        header = b"".join(header_lines)
+
+        # Parse the header elements, the root element is not closed before the first event
+        run_card = None
+        weight_groups = []
+        try:
+            for _, elem in ET.iterparse(io.BytesIO(header)):
+                if elem.tag == "MGRunCard":
+                    run_card = elem.text
+                elif elem.tag == "initrwgt":
+                    weight_groups += elem.findall("weightgroup")
+        except ET.ParseError:
+            pass
+
+        self.n_events_runcard, self.weight_norm_is_average = _parse_run_card(run_card)
+        self.weight_group_strings = [ET.tostring(weight_group).decode("utf-8") for weight_group in weight_groups]
+
+    def _load(self):
+        try:
+            with open(self.sidecar_filename, "r") as file:
+                data = json.load(file)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if data.get("version") != self.version or data.get("file_key") != list(self.file_key):
+            return False
+
+        self.n_events_runcard = data["n_events_runcard"]
+        self.weight_norm_is_average = data["weight_norm_is_average"]
+        self.weight_group_strings = data["weight_groups"]
+        self.n_events = data["n_events"]
+        self._content_hash = data.get("content_hash")
+        return True
+
+    def _save(self):
+        data = {
+            "version": self.version,
+            "file_key": list(self.file_key),
+            "n_events_runcard": self.n_events_runcard,
+            "weight_norm_is_average": self.weight_norm_is_average,
+            "weight_groups": self.weight_group_strings,
+            "n_events": self.n_events,
+            "content_hash": self._content_hash,
+        }
+        try:
+            with open(self.sidecar_filename, "w") as file:
+                json.dump(data, file)
+        except (IOError, OSError) as e:
+            logger.debug("Could not save LHE header information to %s: %s", self.sidecar_filename, e)
+
+
+def _hash_file(filename, block_size=2 ** 24):
+    file_hash = hashlib.sha1()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _get_file_key(filename):
+    # Size and modification time, which change whenever the file is changed
+    return os.path.getsize(filename), os.path.getmtime(filename)
+
+
+def _parse_run_card(run_card):
+    # Returns the number of events and whether the weights are normalized to the average (event_norm = average)
+    n_events_runcard = None
+    weight_norm_is_average = None
+    if run_card is None:
+        return n_events_runcard, weight_norm_is_average
+
+    for line in run_card.splitlines():
+        # Remove run card comments
+        try:
+            line, _ = line.split("!")
+        except:
+            pass
+
+        # Separate in keys and values
+        try:
+            value, key = line.split("=")
+        except:
+            continue
+
+        # Remove spaces
+        value = value.strip()
+        key = key.strip()
+
+        # Parse entries
+        if key == "nevents":
+            n_events_runcard = float(value)
+        if key == "event_norm":
+            weight_norm_is_average = value == "average"
+
+            logger.debug(
+                "Found entry event_norm = %s in LHE header. Interpreting this as weight_norm_is_average " "= %s.",
+                value,
+                weight_norm_is_average,
+            )
+
+    return n_events_runcard, weight_norm_is_average
+
+
+def _is_gzip_file(filename):
+    return os.path.splitext(filename)[1] == ".gz"
+
+
+def _open_lhe_file(filename, binary=False):
+    # Compressed event files are decompressed on the fly while reading
+    if not _is_gzip_file(filename):
+        return open(filename, "rb" if binary else "r")
+    if binary:
+        return gzip.open(filename, "rb")
+    return io.TextIOWrapper(gzip.open(filename, "rb"))
+
+
+def _untar_and_parse_lhe_file(filename, tags=None, byte_range=None):
+    if byte_range is None:
+        source = _open_lhe_file(filename, binary=True)
+    else:
+        # Events in the byte range, wrapped in a root element so that they form a valid XML document
+        source = _ByteRangeReader(filename, byte_range[0], byte_range[1], b"<LesHouchesEvents>", b"</LesHouchesEvents>")
+
+    try:
+        for event, elem in ET.iterparse(source):
+            if tags and elem.tag not in tags:
+                continue
+            else:
+                yield elem
 
-        elem.clear()
+            elem.clear()
+    finally:
+        source.close()
 
 
 def _get_objects(particles, particles_truth, met_resolution=None, global_event_data=None):
@@ -943,22 +2073,73 @@ def _get_objects(particles, particles_truth, met_resolution=None, global_event_d
     met = MadMinerParticle()
     met.setpxpypze(met_x, met_y, 0.0, (met_x ** 2 + met_y ** 2) ** 0.5)
 
+    # Build objects (the math commands are provided by eval_expression())
+    objects = {
+        "p": particles,
+        "p_truth": particles_truth,
+        "e": electrons,
+        "j": jets,
+        "a": photons,
+        "mu": muons,
+        "tau": taus,
+        "l": leptons,
+        "met": met,
+        "v": neutrinos,
+    }
+
+    # Global event_data
+    if global_event_data is not None:
+        objects.update(global_event_data)
+
+    return objects
+
+
+def _get_columnar_objects(particles, particles_truth, met_resolution=None, global_event_data=None, met_noise=None):
+    """ Columnar version of _get_objects() for a batch of events given as JaggedParticles. The MET noise (x and y
+    components) can be given, otherwise it is drawn based on met_resolution. """
+
+    abs_pdgids = np.abs(particles.pdgid)
+
+    # Find and sort visible particles
+    jets = particles.select(np.isin(abs_pdgids, [1, 2, 3, 4, 5, 6, 9, 21])).sorted_by_pt()
+    electrons = particles.select(abs_pdgids == 11).sorted_by_pt()
+    muons = particles.select(abs_pdgids == 13).sorted_by_pt()
+    taus = particles.select(abs_pdgids == 15).sorted_by_pt()
+    photons = particles.select(abs_pdgids == 22).sorted_by_pt()
+    leptons = particles.select(np.isin(abs_pdgids, [11, 13])).sorted_by_pt()
+    neutrinos = particles.select(np.isin(abs_pdgids, [12, 14, 16])).sorted_by_pt()
+
+    known = np.isin(abs_pdgids, [1, 2, 3, 4, 5, 6, 9, 11, 12, 13, 14, 15, 16, 21, 22, 23, 24, 25])
+    if not np.all(known):
+        logger.warning("Unknown particles with PDG ids %s, treating as invisible!", np.unique(particles.pdgid[~known]))
+
+    # Sum over all visible particles
+    visible = np.isin(abs_pdgids, [1, 2, 3, 4, 5, 6, 9, 11, 13, 15, 21, 22, 23, 24, 25])
+    visible_px, visible_py, _, _ = particles.sum(visible)
+
+    # Soft noise
+    if met_noise is None:
+        met_noise = _draw_met_noise(particles, met_resolution)
+    noise_x, noise_y = met_noise
+
+    # MET
+    met_x = -visible_px + noise_x
+    met_y = -visible_py + noise_y
+    met = ParticleColumns(met_x, met_y, np.zeros(particles.n_events), (met_x ** 2 + met_y ** 2) ** 0.5)
+
     # Build objects
-    objects = math_commands()
-    objects.update(
-        {
-            "p": particles,
-            "p_truth": particles_truth,
-            "e": electrons,
-            "j": jets,
-            "a": photons,
-            "mu": muons,
-            "tau": taus,
-            "l": leptons,
-            "met": met,
-            "v": neutrinos,
-        }
-    )
+    objects = {
+        "p": particles,
+        "p_truth": particles_truth,
+        "e": electrons,
+        "j": jets,
+        "a": photons,
+        "mu": muons,
+        "tau": taus,
+        "l": leptons,
+        "met": met,
+        "v": neutrinos,
+    }
 
     # Global event_data
     if global_event_data is not None:
@@ -967,6 +2148,19 @@ def _get_objects(particles, particles_truth, met_resolution=None, global_event_d
     return objects
 
 
+def _draw_met_noise(particles, met_resolution=None):
+    # Soft noise in the x and y components of the MET, with a width that depends on the scalar sum of visible pT
+    if met_resolution is None:
+        return np.zeros(particles.n_events), np.zeros(particles.n_events)
+
+    visible = np.isin(np.abs(particles.pdgid), [1, 2, 3, 4, 5, 6, 9, 11, 13, 15, 21, 22, 23, 24, 25])
+    ht = np.bincount(particles.event_index, weights=particles.pt * visible, minlength=particles.n_events)
+    noise_std = met_resolution[0] + met_resolution[1] * ht
+    noise_x = np.random.normal(0.0, noise_std, size=particles.n_events)
+    noise_y = np.random.normal(0.0, noise_std, size=particles.n_events)
+    return noise_x, noise_y
+
+
 def _smear_variable(true_value, resolutions, id):
     """ Adds Gaussian nose to a variable """
     try:
@@ -1056,6 +2250,98 @@ def _smear_particles(particles, energy_resolutions, pt_resolutions, eta_resoluti
     return smeared_particles
 
 
+def _smear_column(true_values, resolution, min_value=None):
+    """ Columnar version of _smear_variable(), redrawing the noise while the result is not larger than min_value """
+
+    try:
+        res = np.asarray(resolution[0] + resolution[1] * true_values, dtype=np.float64)
+    except TypeError:
+        return true_values
+
+    values = np.array(true_values, dtype=np.float64)
+    if min_value is not None:
+        min_value = np.broadcast_to(min_value, values.shape)
+
+    todo = res > 0.0
+    while np.any(todo):
+        values[todo] = true_values[todo] + np.random.normal(0.0, res[todo])
+        if min_value is None:
+            break
+        todo &= values <= min_value
+
+    return values
+
+
+def _smear_particle_columns(particles, energy_resolutions, pt_resolutions, eta_resolutions, phi_resolutions):
+    """ Columnar version of _smear_particles() for a batch of events given as JaggedParticles """
+
+    # No smearing if any argument is None
+    if energy_resolutions is None or pt_resolutions is None or eta_resolutions is None or phi_resolutions is None:
+        return particles
+
+    px = np.zeros(len(particles))
+    py = np.zeros(len(particles))
+    pz = np.zeros(len(particles))
+    e = np.zeros(len(particles))
+    smeared = np.zeros(len(particles), dtype=np.bool_)
+
+    for pdgid in np.unique(particles.pdgid):
+        pdgid = int(pdgid)
+        if (
+            pdgid not in six.iterkeys(energy_resolutions)
+            or pdgid not in six.iterkeys(pt_resolutions)
+            or pdgid not in six.iterkeys(eta_resolutions)
+            or pdgid not in six.iterkeys(phi_resolutions)
+        ):
+            continue
+
+        if None in energy_resolutions[pdgid] and None in pt_resolutions[pdgid]:
+            raise RuntimeError("Cannot derive both pT and energy from on-shell conditions!")
+
+        mask = particles.pdgid == pdgid
+        smeared |= mask
+        true = ParticleColumns(particles.px[mask], particles.py[mask], particles.pz[mask], particles.e[mask])
+
+        # Minimum energy and pT
+        m = true.m
+        min_e = m if None in pt_resolutions[pdgid] else 0.0
+        min_pt = 0.0
+
+        # Smear four-momenta
+        this_e, this_pt = None, None
+        if None not in energy_resolutions[pdgid]:
+            this_e = _smear_column(true.e, energy_resolutions[pdgid], min_e)
+        if None not in pt_resolutions[pdgid]:
+            this_pt = _smear_column(true.pt, pt_resolutions[pdgid], min_pt)
+        this_eta = _smear_column(true.eta, eta_resolutions[pdgid])
+        this_phi = _smear_column(true.phi(), phi_resolutions[pdgid])
+
+        if None in energy_resolutions[pdgid]:
+            # Calculate E from on-shell conditions (like LorentzVector.setptetaphim())
+            p2 = (this_pt * np.cosh(this_eta)) ** 2
+            this_e = np.where(m > 0.0, np.sqrt(p2 + m ** 2), np.sqrt(p2 - m ** 2))
+        elif None in pt_resolutions[pdgid]:
+            # Calculate pT from on-shell conditions
+            with np.errstate(invalid="ignore"):
+                this_pt = np.where(this_e > m, (this_e ** 2 - m ** 2) ** 0.5 / np.cosh(this_eta), 0.0)
+
+        px[mask] = this_pt * np.cos(this_phi)
+        py[mask] = this_pt * np.sin(this_phi)
+        pz[mask] = this_pt * np.sinh(this_eta)
+        e[mask] = this_e
+
+    return JaggedParticles(
+        px[smeared],
+        py[smeared],
+        pz[smeared],
+        e[smeared],
+        particles.pdgid[smeared],
+        particles.event_index[smeared],
+        particles.n_events,
+        spin=particles.spin[smeared],
+    )
+
+
 def get_elementary_pdg_ids():
     ids = [1, -1, 2, -2, 3, -3, 4, -4, 5, -5, 6, -6, 9, 11, -11, 12, -12, 13, -13, 14, -14, 15, -15, 16, -16]
     ids += [21, 22, 23, 24, -24, 25]
@@ -0,0 +1,233 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import multiprocessing
+import six
+import socket
+import traceback
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from madminer.utils.various import get_fork_context
+
+logger = logging.getLogger(__name__)
+
+
+def is_distributed():
+    """ Returns True if this process is part of a torch.distributed process group with more than one process """
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def broadcast_model(model, src=0):
+    """ Copies all parameters and buffers of a model from process src to all other processes """
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, src)
+
+
+def broadcast_seed(src=0):
+    """ Draws a random seed in process src and returns it in all processes """
+    seed = torch.tensor([np.random.randint(0, 2 ** 31 - 1) if get_rank() == src else 0], dtype=torch.long)
+    dist.broadcast(seed, src)
+    return int(seed.item())
+
+
+def broadcast_flag(flag, src=0):
+    """ Returns the boolean flag of process src in all processes """
+    flag = torch.tensor([1 if flag else 0], dtype=torch.long)
+    dist.broadcast(flag, src)
+    return bool(flag.item())
+
+
+def all_reduce_sum(values):
+    """ Sums a list of numbers over all processes """
+    values = torch.tensor(values, dtype=torch.double)
+    dist.all_reduce(values, op=dist.ReduceOp.SUM)
+    return values.numpy()
+
+
+def all_reduce_min(value):
+    """ Returns the minimum of an integer over all processes """
+    value = torch.tensor([value], dtype=torch.long)
+    dist.all_reduce(value, op=dist.ReduceOp.MIN)
+    return int(value.item())
+
+
+def all_reduce_gradients(model, failed=False):
+    """
+    Averages the gradients of all trainable parameters over all processes, using a single all-reduce on a flat buffer.
+    A process that could not calculate its gradients (for instance because NaNs appeared) still has to take part in
+    the all-reduce and sets failed=True. Returns True if that happened in any process, in which case the gradients are
+    left unchanged.
+    """
+
+    parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+    flat_gradients = [
+        torch.zeros(parameter.numel(), dtype=parameter.dtype, device=parameter.device)
+        if parameter.grad is None or failed
+        else parameter.grad.detach().reshape(-1)
+        for parameter in parameters
+    ]
+    flag = torch.tensor([1.0 if failed else 0.0], dtype=parameters[0].dtype, device=parameters[0].device)
+    buffer = torch.cat(flat_gradients + [flag])
+
+    dist.all_reduce(buffer, op=dist.ReduceOp.SUM)
+    if buffer[-1].item() > 0.0:
+        return True
+
+    buffer /= dist.get_world_size()
+    offset = 0
+    for parameter in parameters:
+        n = parameter.numel()
+        if parameter.grad is None:
+            parameter.grad = torch.zeros_like(parameter)
+        parameter.grad.copy_(buffer[offset : offset + n].view_as(parameter))
+        offset += n
+    return False
+
+
+class _PortInUseError(RuntimeError):
+    pass
+
+
+def launch_local(function, n_processes, args=(), master_port=None, max_port_attempts=3, poll_interval=1.0):
+    """
+    Runs function(*args) in n_processes processes on this machine, which form a torch.distributed process group with
+    the gloo backend. The processes are forked, so the function and its arguments (e.g. training data) do not have to
+    be pickled, and the CPU threads used by PyTorch are divided between them.
+
+    Trainer.train() switches to data-parallel training whenever it runs in a process group with more than one process:
+    each process trains on its own shard of the training data, the gradients are averaged over all processes after
+    every minibatch, and rank 0 makes the early stopping decisions. This function sets up such a group on a single
+    machine, for instance for tests. On a cluster, the processes can instead be started with any other launcher such
+    as torchrun, calling `torch.distributed.init_process_group("gloo")` before training.
+
+    Parameters
+    ----------
+    function : callable
+        Function to run in every process. It can use `get_rank()` to find out which process it runs in.
+
+    n_processes : int
+        Number of processes.
+
+    args : tuple, optional
+        Arguments for function. Default value: ().
+
+    master_port : int or None, optional
+        Port on localhost used to set up the process group. If None, a free port is chosen. Since the port is only
+        reserved once the process group is set up, another program can take it in between; in that case the processes
+        are started again with another free port, up to max_port_attempts times. Default value: None.
+
+    max_port_attempts : int, optional
+        Maximal number of attempts to set up the process group on a free port if master_port is None. Default value: 3.
+
+    poll_interval : float, optional
+        Interval in seconds in which the processes are checked while waiting for their results. A process that exits
+        without returning a result, for instance because it was killed, raises a RuntimeError instead of blocking
+        forever. Default value: 1.
+
+    Returns
+    -------
+    result : object
+        The return value of function in the process with rank 0 (which has to be picklable).
+
+    """
+
+    for attempt in range(max_port_attempts if master_port is None else 1):
+        try:
+            return _launch_local(
+                function, n_processes, args, _find_free_port() if master_port is None else master_port, poll_interval
+            )
+        except _PortInUseError:
+            if master_port is not None or attempt + 1 >= max_port_attempts:
+                raise
+            logger.info("Port was taken before the process group was set up, trying again with another port")
+
+
+def _launch_local(function, n_processes, args, master_port, poll_interval):
+    n_threads = max(1, multiprocessing.cpu_count() // n_processes)
+    logger.info("Starting %s training processes with %s threads each", n_processes, n_threads)
+
+    context = get_fork_context()
+    queue = context.Queue()
+    processes = [
+        context.Process(
+            target=_run_process, args=(function, args, rank, n_processes, master_port, n_threads, queue)
+        )
+        for rank in range(n_processes)
+    ]
+    for process in processes:
+        process.start()
+
+    result, finished, finished_ranks = None, False, set()
+    try:
+        while len(finished_ranks) < n_processes:
+            # Processes that exited before the queue is read have already sent any result they have
+            exited_ranks = [
+                rank
+                for rank, process in enumerate(processes)
+                if rank not in finished_ranks and process.exitcode is not None
+            ]
+            try:
+                rank, rank_result, error, initialized = queue.get(timeout=poll_interval)
+            except six.moves.queue.Empty:
+                if len(exited_ranks) > 0:
+                    raise RuntimeError(
+                        "Training process {} exited with code {} without returning a result".format(
+                            exited_ranks[0], processes[exited_ranks[0]].exitcode
+                        )
+                    )
+                continue
+
+            if error is not None:
+                message = "Training process {} failed:\n{}".format(rank, error)
+                if not initialized and "address already in use" in error.lower():
+                    raise _PortInUseError(message)
+                raise RuntimeError(message)
+            if rank == 0:
+                result = rank_result
+            finished_ranks.add(rank)
+        finished = True
+    finally:
+        # If one process failed, the others may wait forever in a collective operation
+        for process in processes:
+            if not finished and process.is_alive():
+                process.terminate()
+            process.join()
+
+    return result
+
+
+def _run_process(function, args, rank, world_size, master_port, n_threads, queue):
+    torch.set_num_threads(n_threads)
+    initialized = False
+    try:
+        dist.init_process_group(
+            "gloo", init_method="tcp://127.0.0.1:{}".format(master_port), rank=rank, world_size=world_size
+        )
+        initialized = True
+        result = function(*args)
+        queue.put((rank, result if rank == 0 else None, None, True))
+    except Exception:
+        queue.put((rank, None, traceback.format_exc(), initialized))
+    finally:
+        if initialized:
+            dist.destroy_process_group()
+
+
+def _find_free_port():
+    # The port is released again before the process group binds it, see launch_local
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
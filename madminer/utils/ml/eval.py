@@ -3,58 +3,62 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import logging
 import numpy as np
 import torch
-from torch import tensor
+from torch.autograd import grad
 
 from madminer.utils.ml.models.ratio import DenseSingleParameterizedRatioModel, DenseDoublyParameterizedRatioModel
 
 logger = logging.getLogger(__name__)
 
 
-def evaluate_flow_model(model, thetas=None, xs=None, evaluate_score=False, run_on_gpu=True, double_precision=False):
+def evaluate_flow_model(
+    model,
+    thetas=None,
+    xs=None,
+    evaluate_score=False,
+    run_on_gpu=True,
+    double_precision=False,
+    batch_size=100000,
+    compiled_model=None,
+):
     # CPU or GPU?
     run_on_gpu = run_on_gpu and torch.cuda.is_available()
     device = torch.device("cuda" if run_on_gpu else "cpu")
     dtype = torch.double if double_precision else torch.float
 
-    # Balance theta0 and theta1
-    n_thetas = len(thetas)
-
     # Prepare data
+    xs = np.asarray(xs)
+    thetas = np.asarray(thetas)
     n_xs = len(xs)
-    thetas = torch.stack([tensor(thetas[i % n_thetas], requires_grad=True) for i in range(n_xs)])
-    xs = torch.stack([tensor(i) for i in xs])
 
-    model = model.to(device, dtype)
-    thetas = thetas.to(device, dtype)
-    xs = xs.to(device, dtype)
-
-    # Evaluate estimator with score:
-    if evaluate_score:
-        model.eval()
+    model, use_compiled = _inference_model(model, compiled_model, device, dtype, double_precision)
 
-        _, log_p_hat, t_hat = model.log_likelihood_and_score(thetas, xs)
+    log_p_hat = np.empty(n_xs, dtype=_numpy_dtype(double_precision))
+    t_hat = np.empty((n_xs, thetas.shape[1]), dtype=_numpy_dtype(double_precision)) if evaluate_score else None
 
-        # Copy back tensors to CPU
-        if run_on_gpu:
-            log_p_hat = log_p_hat.cpu()
-            t_hat = t_hat.cpu()
+    for start, end in _batches(n_xs, batch_size):
+        theta_batch = _theta_batch(thetas, start, end, device, dtype, requires_grad=evaluate_score)
+        x_batch = _as_tensor(xs[start:end], device, dtype)
 
-        log_p_hat = log_p_hat.detach().numpy().flatten()
-        t_hat = t_hat.detach().numpy().flatten()
+        # Evaluate compiled estimator
+        if use_compiled:
+            log_p_hat_batch, (t_hat_batch,) = _evaluate_compiled_model(model, [theta_batch], x_batch, evaluate_score)
+            if evaluate_score:
+                t_hat[start:end] = t_hat_batch.cpu().numpy()
 
-    # Evaluate estimator without score:
-    else:
-        with torch.no_grad():
-            model.eval()
+        # Evaluate estimator with score:
+        elif evaluate_score:
+            _, log_p_hat_batch, t_hat_batch = model.log_likelihood_and_score(theta_batch, x_batch)
+            t_hat[start:end] = t_hat_batch.detach().cpu().numpy()
 
-            _, log_p_hat = model.log_likelihood(thetas, xs)
+        # Evaluate estimator without score:
+        else:
+            with torch.no_grad():
+                _, log_p_hat_batch = model.log_likelihood(theta_batch, x_batch)
 
-            # Copy back tensors to CPU
-            if run_on_gpu:
-                log_p_hat = log_p_hat.cpu()
+        log_p_hat[start:end] = log_p_hat_batch.detach().cpu().numpy().flatten()
 
-            log_p_hat = log_p_hat.detach().numpy().flatten()
-            t_hat = None
+    if t_hat is not None:
+        t_hat = t_hat.flatten()
 
     return log_p_hat, t_hat
 
@@ -69,6 +73,8 @@ def evaluate_ratio_model(
     run_on_gpu=True,
     double_precision=False,
     return_grad_x=False,
+    batch_size=100000,
+    compiled_model=None,
 ):
     # CPU or GPU?
     run_on_gpu = run_on_gpu and torch.cuda.is_available()
@@ -78,138 +84,264 @@ def evaluate_ratio_model(
     # Figure out method type
     if method_type is None:
         if isinstance(model, DenseSingleParameterizedRatioModel):
-            method_type = "parameterized"
+            method_type = "parameterized_ratio"
         elif isinstance(model, DenseDoublyParameterizedRatioModel):
-            method_type = "doubly_parameterized"
+            method_type = "double_parameterized_ratio"
         else:
             raise RuntimeError("Cannot infer method type automatically")
+    if method_type not in ["parameterized_ratio", "double_parameterized_ratio"]:
+        raise ValueError("Unknown method type %s", method_type)
 
     # Balance theta0 and theta1
-    if theta1s is None:
-        n_thetas = len(theta0s)
-    else:
-        n_thetas = max(len(theta0s), len(theta1s))
+    theta0s = np.asarray(theta0s)
+    if theta1s is not None:
+        theta1s = np.asarray(theta1s)
         if len(theta0s) > len(theta1s):
             theta1s = np.array([theta1s[i % len(theta1s)] for i in range(len(theta0s))])
         elif len(theta0s) < len(theta1s):
             theta0s = np.array([theta0s[i % len(theta0s)] for i in range(len(theta1s))])
 
     # Prepare data
+    xs = np.asarray(xs)
     n_xs = len(xs)
-    theta0s = torch.stack([tensor(theta0s[i % n_thetas], requires_grad=evaluate_score) for i in range(n_xs)])
-    if theta1s is not None:
-        theta1s = torch.stack([tensor(theta1s[i % n_thetas], requires_grad=evaluate_score) for i in range(n_xs)])
-    xs = torch.stack([tensor(i) for i in xs])
 
-    model = model.to(device, dtype)
-    theta0s = theta0s.to(device, dtype)
-    if theta1s is not None:
-        theta1s = theta1s.to(device, dtype)
-    xs = xs.to(device, dtype)
-
-    # Evaluate ratio estimator with score or x gradients:
-    if evaluate_score or return_grad_x:
-        model.eval()
-
-        if method_type == "parameterized_ratio":
-            if return_grad_x:
-                s_hat, log_r_hat, t_hat0, x_gradients = model(
-                    theta0s, xs, return_grad_x=True, track_score=evaluate_score, create_gradient_graph=False
-                )
-            else:
-                s_hat, log_r_hat, t_hat0 = model(theta0s, xs, track_score=evaluate_score, create_gradient_graph=False)
-                x_gradients = None
-            t_hat1 = None
-        elif method_type == "double_parameterized_ratio":
-            if return_grad_x:
-                s_hat, log_r_hat, t_hat0, t_hat1, x_gradients = model(
-                    theta0s, theta1s, xs, return_grad_x=True, track_score=evaluate_score, create_gradient_graph=False
+    if return_grad_x:
+        compiled_model = None
+    model, use_compiled = _inference_model(model, compiled_model, device, dtype, double_precision)
+
+    # Output arrays
+    np_dtype = _numpy_dtype(double_precision)
+    s_hat = np.empty(n_xs, dtype=np_dtype)
+    log_r_hat = np.empty(n_xs, dtype=np_dtype)
+    t_hat0, t_hat1, x_gradients = None, None, None
+    if evaluate_score:
+        t_hat0 = np.empty((n_xs, theta0s.shape[1]), dtype=np_dtype)
+        if method_type == "double_parameterized_ratio":
+            t_hat1 = np.empty((n_xs, theta1s.shape[1]), dtype=np_dtype)
+    if return_grad_x:
+        x_gradients = np.empty(xs.shape, dtype=np_dtype)
+
+    for start, end in _batches(n_xs, batch_size):
+        theta0_batch = _theta_batch(theta0s, start, end, device, dtype, requires_grad=evaluate_score)
+        theta1_batch = None
+        if theta1s is not None:
+            theta1_batch = _theta_batch(theta1s, start, end, device, dtype, requires_grad=evaluate_score)
+        x_batch = _as_tensor(xs[start:end], device, dtype)
+
+        # Evaluate compiled ratio estimator
+        if use_compiled:
+            theta_batches = [theta0_batch] if method_type == "parameterized_ratio" else [theta0_batch, theta1_batch]
+            log_r_hat_batch, t_hat_batches = _evaluate_compiled_model(model, theta_batches, x_batch, evaluate_score)
+            outputs = (1.0 / (1.0 + torch.exp(log_r_hat_batch)), log_r_hat_batch)
+            if evaluate_score:
+                t_hat0[start:end] = t_hat_batches[0].cpu().numpy()
+                if method_type == "double_parameterized_ratio":
+                    t_hat1[start:end] = t_hat_batches[1].cpu().numpy()
+
+        # Evaluate ratio estimator with score or x gradients:
+        elif evaluate_score or return_grad_x:
+            if method_type == "parameterized_ratio":
+                outputs = model(
+                    theta0_batch,
+                    x_batch,
+                    return_grad_x=return_grad_x,
+                    track_score=evaluate_score,
+                    create_gradient_graph=False,
                 )
+                t_hat0_batch, t_hat1_batch = outputs[2], None
             else:
-                s_hat, log_r_hat, t_hat0, t_hat1 = model(
-                    theta0s, theta1s, xs, track_score=evaluate_score, create_gradient_graph=False
+                outputs = model(
+                    theta0_batch,
+                    theta1_batch,
+                    x_batch,
+                    return_grad_x=return_grad_x,
+                    track_score=evaluate_score,
+                    create_gradient_graph=False,
                 )
-                x_gradients = None
-        else:
-            raise ValueError("Unknown method type %s", method_type)
-
-        # Copy back tensors to CPU
-        if run_on_gpu:
-            s_hat = s_hat.cpu()
-            log_r_hat = log_r_hat.cpu()
-            if t_hat0 is not None:
-                t_hat0 = t_hat0.cpu()
-            if t_hat1 is not None:
-                t_hat1 = t_hat1.cpu()
-
-        # Get data and return
-        s_hat = s_hat.detach().numpy().flatten()
-        log_r_hat = log_r_hat.detach().numpy().flatten()
-        if t_hat0 is not None:
-            t_hat0 = t_hat0.detach().numpy()
-        if t_hat1 is not None:
-            t_hat1 = t_hat1.detach().numpy()
-
-    # Evaluate ratio estimator without score:
-    else:
-        with torch.no_grad():
-            model.eval()
+                t_hat0_batch, t_hat1_batch = outputs[2], outputs[3]
 
-            if method_type == "parameterized_ratio":
-                s_hat, log_r_hat, _ = model(theta0s, xs, track_score=False, create_gradient_graph=False)
-            elif method_type == "double_parameterized_ratio":
-                s_hat, log_r_hat, _, _ = model(theta0s, theta1s, xs, track_score=False, create_gradient_graph=False)
-            else:
-                raise ValueError("Unknown method type %s", method_type)
+            if t_hat0_batch is not None:
+                t_hat0[start:end] = t_hat0_batch.detach().cpu().numpy()
+            if t_hat1_batch is not None:
+                t_hat1[start:end] = t_hat1_batch.detach().cpu().numpy()
+            if return_grad_x:
+                x_gradients[start:end] = outputs[-1].detach().cpu().numpy()
 
-            # Copy back tensors to CPU
-            if run_on_gpu:
-                s_hat = s_hat.cpu()
-                log_r_hat = log_r_hat.cpu()
+        # Evaluate ratio estimator without score:
+        else:
+            with torch.no_grad():
+                if method_type == "parameterized_ratio":
+                    outputs = model(theta0_batch, x_batch, track_score=False, create_gradient_graph=False)
+                else:
+                    outputs = model(
+                        theta0_batch, theta1_batch, x_batch, track_score=False, create_gradient_graph=False
+                    )
 
-            # Get data and return
-            s_hat = s_hat.detach().numpy().flatten()
-            log_r_hat = log_r_hat.detach().numpy().flatten()
-            t_hat0, t_hat1 = None, None
+        s_hat[start:end] = outputs[0].detach().cpu().numpy().flatten()
+        log_r_hat[start:end] = outputs[1].detach().cpu().numpy().flatten()
 
     if return_grad_x:
         return s_hat, log_r_hat, t_hat0, t_hat1, x_gradients
     return s_hat, log_r_hat, t_hat0, t_hat1
 
 
-def evaluate_local_score_model(model, xs=None, run_on_gpu=True, double_precision=False, return_grad_x=False):
+def evaluate_ratio_model_grid(
+    model, thetas=None, xs=None, evaluate_score=False, run_on_gpu=True, double_precision=False, batch_size=100000
+):
+    """
+    Evaluates a DenseSingleParameterizedRatioModel for all combinations of thetas and xs. The x-dependent part of
+    the first layer is calculated once per batch of observations and reused for all thetas, which are evaluated in
+    chunks of at most batch_size theta-x combinations.
+
+    Returns log_r_hat with shape (n_thetas, n_xs) and t_hat with shape (n_thetas, n_xs, n_parameters) (or None).
+    """
+
+    # CPU or GPU?
+    run_on_gpu = run_on_gpu and torch.cuda.is_available()
+    device = torch.device("cuda" if run_on_gpu else "cpu")
+    dtype = torch.double if double_precision else torch.float
+
+    model = model.to(device, dtype)
+    model.eval()
+
+    n_thetas, n_xs = len(thetas), len(xs)
+    x_batch_size = max(1, min(n_xs, batch_size))
+    theta_batch_size = max(1, batch_size // x_batch_size)
+
+    thetas = _as_tensor(thetas, device, dtype)
+    xs = np.asarray(xs)
+
+    np_dtype = _numpy_dtype(double_precision)
+    all_log_r_hat = np.empty((n_thetas, n_xs), dtype=np_dtype)
+    all_t_hat = np.empty((n_thetas, n_xs, thetas.size(1)), dtype=np_dtype) if evaluate_score else None
+
+    for x_start, x_end in _batches(n_xs, x_batch_size):
+        with torch.no_grad():
+            x_projection = model.project_x(_as_tensor(xs[x_start:x_end], device, dtype))
+
+        for theta_start, theta_end in _batches(n_thetas, theta_batch_size):
+            theta_batch = thetas[theta_start:theta_end]
+
+            if evaluate_score:
+                log_r_hat, t_hat = model.forward_grid(
+                    theta_batch.clone(), x_projection, track_score=True, create_gradient_graph=False
+                )
+                all_t_hat[theta_start:theta_end, x_start:x_end] = t_hat.detach().cpu().numpy()
+            else:
+                with torch.no_grad():
+                    log_r_hat, _ = model.forward_grid(theta_batch, x_projection, track_score=False)
+
+            all_log_r_hat[theta_start:theta_end, x_start:x_end] = log_r_hat.detach().cpu().numpy()
+
+    return all_log_r_hat, all_t_hat
+
+
+def evaluate_local_score_model(
+    model,
+    xs=None,
+    run_on_gpu=True,
+    double_precision=False,
+    return_grad_x=False,
+    batch_size=100000,
+    compiled_model=None,
+):
     # CPU or GPU?
     run_on_gpu = run_on_gpu and torch.cuda.is_available()
     device = torch.device("cuda" if run_on_gpu else "cpu")
     dtype = torch.double if double_precision else torch.float
 
     # Prepare data
-    xs = torch.stack([tensor(i) for i in xs])
+    xs = np.asarray(xs)
+    n_xs = len(xs)
 
-    model = model.to(device, dtype)
-    xs = xs.to(device, dtype)
+    if return_grad_x:
+        compiled_model = None
+    model, _ = _inference_model(model, compiled_model, device, dtype, double_precision)
 
-    # Evaluate networks
+    t_hat, x_gradients = None, None
     if return_grad_x:
-        model.eval()
-        t_hat, x_gradients = model(xs, return_grad_x=True)
-    else:
-        with torch.no_grad():
-            model.eval()
-            t_hat = model(xs)
-        x_gradients = None
+        x_gradients = np.empty(xs.shape, dtype=_numpy_dtype(double_precision))
 
-    # Copy back tensors to CPU
-    if run_on_gpu:
-        t_hat = t_hat.cpu()
-        if x_gradients is not None:
-            x_gradients = x_gradients.cpu()
+    # Evaluate networks
+    for start, end in _batches(n_xs, batch_size):
+        x_batch = _as_tensor(xs[start:end], device, dtype)
 
-    # Get data and return
-    t_hat = t_hat.detach().numpy()
+        if return_grad_x:
+            t_hat_batch, x_gradients_batch = model(x_batch, return_grad_x=True)
+            x_gradients[start:end] = x_gradients_batch.detach().cpu().numpy()
+        else:
+            with torch.no_grad():
+                t_hat_batch = model(x_batch)
+
+        # The output dimension is only known after the first batch
+        t_hat_batch = t_hat_batch.detach().cpu().numpy()
+        if t_hat is None:
+            t_hat = np.empty((n_xs,) + t_hat_batch.shape[1:], dtype=_numpy_dtype(double_precision))
+        t_hat[start:end] = t_hat_batch
 
     if return_grad_x:
-        x_gradients = x_gradients.detach().numpy()
         return t_hat, x_gradients
 
     return t_hat
+
+
+def _inference_model(model, compiled_model, device, dtype, double_precision):
+    """ Returns the model to evaluate, moved to the device and in evaluation mode, and whether it is compiled. Compiled
+    models are traced in single precision and only calculate the main output, so they are not used for double
+    precision or gradients with respect to x. """
+
+    if compiled_model is not None and not double_precision:
+        compiled_model = compiled_model.to(device)
+        compiled_model.eval()
+        return compiled_model, True
+
+    model = model.to(device, dtype)
+    model.eval()
+    return model, False
+
+
+def _evaluate_compiled_model(compiled_model, thetas, x, evaluate_score):
+    """ Evaluates a compiled model on (thetas..., x) and, if evaluate_score is True, the gradient of the output with
+    respect to each theta. Returns the output and a list with the gradients (or None). """
+
+    if not evaluate_score:
+        with torch.no_grad():
+            output = compiled_model(*(thetas + [x]))
+        return output.flatten(), [None for _ in thetas]
+
+    output = compiled_model(*(thetas + [x]))
+    gradients = grad(output, thetas, grad_outputs=torch.ones_like(output), only_inputs=True)
+    return output.detach().flatten(), [gradient.detach() for gradient in gradients]
+
+
+def _numpy_dtype(double_precision):
+    return np.float64 if double_precision else np.float32
+
+
+def _batches(n, batch_size):
+    """ Yields (start, end) index ranges that split n samples into batches of at most batch_size """
+    if batch_size is None or batch_size <= 0:
+        batch_size = max(n, 1)
+    for start in range(0, n, batch_size):
+        yield start, min(start + batch_size, n)
+
+
+def _as_tensor(array, device, dtype):
+    """ Wraps a NumPy array as tensor, without copying it unless the dtype or device differ """
+    return torch.from_numpy(np.ascontiguousarray(array)).to(device, dtype)
+
+
+def _theta_batch(thetas, start, end, device, dtype, requires_grad=False):
+    """ Returns the parameter points for samples start to end, where sample i belongs to thetas[i % len(thetas)] """
+    n_thetas = len(thetas)
+    if n_thetas == 1:
+        theta_batch = _as_tensor(thetas, device, dtype).expand(end - start, -1)
+    elif start == 0 and end <= n_thetas:
+        theta_batch = _as_tensor(thetas[start:end], device, dtype)
+    else:
+        theta_batch = _as_tensor(thetas[np.arange(start, end) % n_thetas], device, dtype)
+
+    # Gradients with respect to theta are calculated per sample, so each sample needs its own leaf tensor
+    if requires_grad:
+        theta_batch = theta_batch.detach().clone().requires_grad_(True)
+    return theta_batch
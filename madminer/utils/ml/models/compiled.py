@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import torch
+import torch.nn as nn
+import logging
+import warnings
+
+from madminer.utils.ml.models.base import BaseConditionalFlow
+from madminer.utils.ml.models.ratio import DenseSingleParameterizedRatioModel, DenseDoublyParameterizedRatioModel
+from madminer.utils.ml.models.score import DenseLocalScoreModel
+
+logger = logging.getLogger(__name__)
+
+
+class _SingleParameterizedLogRatio(nn.Module):
+    def __init__(self, model):
+        super(_SingleParameterizedLogRatio, self).__init__()
+        self.model = model
+
+    def forward(self, theta, x):
+        return self.model(theta, x, track_score=False, create_gradient_graph=False)[1]
+
+
+class _DoublyParameterizedLogRatio(nn.Module):
+    def __init__(self, model):
+        super(_DoublyParameterizedLogRatio, self).__init__()
+        self.model = model
+
+    def forward(self, theta0, theta1, x):
+        return self.model(theta0, theta1, x, track_score=False, create_gradient_graph=False)[1]
+
+
+class _LocalScore(nn.Module):
+    def __init__(self, model):
+        super(_LocalScore, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)
+
+
+class _ConditionalLogLikelihood(nn.Module):
+    def __init__(self, model):
+        super(_ConditionalLogLikelihood, self).__init__()
+        self.model = model
+
+    def forward(self, theta, x):
+        return self.model.log_likelihood(theta, x)[1]
+
+
+def compile_model(model, n_observables, n_parameters):
+    """
+    Compiles the inference pass of a trained model to TorchScript.
+
+    The compiled module only calculates the main output: log r(x | theta) for parameterized ratio models (with inputs
+    theta, x or theta0, theta1, x), t(x) for local score models (input x), and log p(x | theta) for conditional flows
+    (inputs theta, x). Scores with respect to theta can still be calculated by differentiating this output, since
+    TorchScript modules support autograd.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Trained model.
+
+    n_observables : int
+        Number of observables the model takes as input (after feature selection).
+
+    n_parameters : int
+        Number of parameters.
+
+    Returns
+    -------
+    compiled_model : torch.jit.ScriptModule or None
+        Compiled model in single precision on the CPU, or None if this type of model is not supported.
+
+    """
+
+    if isinstance(model, DenseSingleParameterizedRatioModel):
+        wrapper, n_theta_inputs = _SingleParameterizedLogRatio(model), 1
+    elif isinstance(model, DenseDoublyParameterizedRatioModel):
+        wrapper, n_theta_inputs = _DoublyParameterizedLogRatio(model), 2
+    elif isinstance(model, DenseLocalScoreModel):
+        wrapper, n_theta_inputs = _LocalScore(model), 0
+    elif isinstance(model, BaseConditionalFlow):
+        wrapper, n_theta_inputs = _ConditionalLogLikelihood(model), 1
+    else:
+        logger.warning("Compilation of models of type %s is not supported", type(model).__name__)
+        return None
+
+    model = model.to(torch.device("cpu"), torch.float)
+    model.eval()
+
+    # Example inputs for tracing, with a batch size that does not coincide with any layer size
+    n_examples = 7
+    example_inputs = [torch.zeros(n_examples, n_parameters) for _ in range(n_theta_inputs)]
+    example_inputs.append(torch.zeros(n_examples, n_observables))
+
+    # Input shape checks in the flows are evaluated once during tracing, which is what we want here
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        compiled_model = torch.jit.trace(wrapper, tuple(example_inputs), check_trace=False)
+    compiled_model.eval()
+
+    return compiled_model
@@ -0,0 +1,58 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import copy
+import torch
+import torch.nn as nn
+import logging
+import warnings
+
+from madminer.utils.ml.models.ratio import DenseSingleParameterizedRatioModel
+from madminer.utils.ml.models.score import DenseLocalScoreModel
+
+logger = logging.getLogger(__name__)
+
+
+def quantize_model(model):
+    """
+    Returns a copy of a trained model in which the weights of the linear layers are quantized to int8, with activations
+    quantized dynamically for each batch. The first layer, which acts on the (rescaled) observables and parameters, is
+    kept in single precision: it holds only a small part of the weights, and keeping it in floating point means that
+    the inputs are not rounded and that the shared x projection of DenseSingleParameterizedRatioModel still works.
+
+    The quantized model runs on the CPU only and does not support gradients, so it can only be used to evaluate the
+    network output (t(x) for local score models, log r for parameterized ratio models).
+
+    Parameters
+    ----------
+    model : DenseLocalScoreModel or DenseSingleParameterizedRatioModel
+        Trained model.
+
+    Returns
+    -------
+    quantized_model : torch.nn.Module or None
+        Quantized model, or None if the model type is not supported.
+
+    """
+
+    if not isinstance(model, (DenseLocalScoreModel, DenseSingleParameterizedRatioModel)):
+        logger.warning("Quantization of models of type %s is not supported", type(model).__name__)
+        return None
+
+    model = copy.deepcopy(model).to(torch.device("cpu"), torch.float)
+    model.eval()
+
+    try:
+        quantize_dynamic = torch.ao.quantization.quantize_dynamic
+    except AttributeError:  # Older PyTorch versions
+        quantize_dynamic = torch.quantization.quantize_dynamic
+
+    linear_layers = [name for name, module in model.named_modules() if isinstance(module, nn.Linear)]
+    if len(linear_layers) < 2:
+        logger.warning("Model has only one linear layer, nothing to quantize")
+        return None
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        quantized_model = quantize_dynamic(model, set(linear_layers[1:]), dtype=torch.qint8)
+
+    return quantized_model
@@ -2,6 +2,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import grad
 from madminer.utils.ml.utils import get_activation_function
 import logging
@@ -18,6 +19,7 @@ class DenseSingleParameterizedRatioModel(nn.Module):
         super(DenseSingleParameterizedRatioModel, self).__init__()
 
         # Save input
+        self.n_parameters = n_parameters
         self.n_hidden = n_hidden
         self.activation = get_activation_function(activation)
         self.dropout_prob = dropout_prob
@@ -88,6 +90,78 @@ class DenseSingleParameterizedRatioModel(nn.Module):
 
         return s_hat, log_r_hat, t_hat
 
+    def project_x(self, x):
+
+        """ Calculates the x-dependent part of the first linear layer. The input to this layer is cat(theta, x), so
+        its output splits into W_theta theta + W_x x + b, and W_x x can be reused for any number of thetas. """
+
+        i_first = self._first_linear_layer()
+        x = self._preprocess_input(x, i_first)
+        return F.linear(x, self.layers[i_first].weight[:, self.n_parameters :])
+
+    def forward_grid(self, theta, x_projection, track_score=True, create_gradient_graph=True):
+
+        """ Calculates the estimated log likelihood ratio and the derived score for all combinations of theta (shape
+        (n_thetas, n_parameters)) and the observations encoded in x_projection (the output of project_x(), shape
+        (n_xs, n_hidden[0])). Returns log_r_hat with shape (n_thetas, n_xs) and t_hat with shape
+        (n_thetas, n_xs, n_parameters). """
+
+        n_thetas, n_xs = theta.size(0), x_projection.size(0)
+        i_first = self._first_linear_layer()
+        first_layer = self.layers[i_first]
+
+        # The score needs one copy of theta per combination, otherwise the gradient would be summed over x
+        if track_score:
+            if not theta.requires_grad:
+                theta.requires_grad = True
+            theta_expanded = theta.unsqueeze(1).expand(n_thetas, n_xs, theta.size(1))
+            theta_projection = F.linear(
+                self._preprocess_input(theta_expanded, i_first),
+                first_layer.weight[:, : self.n_parameters],
+                first_layer.bias,
+            )
+            log_r_hat = theta_projection + x_projection.unsqueeze(0)
+        else:
+            theta_projection = F.linear(
+                self._preprocess_input(theta, i_first), first_layer.weight[:, : self.n_parameters], first_layer.bias
+            )
+            log_r_hat = theta_projection.unsqueeze(1) + x_projection.unsqueeze(0)
+
+        # Remaining layers
+        log_r_hat = log_r_hat.view(n_thetas * n_xs, -1)
+        for layer in self.layers[i_first + 1 :]:
+            log_r_hat = layer(self.activation(log_r_hat))
+        log_r_hat = log_r_hat.view(n_thetas, n_xs)
+
+        # Score t
+        if track_score:
+            t_hat, = grad(
+                log_r_hat,
+                theta_expanded,
+                grad_outputs=torch.ones_like(log_r_hat.data),
+                only_inputs=True,
+                create_graph=create_gradient_graph,
+            )
+        else:
+            t_hat = None
+
+        return log_r_hat, t_hat
+
+    def _first_linear_layer(self):
+        for i, layer in enumerate(self.layers):
+            if isinstance(layer, nn.Linear):
+                return i
+
+    def _preprocess_input(self, inputs, i_first):
+        # Layers before the first linear one (dropout and the activation in front of it) act element-wise, so they
+        # can be applied to theta and x separately
+        for i, layer in enumerate(self.layers[: i_first + 1]):
+            if i > 0:
+                inputs = self.activation(inputs)
+            if i < i_first:
+                inputs = layer(inputs)
+        return inputs
+
     def to(self, *args, **kwargs):
         self = super(DenseSingleParameterizedRatioModel, self).to(*args, **kwargs)
 
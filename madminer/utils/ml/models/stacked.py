@@ -0,0 +1,172 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.autograd import grad
+import logging
+
+from madminer.utils.ml.models.ratio import DenseSingleParameterizedRatioModel
+from madminer.utils.ml.models.score import DenseLocalScoreModel
+
+logger = logging.getLogger(__name__)
+
+
+class StackedDenseModel(nn.Module):
+    """ Module that evaluates several dense networks with the same architecture (for instance the members of an
+    ensemble) in one pass. The weights of each layer are stacked into a tensor with shape
+    (n_networks, n_inputs, n_outputs), so that every layer is a single batched matrix multiplication. """
+
+    def __init__(self, weights, biases, activation):
+
+        super(StackedDenseModel, self).__init__()
+
+        self.n_networks = weights[0].shape[0]
+        self.activation = activation
+        self.weights = nn.ParameterList([nn.Parameter(w, requires_grad=False) for w in weights])
+        self.biases = nn.ParameterList([nn.Parameter(b, requires_grad=False) for b in biases])
+
+    @classmethod
+    def from_estimators(cls, estimators):
+        """ Builds the stacked model from trained estimators, or returns None if they cannot be stacked. The input
+        rescaling and feature selection of each estimator are absorbed into its first layer, so all networks take the
+        same raw input: x for local score models and cat(theta, x) for parameterized ratio models. """
+
+        models = [estimator.model for estimator in estimators]
+        model_types = set([type(model) for model in models])
+        if len(model_types) != 1:
+            return None
+        if list(model_types)[0] not in [DenseLocalScoreModel, DenseSingleParameterizedRatioModel]:
+            return None
+        if len(set([estimator.activation for estimator in estimators])) != 1:
+            return None
+
+        # Dropout layers would put a nonlinearity in front of the first linear layer
+        if any([estimator.dropout_prob > 1.0e-9 for estimator in estimators]):
+            return None
+
+        parameterized = isinstance(models[0], DenseSingleParameterizedRatioModel)
+        n_parameters = models[0].n_parameters if parameterized else 0
+
+        all_weights, all_biases = [], []
+        for estimator, model in zip(estimators, models):
+            layers = [layer for layer in model.layers if isinstance(layer, nn.Linear)]
+            weights = [layer.weight.detach().cpu().numpy().astype(np.float64) for layer in layers]
+            biases = [layer.bias.detach().cpu().numpy().astype(np.float64) for layer in layers]
+            weights[0], biases[0] = cls._absorb_input_transform(estimator, weights[0], biases[0], n_parameters)
+            all_weights.append(weights)
+            all_biases.append(biases)
+
+        shapes = set([tuple([w.shape for w in weights]) for weights in all_weights])
+        if len(shapes) != 1:
+            return None
+
+        stacked_weights = [
+            torch.tensor(np.array([weights[i].T for weights in all_weights]), dtype=torch.float)
+            for i in range(len(all_weights[0]))
+        ]
+        stacked_biases = [
+            torch.tensor(np.array([biases[i][np.newaxis, :] for biases in all_biases]), dtype=torch.float)
+            for i in range(len(all_biases[0]))
+        ]
+        return cls(stacked_weights, stacked_biases, models[0].activation)
+
+    @staticmethod
+    def _absorb_input_transform(estimator, weight, bias, n_parameters):
+        # Columns for theta (if any), then for x
+        weight_theta, weight_x = weight[:, :n_parameters], weight[:, n_parameters:]
+
+        # Feature selection and input rescaling: W (x[f] - m[f]) / s[f] + b = W' x + b'
+        if estimator.x_scaling_means is not None and estimator.x_scaling_stds is not None:
+            means, stds = estimator.x_scaling_means, estimator.x_scaling_stds
+        else:
+            n_observables = weight_x.shape[1] if estimator.features is None else max(estimator.features) + 1
+            means, stds = np.zeros(n_observables), np.ones(n_observables)
+        features = list(range(len(means))) if estimator.features is None else list(estimator.features)
+
+        weight_x_full = np.zeros((weight.shape[0], len(means)))
+        weight_x_full[:, features] = weight_x / stds[features][np.newaxis, :]
+        bias = bias - weight_x.dot(means[features] / stds[features])
+
+        # Parameter rescaling
+        if n_parameters > 0:
+            theta_means = getattr(estimator, "theta_scaling_means", None)
+            theta_stds = getattr(estimator, "theta_scaling_stds", None)
+            if theta_means is not None and theta_stds is not None:
+                bias = bias - weight_theta.dot(theta_means / theta_stds)
+                weight_theta = weight_theta / theta_stds[np.newaxis, :]
+
+        weight = np.concatenate((weight_theta, weight_x_full), axis=1)
+        return weight, bias
+
+    def first_layer(self, inputs, columns=None):
+        """ Applies the first layer. With columns, only these input columns are used and the bias is left out, so
+        that the contributions of different input blocks can be calculated separately and added up. """
+
+        weight = self.weights[0]
+        if columns is not None:
+            weight = weight[:, columns, :]
+            return torch.bmm(self._expand(inputs), weight)
+        return torch.baddbmm(self.biases[0], self._expand(inputs), weight)
+
+    def hidden_layers(self, hidden):
+        """ Applies all layers after the first one to hidden with shape (n_networks, n_samples, n_hidden) """
+
+        for weight, bias in zip(self.weights[1:], self.biases[1:]):
+            hidden = torch.baddbmm(bias, self.activation(hidden), weight)
+        return hidden
+
+    def forward(self, inputs):
+        """ Evaluates all networks on inputs with shape (n_samples, n_inputs) (shared between the networks) or
+        (n_networks, n_samples, n_inputs). Returns a tensor with shape (n_networks, n_samples, n_outputs). """
+
+        return self.hidden_layers(self.first_layer(inputs))
+
+    def forward_grid(self, theta, x, track_score=False):
+        """ Evaluates stacked parameterized ratio models for all combinations of theta with shape
+        (n_thetas, n_parameters) and x with shape (n_xs, n_observables). Returns log_r_hat with shape
+        (n_networks, n_thetas, n_xs) and the score t_hat with shape (n_networks, n_thetas, n_xs, n_parameters). """
+
+        n_thetas, n_parameters = theta.shape
+        n_xs = x.shape[0]
+        parameter_columns = list(range(n_parameters))
+        observable_columns = list(range(n_parameters, self.weights[0].shape[1]))
+
+        # The x part of the first layer is calculated once for all thetas
+        x_projection = self.first_layer(x, observable_columns)  # (n_networks, n_xs, n_hidden)
+
+        if track_score:
+            # One copy of theta per network and combination, so the gradients are not summed
+            theta = theta.unsqueeze(1).expand(n_thetas, n_xs, n_parameters).reshape(-1, n_parameters)
+            theta = self._expand(theta).clone().requires_grad_(True)
+            hidden = torch.baddbmm(self.biases[0], theta, self.weights[0][:, parameter_columns, :])
+            hidden = hidden.view(self.n_networks, n_thetas, n_xs, -1) + x_projection.unsqueeze(1)
+        else:
+            theta_projection = torch.baddbmm(
+                self.biases[0], self._expand(theta), self.weights[0][:, parameter_columns, :]
+            )  # (n_networks, n_thetas, n_hidden)
+            hidden = theta_projection.unsqueeze(2) + x_projection.unsqueeze(1)
+
+        log_r_hat = self.hidden_layers(hidden.view(self.n_networks, n_thetas * n_xs, -1))
+
+        if track_score:
+            t_hat, = grad(log_r_hat, theta, grad_outputs=torch.ones_like(log_r_hat.data), only_inputs=True)
+            t_hat = t_hat.view(self.n_networks, n_thetas, n_xs, n_parameters)
+        else:
+            t_hat = None
+
+        return log_r_hat.view(self.n_networks, n_thetas, n_xs), t_hat
+
+    def forward_with_score(self, theta, x):
+        """ Evaluates stacked parameterized ratio models for the pairs (theta[i], x[i]) and returns log_r_hat with
+        shape (n_networks, n_samples) and the score t_hat with shape (n_networks, n_samples, n_parameters). """
+
+        theta = self._expand(theta).clone().requires_grad_(True)
+        log_r_hat = self.forward(torch.cat((theta, self._expand(x)), 2))
+        t_hat, = grad(log_r_hat, theta, grad_outputs=torch.ones_like(log_r_hat.data), only_inputs=True)
+        return log_r_hat[:, :, 0], t_hat
+
+    def _expand(self, inputs):
+        if inputs.dim() == 2:
+            return inputs.unsqueeze(0).expand(self.n_networks, -1, -1)
+        return inputs
@@ -2,15 +2,21 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import six
 import logging
+import os
+import random
 from collections import OrderedDict
 import numpy as np
+import threading
 import time
+import sys
 import torch
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data import Dataset
 from torch.nn.utils import clip_grad_norm_
 
+from madminer.utils.ml import distributed
+from madminer.utils.various import is_out_of_core
+
 logger = logging.getLogger(__name__)
 
 
@@ -22,6 +28,23 @@ class NanException(Exception):
     pass
 
 
+class TrainingCallback(object):
+    """
+    Base class for user callbacks during training. Subclasses can overwrite any of the methods, which are called by
+    Trainer.train() after each minibatch and after each epoch. The trainer itself is passed as first argument, giving
+    access to the model and the timers in trainer.timer.
+    """
+
+    def on_batch_end(self, trainer, i_epoch, i_batch, n_samples, loss):
+        """ Called after each training minibatch with n_samples samples and training loss loss. """
+        pass
+
+    def on_epoch_end(self, trainer, i_epoch, epoch_profile):
+        """ Called after each epoch. epoch_profile is the dict that is also added to the training profile, with the
+        losses, learning rate, duration, throughput, data loading stall fraction, and peak memory of the epoch. """
+        pass
+
+
 class NumpyDataset(Dataset):
     """ Dataset for numpy arrays with explicit memmap support """
 
@@ -37,7 +60,7 @@ class NumpyDataset(Dataset):
                 self.n = array.shape[0]
             assert array.shape[0] == self.n
 
-            if isinstance(array, np.memmap):
+            if is_out_of_core(array):
                 self.memmap.append(True)
                 self.data.append(array)
             else:
@@ -59,10 +82,122 @@ class NumpyDataset(Dataset):
         return self.n
 
 
+class TensorBatchLoader(object):
+    """ Minimal replacement for DataLoader for in-memory tensors: each minibatch is one slice of every tensor with a
+    (permuted) index array, instead of batch_size calls of __getitem__ and a collate step """
+
+    def __init__(self, tensors, batch_size, shuffle=True):
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.n = tensors[0].shape[0]
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(self.n)
+        else:
+            indices = torch.arange(self.n)
+
+        for start in range(0, self.n, self.batch_size):
+            batch_indices = indices[start : start + self.batch_size]
+            yield tuple(tensor[batch_indices] for tensor in self.tensors)
+
+    def __len__(self):
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+
+class BlockShuffledLoader(object):
+    """
+    Streams minibatches from memory-mapped arrays that may be larger than the RAM. The samples are split into
+    contiguous blocks of block_size samples. In each epoch the blocks are visited in random order, n_buffer_blocks
+    of them are read into a buffer (contiguous reads), and minibatches are drawn from the shuffled buffer. The next
+    buffer is read in a background thread while the current one is used for training.
+    """
+
+    def __init__(self, dataset, batch_size, blocks, shuffle=True, n_buffer_blocks=16):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.blocks = blocks
+        self.shuffle = shuffle
+        self.n_buffer_blocks = n_buffer_blocks
+        self.n = sum([end - start for start, end in blocks])
+
+    @staticmethod
+    def make_blocks(n_samples, block_size):
+        return [(start, min(start + block_size, n_samples)) for start in range(0, n_samples, block_size)]
+
+    def __iter__(self):
+        blocks = list(self.blocks)
+        if self.shuffle:
+            blocks = [blocks[i] for i in np.random.permutation(len(blocks))]
+        buffers = [
+            sorted(blocks[i : i + self.n_buffer_blocks]) for i in range(0, len(blocks), self.n_buffer_blocks)
+        ]
+
+        queue = six.moves.queue.Queue(maxsize=1)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_buffers, args=(buffers, queue, stop))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            leftover = None
+            for _ in buffers:
+                buffer = queue.get()
+                if isinstance(buffer, Exception):
+                    raise buffer
+                if leftover is not None:
+                    buffer = [torch.cat((old, new), 0) for old, new in zip(leftover, buffer)]
+
+                n = buffer[0].shape[0]
+                indices = torch.randperm(n) if self.shuffle else torch.arange(n)
+                n_full = n - n % self.batch_size
+                for start in range(0, n_full, self.batch_size):
+                    batch_indices = indices[start : start + self.batch_size]
+                    yield tuple(tensor[batch_indices] for tensor in buffer)
+
+                # Samples that do not fill a batch are mixed into the next buffer
+                leftover = [tensor[indices[n_full:]] for tensor in buffer] if n_full < n else None
+
+            if leftover is not None:
+                yield tuple(leftover)
+
+        finally:
+            stop.set()
+
+    def _read_buffers(self, buffers, queue, stop):
+        try:
+            for blocks in buffers:
+                buffer = self._read_blocks(blocks)
+                while not stop.is_set():
+                    try:
+                        queue.put(buffer, timeout=0.1)
+                        break
+                    except six.moves.queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            queue.put(e)
+
+    def _read_blocks(self, blocks):
+        buffer = []
+        for memmap, array in zip(self.dataset.memmap, self.dataset.data):
+            if memmap:
+                data = np.concatenate([np.asarray(array[start:end]) for start, end in blocks], 0)
+                buffer.append(torch.from_numpy(data).to(self.dataset.dtype))
+            else:
+                buffer.append(torch.cat([array[start:end] for start, end in blocks], 0))
+        return buffer
+
+    def __len__(self):
+        return (self.n + self.batch_size - 1) // self.batch_size
+
+
 class Trainer(object):
     """ Trainer class. Any subclass has to implement the forward_pass() function. """
 
-    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=8):
+    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=None, block_size=16384):
         self._init_timer()
         self._timer(start="ALL")
         self._timer(start="initialize model")
@@ -70,10 +205,16 @@ class Trainer(object):
         self.run_on_gpu = run_on_gpu and torch.cuda.is_available()
         self.device = torch.device("cuda" if self.run_on_gpu else "cpu")
         self.dtype = torch.double if double_precision else torch.float
-        self.n_workers = n_workers
+        self.block_size = block_size
+        self.rank, self.world_size = 0, 1
+        self.max_batches = None
 
         self.model = self.model.to(self.device, self.dtype)
 
+        # The batches are no longer loaded with a multi-process torch DataLoader, so n_workers has no effect
+        if n_workers is not None:
+            logger.warning("The n_workers argument is deprecated and will be ignored")
+
         logger.info(
             "Training on %s with %s precision",
             "GPU" if self.run_on_gpu else "CPU",
@@ -101,6 +242,11 @@ class Trainer(object):
         early_stopping_patience=None,
         clip_gradient=None,
         verbose="some",
+        checkpoint_path=None,
+        checkpoint_every=1,
+        resume_from=None,
+        callbacks=None,
+        return_profile=False,
     ):
         self._timer(start="ALL")
         self._timer(start="check data")
@@ -119,8 +265,29 @@ class Trainer(object):
         else:
             dataset_val = None
         self._timer(stop="make dataset", start="make dataloader")
+
+        # Data-parallel training: each process trains on its own shard of the data
+        self.rank, self.world_size = distributed.get_rank(), distributed.get_world_size()
+        if self.world_size > 1:
+            logger.info("Data-parallel training in process %s of %s", self.rank + 1, self.world_size)
+            distributed.broadcast_model(self.model)
+
+        # When resuming, the RNG state from the start of the original run reproduces its validation split
+        checkpoint = None
+        if resume_from is not None:
+            logger.info("Resuming training from checkpoint %s", resume_from)
+            checkpoint = self.load_checkpoint(resume_from)
+            self._set_rng_state(checkpoint["initial_rng_state"])
+        initial_rng_state = self._get_rng_state()
+
         train_loader, val_loader = self.make_dataloaders(dataset, dataset_val, validation_split, batch_size)
 
+        # All processes have to go through the same number of minibatches, since each one ends with an all-reduce
+        self.max_batches = None
+        if self.world_size > 1:
+            self.max_batches = distributed.all_reduce_min(len(train_loader))
+            logger.debug("Training on %s minibatches per process and epoch", self.max_batches)
+
         self._timer(stop="make dataloader", start="setup optimizer")
         logger.debug("Setting up optimizer")
         optimizer_kwargs = {} if optimizer_kwargs is None else optimizer_kwargs
@@ -154,12 +321,24 @@ class Trainer(object):
             raise ValueError("Unknown value %s for keyword verbose", verbose)
         logger.debug("Will print training progress every %s epochs", n_epochs_verbose)
 
-        logger.debug("Beginning main training loop")
+        callbacks = [] if callbacks is None else list(callbacks)
+        epoch_profiles = []
         losses_train, losses_val = [], []
+        first_epoch, loss_val = 0, None
+        if checkpoint is not None:
+            first_epoch, best_loss, best_model, best_epoch, losses_train, losses_val = self.restore_checkpoint(
+                checkpoint, opt, epochs, initial_lr, final_lr
+            )
+            loss_val = losses_val[-1] if len(losses_val) > 0 else None
+            logger.info("Continuing training after epoch %s", first_epoch)
+        if checkpoint_path is not None:
+            logger.debug("Will save a checkpoint to %s every %s epochs", checkpoint_path, checkpoint_every)
+
+        logger.debug("Beginning main training loop")
         self._timer(stop="initialize training")
 
         # Loop over epochs
-        for i_epoch in range(epochs):
+        for i_epoch in range(first_epoch, epochs):
             logger.debug("Training epoch %s / %s", i_epoch + 1, epochs)
 
             self._timer(start="set lr")
@@ -168,10 +347,20 @@ class Trainer(object):
             logger.debug("Learning rate: %s", lr)
             self._timer(stop="set lr")
             loss_val = None
+            time_epoch = time.time()
+            time_loading = self._data_loading_time()
 
             try:
-                loss_train, loss_val, loss_contributions_train, loss_contributions_val = self.epoch(
-                    i_epoch, data_labels, train_loader, val_loader, opt, loss_functions, loss_weights, clip_gradient
+                loss_train, loss_val, loss_contributions_train, loss_contributions_val, n_samples = self.epoch(
+                    i_epoch,
+                    data_labels,
+                    train_loader,
+                    val_loader,
+                    opt,
+                    loss_functions,
+                    loss_weights,
+                    clip_gradient,
+                    callbacks,
                 )
                 losses_train.append(loss_train)
                 losses_val.append(loss_val)
@@ -179,13 +368,33 @@ class Trainer(object):
                 logger.info("Ending training during epoch %s because NaNs appeared", i_epoch + 1)
                 break
 
+            epoch_profile = self.profile_epoch(
+                i_epoch,
+                lr,
+                loss_train,
+                loss_val,
+                n_samples,
+                time.time() - time_epoch,
+                self._data_loading_time() - time_loading,
+            )
+            epoch_profiles.append(epoch_profile)
+            for callback in callbacks:
+                callback.on_epoch_end(self, i_epoch, epoch_profile)
+
+            # In data-parallel training, the first process decides on early stopping
             self._timer(start="early stopping")
             if early_stopping:
-                try:
-                    best_loss, best_model, best_epoch = self.check_early_stopping(
-                        best_loss, best_model, best_epoch, loss_val, i_epoch, early_stopping_patience
-                    )
-                except EarlyStoppingException:
+                stop = False
+                if self.rank == 0:
+                    try:
+                        best_loss, best_model, best_epoch = self.check_early_stopping(
+                            best_loss, best_model, best_epoch, loss_val, i_epoch, early_stopping_patience
+                        )
+                    except EarlyStoppingException:
+                        stop = True
+                if self.world_size > 1:
+                    stop = distributed.broadcast_flag(stop)
+                if stop:
                     logger.info("Early stopping: ending training after %s epochs", i_epoch + 1)
                     break
             self._timer(stop="early stopping", start="report epoch")
@@ -198,13 +407,34 @@ class Trainer(object):
                 loss_val,
                 loss_contributions_train,
                 loss_contributions_val,
-                verbose=verbose_epoch,
+                verbose=verbose_epoch and self.rank == 0,
             )
             self._timer(stop="report epoch")
 
+            last_epoch = i_epoch + 1 == epochs
+            if checkpoint_path is not None and self.rank == 0 and ((i_epoch + 1) % checkpoint_every == 0 or last_epoch):
+                self._timer(start="save checkpoint")
+                self.save_checkpoint(
+                    checkpoint_path,
+                    opt,
+                    i_epoch,
+                    epochs,
+                    initial_lr,
+                    final_lr,
+                    best_loss,
+                    best_model,
+                    best_epoch,
+                    losses_train,
+                    losses_val,
+                    initial_rng_state,
+                )
+                self._timer(stop="save checkpoint")
+
         self._timer(start="early stopping")
-        if early_stopping and len(losses_val) > 0:
+        if early_stopping and len(losses_val) > 0 and self.rank == 0:
             self.wrap_up_early_stopping(best_model, loss_val, best_loss, best_epoch)
+        if self.world_size > 1:
+            distributed.broadcast_model(self.model)
         self._timer(stop="early stopping")
 
         logger.debug("Training finished")
@@ -212,6 +442,11 @@ class Trainer(object):
         self._timer(stop="ALL")
         self._report_timer()
 
+        if return_profile:
+            profile = OrderedDict(
+                [("timers", OrderedDict(self.timer)), ("epochs", epoch_profiles), ("peak_memory", self._peak_memory())]
+            )
+            return np.array(losses_train), np.array(losses_val), profile
         return np.array(losses_train), np.array(losses_val)
 
     @staticmethod
@@ -220,6 +455,8 @@ class Trainer(object):
         for key, value in six.iteritems(data):
             if value is None:
                 logger.debug("  %s: -", key)
+            elif is_out_of_core(value):
+                logger.debug("  %s: shape %s, memory-mapped", key, value.shape)
             else:
                 logger.debug(
                     "  %s: shape %s, first %s, mean %s, min %s, max %s",
@@ -245,49 +482,93 @@ class Trainer(object):
         return data_labels, dataset
 
     def make_dataloaders(self, dataset, dataset_val, validation_split, batch_size):
+        # In data-parallel training, all processes have to agree on the validation split
+        random_state = np.random
+        if self.world_size > 1:
+            random_state = np.random.RandomState(distributed.broadcast_seed())
+
+        in_memory = not any(dataset.memmap) and (dataset_val is None or not any(dataset_val.memmap))
+        if in_memory:
+            return self._make_tensor_loaders(dataset, dataset_val, validation_split, batch_size, random_state)
+        return self._make_streaming_loaders(dataset, dataset_val, validation_split, batch_size, random_state)
+
+    def _make_streaming_loaders(self, dataset, dataset_val, validation_split, batch_size, random_state=np.random):
+        logger.debug("Data is memory-mapped, streaming shuffled blocks of %s samples", self.block_size)
+        blocks = BlockShuffledLoader.make_blocks(len(dataset), self.block_size)
+
         if dataset_val is None and (validation_split is None or validation_split <= 0.0):
-            train_loader = DataLoader(
-                dataset, batch_size=batch_size, shuffle=True, pin_memory=self.run_on_gpu, num_workers=self.n_workers
-            )
+            train_loader = BlockShuffledLoader(dataset, batch_size, self._shard_blocks(blocks))
             val_loader = None
 
         elif dataset_val is not None:
-            train_loader = DataLoader(
-                dataset, batch_size=batch_size, shuffle=True, pin_memory=self.run_on_gpu, num_workers=self.n_workers
-            )
-            val_loader = DataLoader(
-                dataset_val, batch_size=batch_size, shuffle=True, pin_memory=self.run_on_gpu, num_workers=self.n_workers
+            train_loader = BlockShuffledLoader(dataset, batch_size, self._shard_blocks(blocks))
+            blocks_val = BlockShuffledLoader.make_blocks(len(dataset_val), self.block_size)
+            val_loader = BlockShuffledLoader(dataset_val, batch_size, self._shard_blocks(blocks_val))
+
+        else:
+            assert 0.0 < validation_split < 1.0, "Wrong validation split: {}".format(validation_split)
+            assert len(blocks) > 1, "Not enough samples for a validation split with block size {}".format(
+                self.block_size
             )
 
+            # Whole blocks are assigned to the validation set, so it can be read contiguously as well
+            n_blocks_val = min(max(int(round(validation_split * len(blocks))), 1), len(blocks) - 1)
+            permutation = random_state.permutation(len(blocks))
+            blocks_val = sorted([blocks[i] for i in permutation[:n_blocks_val]])
+            blocks_train = sorted([blocks[i] for i in permutation[n_blocks_val:]])
+
+            train_loader = BlockShuffledLoader(dataset, batch_size, self._shard_blocks(blocks_train))
+            val_loader = BlockShuffledLoader(dataset, batch_size, self._shard_blocks(blocks_val))
+
+        return train_loader, val_loader
+
+    def _make_tensor_loaders(self, dataset, dataset_val, validation_split, batch_size, random_state=np.random):
+        logger.debug("Data is in memory, batching tensors directly")
+
+        if dataset_val is None and (validation_split is None or validation_split <= 0.0):
+            train_loader = TensorBatchLoader(self._shard_tensors(dataset.data, random_state), batch_size)
+            val_loader = None
+
+        elif dataset_val is not None:
+            train_loader = TensorBatchLoader(self._shard_tensors(dataset.data, random_state), batch_size)
+            val_loader = TensorBatchLoader(self._shard_tensors(dataset_val.data, random_state), batch_size)
+
         else:
             assert 0.0 < validation_split < 1.0, "Wrong validation split: {}".format(validation_split)
 
+            # Shuffle once, then the validation and training sets are contiguous index ranges
             n_samples = len(dataset)
-            indices = list(range(n_samples))
             split = int(np.floor(validation_split * n_samples))
-            np.random.shuffle(indices)
-            train_idx, valid_idx = indices[split:], indices[:split]
-
-            train_sampler = SubsetRandomSampler(train_idx)
-            val_sampler = SubsetRandomSampler(valid_idx)
-
-            train_loader = DataLoader(
-                dataset,
-                sampler=train_sampler,
-                batch_size=batch_size,
-                pin_memory=self.run_on_gpu,
-                num_workers=self.n_workers,
-            )
-            val_loader = DataLoader(
-                dataset,
-                sampler=val_sampler,
-                batch_size=batch_size,
-                pin_memory=self.run_on_gpu,
-                num_workers=self.n_workers,
-            )
+            indices = torch.from_numpy(random_state.permutation(n_samples))
+            tensors = [tensor[indices] for tensor in dataset.data]
+
+            train_loader = TensorBatchLoader(self._shard_tensors([tensor[split:] for tensor in tensors]), batch_size)
+            val_loader = TensorBatchLoader(self._shard_tensors([tensor[:split] for tensor in tensors]), batch_size)
 
         return train_loader, val_loader
 
+    def _shard_tensors(self, tensors, random_state=None):
+        """ Returns the samples processed by this process in data-parallel training: an equally sized slice for each
+        process, after a permutation shared between the processes if random_state is given """
+
+        if self.world_size == 1:
+            return tensors
+        if random_state is not None:
+            indices = torch.from_numpy(random_state.permutation(tensors[0].shape[0]))
+            tensors = [tensor[indices] for tensor in tensors]
+        n_shard = tensors[0].shape[0] // self.world_size
+        return [tensor[self.rank * n_shard : (self.rank + 1) * n_shard] for tensor in tensors]
+
+    def _shard_blocks(self, blocks):
+        """ Returns the blocks of samples processed by this process in data-parallel training """
+
+        if self.world_size == 1:
+            return blocks
+        assert len(blocks) >= self.world_size, "Fewer blocks of {} samples than processes, reduce block_size".format(
+            self.block_size
+        )
+        return blocks[self.rank :: self.world_size]
+
     @staticmethod
     def calculate_lr(i_epoch, n_epochs, initial_lr, final_lr):
         if n_epochs == 1:
@@ -309,15 +590,23 @@ class Trainer(object):
         loss_functions,
         loss_weights,
         clip_gradient=None,
+        callbacks=None,
     ):
         n_losses = len(loss_functions)
+        callbacks = [] if callbacks is None else callbacks
 
         self.model.train()
         loss_contributions_train = np.zeros(n_losses)
         loss_train = 0.0
+        n_samples = 0
 
         self._timer(start="load training batch")
+        n_batches = 0
         for i_batch, batch_data in enumerate(train_loader):
+            if self.max_batches is not None and i_batch >= self.max_batches:
+                break
+            n_batches += 1
+            n_batch_samples = len(batch_data[0])
             batch_data = OrderedDict(list(zip(data_labels, batch_data)))
             self._timer(stop="load training batch")
 
@@ -329,43 +618,60 @@ class Trainer(object):
                 loss_contributions_train[i] += batch_loss_contribution
 
             self.report_batch(i_epoch, i_batch, batch_loss)
+            n_samples += n_batch_samples
+            for callback in callbacks:
+                callback.on_batch_end(self, i_epoch, i_batch, n_batch_samples, batch_loss)
 
             self._timer(start="load training batch")
         self._timer(stop="load training batch")
 
-        loss_contributions_train /= len(train_loader)
-        loss_train /= len(train_loader)
+        loss_train, loss_contributions_train = self._average_losses(loss_train, loss_contributions_train, n_batches)
 
         if val_loader is not None:
             self.model.eval()
             loss_contributions_val = np.zeros(n_losses)
             loss_val = 0.0
 
+            n_batches = 0
             self._timer(start="load validation batch")
-            for i_batch, batch_data in enumerate(val_loader):
-                batch_data = OrderedDict(list(zip(data_labels, batch_data)))
-                self._timer(stop="load validation batch")
+            try:
+                for i_batch, batch_data in enumerate(val_loader):
+                    batch_data = OrderedDict(list(zip(data_labels, batch_data)))
+                    self._timer(stop="load validation batch")
 
-                batch_loss, batch_loss_contributions = self.batch_val(batch_data, loss_functions, loss_weights)
-                loss_val += batch_loss
-                for i, batch_loss_contribution in enumerate(batch_loss_contributions):
-                    loss_contributions_val[i] += batch_loss_contribution
+                    batch_loss, batch_loss_contributions = self.batch_val(batch_data, loss_functions, loss_weights)
+                    loss_val += batch_loss
+                    n_batches += 1
+                    for i, batch_loss_contribution in enumerate(batch_loss_contributions):
+                        loss_contributions_val[i] += batch_loss_contribution
 
-                self._timer(start="load validation batch")
+                    self._timer(start="load validation batch")
+            except NanException:
+                # The other processes are waiting for the validation loss
+                if self.world_size == 1:
+                    raise
+                loss_val = np.nan
             self._timer(stop="load validation batch")
 
-            loss_contributions_val /= len(val_loader)
-            loss_val /= len(val_loader)
+            loss_val, loss_contributions_val = self._average_losses(loss_val, loss_contributions_val, n_batches)
+            if self.world_size > 1 and np.isnan(loss_val):
+                raise NanException
 
         else:
             loss_contributions_val = None
             loss_val = None
 
-        return loss_train, loss_val, loss_contributions_train, loss_contributions_val
+        return loss_train, loss_val, loss_contributions_train, loss_contributions_val, n_samples
 
     def batch_train(self, batch_data, loss_functions, loss_weights, optimizer, clip_gradient=None):
         self._timer(start="training forward pass")
-        loss_contributions = self.forward_pass(batch_data, loss_functions)
+        try:
+            loss_contributions = self.forward_pass(batch_data, loss_functions)
+        except NanException:
+            # The other processes are waiting for the gradients
+            if self.world_size > 1:
+                distributed.all_reduce_gradients(self.model, failed=True)
+            raise
         self._timer(stop="training forward pass", start="training sum losses")
         loss = self.sum_losses(loss_contributions, loss_weights)
         self._timer(stop="training sum losses", start="optimizer step")
@@ -422,7 +728,14 @@ class Trainer(object):
         optimizer.zero_grad()
         self._timer(stop="opt: zero grad", start="opt: backward")
         loss.backward()
-        self._timer(start="opt: clip grad norm", stop="opt: backward")
+        self._timer(stop="opt: backward")
+        if self.world_size > 1:
+            self._timer(start="opt: all-reduce gradients")
+            failed = distributed.all_reduce_gradients(self.model)
+            self._timer(stop="opt: all-reduce gradients")
+            if failed:
+                raise NanException
+        self._timer(start="opt: clip grad norm")
         if clip_gradient is not None:
             clip_grad_norm_(self.model.parameters(), clip_gradient)
         self._timer(stop="opt: clip grad norm", start="opt: step")
@@ -432,7 +745,7 @@ class Trainer(object):
     def check_early_stopping(self, best_loss, best_model, best_epoch, loss, i_epoch, early_stopping_patience=None):
         if best_loss is None or loss < best_loss:
             best_loss = loss
-            best_model = self.model.state_dict()
+            best_model = OrderedDict((key, value.clone()) for key, value in six.iteritems(self.model.state_dict()))
             best_epoch = i_epoch
 
         if early_stopping_patience is not None and i_epoch - best_epoch > early_stopping_patience >= 0:
@@ -443,6 +756,14 @@ class Trainer(object):
 
         return best_loss, best_model, best_epoch
 
+    def _average_losses(self, loss, loss_contributions, n_batches):
+        """ Averages the summed minibatch losses over the minibatches, in data-parallel training of all processes """
+
+        if self.world_size > 1:
+            totals = distributed.all_reduce_sum([loss, n_batches] + list(loss_contributions))
+            loss, n_batches, loss_contributions = totals[0], totals[1], totals[2:]
+        return loss / n_batches, np.asarray(loss_contributions) / n_batches
+
     @staticmethod
     def report_batch(i_epoch, i_batch, loss_train):
         if i_batch in [0, 1, 10, 100, 1000]:
@@ -487,6 +808,102 @@ class Trainer(object):
         else:
             logger.info("Early stopping did not improve performance")
 
+    def save_checkpoint(
+        self,
+        filename,
+        optimizer,
+        i_epoch,
+        n_epochs,
+        initial_lr,
+        final_lr,
+        best_loss,
+        best_model,
+        best_epoch,
+        losses_train,
+        losses_val,
+        initial_rng_state,
+    ):
+        """ Saves the full training state after epoch i_epoch, such that train(resume_from=filename) continues with
+        the next epoch. The file is written to a temporary name first, so an interruption during saving leaves the
+        previous checkpoint intact. """
+
+        checkpoint = {
+            "epoch": i_epoch + 1,
+            "n_epochs": n_epochs,
+            "initial_lr": initial_lr,
+            "final_lr": final_lr,
+            "model_state_dict": self.model.state_dict(),
+            "optimizer_state_dict": optimizer.state_dict(),
+            "best_loss": best_loss,
+            "best_model_state_dict": best_model,
+            "best_epoch": best_epoch,
+            "losses_train": list(losses_train),
+            "losses_val": list(losses_val),
+            "initial_rng_state": initial_rng_state,
+            "rng_state": self._get_rng_state(),
+        }
+
+        logger.debug("Saving checkpoint after epoch %s to %s", i_epoch + 1, filename)
+        directory = os.path.dirname(filename)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        torch.save(checkpoint, filename + ".tmp")
+        if hasattr(os, "replace"):
+            os.replace(filename + ".tmp", filename)
+        else:  # Python 2: os.rename does not overwrite existing files on Windows
+            if os.name == "nt" and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(filename + ".tmp", filename)
+
+    def load_checkpoint(self, filename):
+        try:
+            return torch.load(filename, map_location=self.device, weights_only=False)
+        except TypeError:  # Older PyTorch versions do not know weights_only
+            return torch.load(filename, map_location=self.device)
+
+    def restore_checkpoint(self, checkpoint, optimizer, n_epochs, initial_lr, final_lr):
+        """ Loads model, optimizer, and RNG state from a checkpoint and returns the epoch to continue with and the
+        early stopping and loss history. """
+
+        schedule = (checkpoint["n_epochs"], checkpoint["initial_lr"], checkpoint["final_lr"])
+        if schedule != (n_epochs, initial_lr, final_lr):
+            logger.warning(
+                "Checkpoint was written for %s epochs with learning rate %s -> %s, now training for %s epochs with "
+                "learning rate %s -> %s. The learning rate schedule will not be continued smoothly.",
+                checkpoint["n_epochs"],
+                checkpoint["initial_lr"],
+                checkpoint["final_lr"],
+                n_epochs,
+                initial_lr,
+                final_lr,
+            )
+
+        self.model.load_state_dict(checkpoint["model_state_dict"])
+        optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+        self._set_rng_state(checkpoint["rng_state"])
+
+        return (
+            checkpoint["epoch"],
+            checkpoint["best_loss"],
+            checkpoint["best_model_state_dict"],
+            checkpoint["best_epoch"],
+            list(checkpoint["losses_train"]),
+            list(checkpoint["losses_val"]),
+        )
+
+    def _get_rng_state(self):
+        state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+        if self.run_on_gpu:
+            state["cuda"] = torch.cuda.get_rng_state_all()
+        return state
+
+    def _set_rng_state(self, state):
+        random.setstate(state["python"])
+        np.random.set_state(state["numpy"])
+        torch.set_rng_state(state["torch"].cpu())
+        if self.run_on_gpu and "cuda" in state:
+            torch.cuda.set_rng_state_all([cuda_state.cpu() for cuda_state in state["cuda"]])
+
     @staticmethod
     def _check_for_nans(label, *tensors):
         for tensor in tensors:
@@ -522,9 +939,52 @@ class Trainer(object):
         for key, value in six.iteritems(self.timer):
             logger.info("  {:>32s}: {:6.2f}h".format(key, value / 3600.0))
 
+    def profile_epoch(self, i_epoch, lr, loss_train, loss_val, n_samples, duration, loading_time):
+        """ Summarizes the performance of one epoch. The stall fraction is the fraction of the epoch spent waiting for
+        training or validation batches, a large value points to a bottleneck in the input pipeline. """
+
+        epoch_profile = OrderedDict(
+            [
+                ("epoch", i_epoch + 1),
+                ("lr", lr),
+                ("loss_train", loss_train),
+                ("loss_val", loss_val),
+                ("n_samples", n_samples),
+                ("time", duration),
+                ("samples_per_second", n_samples / duration if duration > 0.0 else None),
+                ("data_loading_time", loading_time),
+                ("stall_fraction", loading_time / duration if duration > 0.0 else None),
+                ("peak_memory", self._peak_memory()),
+            ]
+        )
+        logger.debug(
+            "  Epoch %s: %.1f samples/s, %.1f%% of the time spent loading data",
+            i_epoch + 1,
+            epoch_profile["samples_per_second"] or 0.0,
+            100.0 * (epoch_profile["stall_fraction"] or 0.0),
+        )
+        return epoch_profile
+
+    def _data_loading_time(self):
+        return self.timer.get("load training batch", 0.0) + self.timer.get("load validation batch", 0.0)
+
+    def _peak_memory(self):
+        """ Returns the peak memory usage in bytes: allocated GPU memory when training on a GPU, otherwise the
+        maximum resident set size of the process (None where that is not available). """
+
+        if self.run_on_gpu:
+            return int(torch.cuda.max_memory_allocated(self.device))
+        try:
+            import resource
+        except ImportError:  # Windows
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is given in bytes on macOS and in kilobytes on Linux
+        return int(peak) if sys.platform == "darwin" else int(peak) * 1024
+
 
 class SingleParameterizedRatioTrainer(Trainer):
-    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=8):
+    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=None):
         super(SingleParameterizedRatioTrainer, self).__init__(model, run_on_gpu, double_precision, n_workers)
         self.calculate_model_score = True
 
@@ -579,7 +1039,7 @@ class SingleParameterizedRatioTrainer(Trainer):
 
 
 class DoubleParameterizedRatioTrainer(Trainer):
-    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=8):
+    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=None):
         super(DoubleParameterizedRatioTrainer, self).__init__(model, run_on_gpu, double_precision, n_workers)
         self.calculate_model_score = True
 
@@ -675,7 +1135,7 @@ class LocalScoreTrainer(Trainer):
 
 
 class FlowTrainer(Trainer):
-    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=8):
+    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=None):
         super(FlowTrainer, self).__init__(model, run_on_gpu, double_precision, n_workers)
         self.calculate_model_score = True
 
@@ -6,6 +6,7 @@ import os
 import stat
 from subprocess import Popen, PIPE
 import io
+import multiprocessing
 import numpy as np
 import shutil
 from contextlib import contextmanager
@@ -14,6 +15,9 @@ logger = logging.getLogger(__name__)
 
 initialized = False
 
+_math_commands = None
+_compiled_expressions = {}
+
 
 def call_command(cmd, log_file=None, return_std=False):
     if log_file is not None:
@@ -151,9 +155,9 @@ def load_and_check(filename, warning_threshold=1.0e9, memmap_files_larger_than_g
 
     if not isinstance(filename, six.string_types):
         data = filename
-        memmap = False
+        memmap = is_out_of_core(data)
     else:
-        filesize_gb = os.stat(filename).st_size / 1.0 * 1024 ** 3
+        filesize_gb = os.stat(filename).st_size / 1024.0 ** 3
         if memmap_files_larger_than_gb is None or filesize_gb <= memmap_files_larger_than_gb:
             logger.info("  Loading %s into RAM", filename)
             data = np.load(filename)
@@ -183,9 +187,133 @@ def load_and_check(filename, warning_threshold=1.0e9, memmap_files_larger_than_g
     return data
 
 
+class TransformedMemmap(object):
+    """
+    Row-wise transformation of a memory-mapped array that is only applied when rows are read, so that rescaling
+    or feature selection does not load the full array into memory. Indexing with rows (an int, slice, or index array)
+    returns a transformed ndarray; indexing with [:, columns] returns another TransformedMemmap.
+    """
+
+    def __init__(self, array, transform):
+        self.array = array
+        self.transform = transform
+        self.shape = (array.shape[0],) + self.transform(np.asarray(array[:1])).shape[1:]
+        self.ndim = len(self.shape)
+        self.dtype = self.transform(np.asarray(array[:1])).dtype
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple) and len(index) > 1 and index[0] == slice(None):
+            columns = index[1:]
+            return TransformedMemmap(self, lambda rows: rows[(slice(None),) + columns])
+        return self.transform(np.asarray(self.array[index]))
+
+    def __len__(self):
+        return self.shape[0]
+
+
+def is_out_of_core(array):
+    """ Checks whether an array is memory-mapped (and should be read in chunks) """
+    return isinstance(array, (np.memmap, TransformedMemmap))
+
+
+def mean_and_std(array, axis=0, chunk_size=100000):
+    """ Mean and standard deviation along the first axis, calculated in chunks for memory-mapped arrays """
+    if not is_out_of_core(array):
+        return np.mean(array, axis=axis), np.std(array, axis=axis)
+
+    assert axis == 0, "Chunked mean and std only support axis=0"
+    n, sum_, sum_squares = 0, 0.0, 0.0
+    for start in range(0, array.shape[0], chunk_size):
+        chunk = np.asarray(array[start : start + chunk_size], dtype=np.float64)
+        n += chunk.shape[0]
+        sum_ = sum_ + np.sum(chunk, axis=0)
+        sum_squares = sum_squares + np.sum(chunk ** 2, axis=0)
+    mean = sum_ / n
+    std = np.sqrt(np.maximum(sum_squares / n - mean ** 2, 0.0))
+    return mean, std
+
+
 def math_commands():
-    """Provides list with math commands - we need this when using eval"""
+    """Provides list with math commands - we need this when using eval. The dict is only built once, every call returns
+    a new copy of it that the caller can extend with its own variables."""
+
+    return dict(_shared_math_commands())
+
+
+def eval_expression(code, variables):
+    """
+    Evaluates a compiled expression for one event. The math commands are passed to `eval()` as globals, using the same
+    dict for all events, and the variables of the event as locals, so that no namespace is built for every event.
+
+    Parameters
+    ----------
+    code : code
+        Expression compiled with `compile_expression()`.
+
+    variables : dict
+        Variables of the event, for instance particles and observables. They take precedence over the math commands.
+
+    Returns
+    -------
+    result : object
+        Value of the expression.
+
+    """
 
+    try:
+        return eval(code, _shared_math_commands(), variables)
+    except NameError:
+        # Comprehensions and lambdas within the expression only see the globals, so they are evaluated again with
+        # the variables as globals
+        namespace = math_commands()
+        namespace.update(variables)
+        return eval(code, namespace)
+
+
+def _shared_math_commands():
+    global _math_commands
+    if _math_commands is None:
+        _math_commands = _build_math_commands()
+    return _math_commands
+
+
+def compile_expression(expression):
+    """
+    Compiles a Python expression for `eval()`. The code object is cached, so every expression is only compiled once
+    per process, however often it is evaluated.
+
+    Parameters
+    ----------
+    expression : str
+        Python expression.
+
+    Returns
+    -------
+    code : code
+        Compiled expression.
+
+    Raises
+    ------
+    SyntaxError
+        If expression is not a valid Python expression.
+
+    """
+
+    try:
+        code = _compiled_expressions[expression]
+    except KeyError:
+        try:
+            code = compile(expression, "<string>", "eval")
+        except SyntaxError:
+            code = None
+        _compiled_expressions[expression] = code
+
+    if code is None:
+        raise SyntaxError("Invalid Python expression: {}".format(expression))
+    return code
+
+
+def _build_math_commands():
     from math import acos, asin, atan, atan2, ceil, cos, cosh, exp, floor, log, pi, pow, sin, sinh, sqrt, tan, tanh
 
     functions = [
@@ -215,6 +343,19 @@ def math_commands():
     return mathdefinitions
 
 
+def get_fork_context():
+    """
+    Returns the multiprocessing context that starts processes with fork, so that they inherit the state of the parent
+    process (for instance functions and models set up as module globals before the pool is created). On Python 2, or
+    where fork is not available, this is the multiprocessing module itself.
+    """
+
+    try:
+        return multiprocessing.get_context("fork")
+    except (AttributeError, ValueError):
+        return multiprocessing
+
+
 def make_file_executable(filename):
     st = os.stat(filename)
     os.chmod(filename, st.st_mode | stat.S_IEXEC)
@@ -0,0 +1,132 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+import pytest
+from collections import OrderedDict
+
+from madminer.utils.interfaces import delphes_root
+from madminer.utils.interfaces.delphes_root import parse_delphes_root_file
+
+awkward = pytest.importorskip("awkward")
+
+
+def jet_pt_plus_met(l, a, j, met):
+    if len(j) < 1:
+        raise RuntimeError("No jet")
+    return j[0].pt + met.pt
+
+
+OBSERVABLES = OrderedDict(
+    [
+        ("pt_j1", "j[0].pt"),
+        ("m_jj", "(j[0] + j[1]).m"),
+        ("n_l", "len(l)"),
+        ("charge_l1", "l[0].charge"),
+        ("et_miss", "met.pt"),
+        ("m_visible", "visible.m"),
+        ("max_pt", "max(j[0].pt, l[0].pt)"),
+        ("has_photon", "1 if len(a) > 0 else 0"),
+        ("function", jet_pt_plus_met),
+    ]
+)
+OBSERVABLES_REQUIRED = OrderedDict((key, key == "pt_j1") for key in OBSERVABLES)
+OBSERVABLES_DEFAULTS = OrderedDict((key, -1.0 if key == "m_jj" else None) for key in OBSERVABLES)
+CUTS = ["pt_j1 > 10.", "et_miss > 5.", "n_l < 4"]
+CUTS_DEFAULT_PASS = [False, False, False]
+
+
+class FakeDelphesTree(object):
+    """ Random Delphes tree with the branches MadMiner reads, behaving like an uproot 3 tree """
+
+    def __init__(self, n_events, seed=1234):
+        random_state = np.random.RandomState(seed)
+        self.branches = {}
+
+        def add_collection(name, mean_multiplicity, **extra_branches):
+            counts = random_state.poisson(mean_multiplicity, size=n_events)
+            n = np.sum(counts)
+            branches = {
+                "PT": random_state.exponential(40.0, size=n) + 1.0,
+                "Eta": random_state.normal(0.0, 2.0, size=n),
+                "Phi": random_state.uniform(-np.pi, np.pi, size=n),
+            }
+            for key, function in extra_branches.items():
+                branches[key] = function(n)
+            for key, values in branches.items():
+                self.branches[name + "." + key] = awkward.JaggedArray.fromcounts(counts, values.astype(np.float32))
+
+        def charge(n):
+            return random_state.choice([-1, 1], size=n)
+
+        def mass(n):
+            return random_state.exponential(10.0, size=n)
+
+        def tag(n):
+            return random_state.choice([0, 1], p=[0.8, 0.2], size=n)
+
+        def energy(n):
+            return random_state.exponential(100.0, size=n) + 200.0
+
+        def pdgid(n):
+            return random_state.choice([11, -11, 13, -13, 22, 21, 1, 12], size=n)
+
+        add_collection("Electron", 1.0, Charge=charge)
+        add_collection("Muon", 1.0, Charge=charge)
+        add_collection("Photon", 0.7, E=energy)
+        add_collection("Jet", 3.0, Mass=mass, TauTag=tag, BTag=tag)
+        add_collection("GenJet", 3.0, Mass=mass, TauTag=tag, BTag=tag)
+        add_collection("Particle", 8.0, E=energy, PID=pdgid, Charge=charge)
+        ones = np.ones(n_events, dtype=np.int64)
+        for name in ["MissingET", "GenMissingET"]:
+            self.branches[name + ".MET"] = awkward.JaggedArray.fromcounts(
+                ones, random_state.exponential(30.0, size=n_events)
+            )
+            self.branches[name + ".Phi"] = awkward.JaggedArray.fromcounts(
+                ones, random_state.uniform(-np.pi, np.pi, size=n_events)
+            )
+        self.branches["Event"] = awkward.JaggedArray.fromcounts(ones, np.arange(n_events))
+        self.branches["Weight.Weight"] = random_state.uniform(0.0, 1.0, size=(n_events, 3))
+
+    def array(self, name, entrystart=None, entrystop=None):
+        return self.branches[name][entrystart:entrystop]
+
+
+def parse(**kwargs):
+    return parse_delphes_root_file(
+        "events.root",
+        OBSERVABLES,
+        OBSERVABLES_REQUIRED,
+        OBSERVABLES_DEFAULTS,
+        list(CUTS),
+        list(CUTS_DEFAULT_PASS),
+        weight_labels=["sm", "bsm1", "bsm2"],
+        acceptance_pt_min_e=10.0,
+        acceptance_pt_min_mu=12.0,
+        acceptance_pt_min_j=20.0,
+        acceptance_eta_max_j=5.0,
+        **kwargs
+    )
+
+
+def test_columnar_delphes_parsing(monkeypatch):
+    tree = FakeDelphesTree(500)
+    monkeypatch.setattr(delphes_root.uproot, "open", lambda filename: {"Delphes": tree})
+
+    for use_generator_truth in [False, True]:
+        observations, weights, event_filter = parse(use_generator_truth=use_generator_truth)
+        assert 0 < np.sum(event_filter) == len(observations["pt_j1"]) < 500
+        assert np.all(np.isfinite(observations["function"]))
+
+        for columnar in [False, True]:
+            for batch_size in [1, 37, 10000]:
+                this_observations, this_weights, this_event_filter = parse(
+                    use_generator_truth=use_generator_truth, columnar=columnar, batch_size=batch_size
+                )
+
+                assert np.array_equal(this_event_filter, event_filter)
+                for key in observations:
+                    assert np.allclose(
+                        this_observations[key], observations[key], rtol=1.0e-5, atol=1.0e-5, equal_nan=True
+                    )
+                for key in weights:
+                    assert np.array_equal(this_weights[key], weights[key])
@@ -0,0 +1,90 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+import torch
+
+from madminer.ml import ParameterizedRatioEstimator, ScoreEstimator, Ensemble
+
+
+def generate_data(n_samples=500):
+    theta = np.random.uniform(-1.0, 1.0, size=(n_samples, 1))
+    y = np.random.randint(0, 2, size=(n_samples, 1)).astype(np.float64)
+    x = np.random.normal(loc=theta * (1.0 - y), size=(n_samples, 1))
+    return x, y, theta
+
+
+def train_kwargs(x, y, theta):
+    return dict(method="carl", x=x, y=y, theta=theta, n_epochs=2, batch_size=64, verbose="none")
+
+
+def test_parallel_ensemble_training():
+    x, y, theta = generate_data()
+
+    # Parallel training
+    np.random.seed(1234)
+    ensemble = Ensemble([ParameterizedRatioEstimator(n_hidden=(10,)) for _ in range(3)])
+    ensemble.train_all(n_processes=2, **train_kwargs(x, y, theta))
+
+    # Serial training with the seeds the workers used
+    np.random.seed(1234)
+    seeds = np.random.randint(0, 2 ** 31 - 1, size=3)
+    estimators = []
+    for seed in seeds:
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        estimator = ParameterizedRatioEstimator(n_hidden=(10,))
+        estimator.train(**train_kwargs(x, y, theta))
+        estimators.append(estimator)
+
+    x_test = np.random.normal(size=(20, 1))
+    theta_test = np.random.uniform(-1.0, 1.0, size=(20, 1))
+    for estimator_parallel, estimator_serial in zip(ensemble.estimators, estimators):
+        log_r_parallel, _ = estimator_parallel.evaluate_log_likelihood_ratio(
+            x=x_test, theta=theta_test, test_all_combinations=False
+        )
+        log_r_serial, _ = estimator_serial.evaluate_log_likelihood_ratio(
+            x=x_test, theta=theta_test, test_all_combinations=False
+        )
+        assert np.allclose(log_r_parallel, log_r_serial, rtol=1.0e-4, atol=1.0e-5)
+
+
+def test_stacked_ensemble_evaluation():
+    x, y, theta = generate_data()
+    t_xz = np.random.normal(size=(len(x), 1))
+    x_test = np.random.normal(size=(50, 1))
+    theta_test = np.random.uniform(-1.0, 1.0, size=(7, 1))
+
+    ratio_estimators = []
+    score_estimators = []
+    for _ in range(3):
+        estimator = ParameterizedRatioEstimator(n_hidden=(10, 10))
+        estimator.train(**train_kwargs(x, y, theta))
+        ratio_estimators.append(estimator)
+
+        estimator = ScoreEstimator(n_hidden=(10, 10))
+        estimator.train(method="sally", x=x, t_xz=t_xz, n_epochs=2, batch_size=64, verbose="none")
+        score_estimators.append(estimator)
+
+    # Log likelihood ratio on a grid and for pairs of theta and x
+    ensemble = Ensemble(ratio_estimators, stacked_evaluation=True)
+    for test_all_combinations in [True, False]:
+        theta_eval = theta_test if test_all_combinations else np.random.uniform(-1.0, 1.0, size=(50, 1))
+        kwargs = dict(x=x_test, theta=theta_eval, test_all_combinations=test_all_combinations)
+
+        stacked = ensemble._evaluate_stacked_log_likelihood_ratio(batch_size=20, **kwargs)
+        assert stacked is not None
+        loop = np.array([estimator.evaluate_log_likelihood_ratio(**kwargs)[0] for estimator in ratio_estimators])
+        assert np.allclose(stacked, loop, rtol=1.0e-4, atol=1.0e-5)
+
+        mean, _ = ensemble.evaluate_log_likelihood_ratio(**kwargs)
+        assert np.allclose(mean, np.mean(loop, axis=0), rtol=1.0e-4, atol=1.0e-5)
+
+    # Options the stacked model does not support fall back to the loop over estimators
+    assert ensemble._evaluate_stacked_log_likelihood_ratio(x=x_test, theta=theta_test, quantized=True) is None
+
+    # Score
+    ensemble = Ensemble(score_estimators, stacked_evaluation=True)
+    stacked = ensemble._evaluate_stacked_score(x=x_test, batch_size=20)
+    assert stacked is not None
+    loop = np.array([estimator.evaluate_score(x=x_test) for estimator in score_estimators])
+    assert np.allclose(stacked, loop, rtol=1.0e-4, atol=1.0e-5)
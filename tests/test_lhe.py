@@ -0,0 +1,294 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import gzip
+import json
+import os
+import six
+import numpy as np
+from collections import OrderedDict
+
+from madminer import MadMiner, LHEReader
+from madminer.utils.interfaces import lhe
+from madminer.utils.interfaces.lhe import parse_lhe_file, extract_weights_from_lhe_file, _find_event_byte_ranges
+
+BENCHMARKS = ["sm", "bsm1", "bsm2"]
+
+OBSERVABLES = OrderedDict(
+    [
+        ("n_j", "len(j)"),
+        ("pt_j1", "j[0].pt"),
+        ("m_jj", "(j[0] + j[1]).m"),
+        ("pt_l1", "l[0].pt"),
+        ("charge_l1", "l[0].charge"),
+        ("e_visible", "visible.e"),
+        ("et_miss", "met.pt"),
+        ("ht", "sum([jet.pt for jet in j])"),
+        ("n_j_above_met", "len([jet for jet in j if jet.pt > met.pt])"),
+        ("scale", "scale"),
+        ("alpha_qcd", "alpha_qcd"),
+    ]
+)
+CUTS = ["len(l) >= 1", "met.pt > 10.0"]
+EFFICIENCIES = ["0.9 if len(a) > 0 else 0.5"]
+
+
+def write_lhe_file(filename, n_events=200, seed=1234):
+    random_state = np.random.RandomState(seed)
+
+    lines = [
+        '<LesHouchesEvents version="3.0">',
+        "<header>",
+        "<MGRunCard>",
+        "<![CDATA[",
+        "  {} = nevents ! Number of unweighted events requested".format(n_events),
+        "  average = event_norm ! average/sum",
+        "]]>",
+        "</MGRunCard>",
+        "</header>",
+        "<init>",
+        "2212 2212 6.5e3 6.5e3 0 0 0 0 3 1",
+        "1.0 0.1 1.0 1",
+        "</init>",
+    ]
+
+    for _ in range(n_events):
+        # Incoming partons, an intermediate Higgs, and a random final state
+        particles = [(21, -1, 0.0, 0.0, random_state.uniform(10.0, 500.0)), (2, -1, 0.0, 0.0, 0.0)]
+        particles.append((25, 2, 0.0, 0.0, 0.0))
+        for pdgid, n in [(21, 3), (11, 2), (-13, 1), (22, 1), (12, 1)]:
+            for _ in range(random_state.randint(0, n + 1)):
+                particles.append((pdgid, 1) + tuple(random_state.normal(0.0, 100.0, size=3)))
+
+        lines.append("<event>")
+        lines.append(
+            "{} 1 {:.6e} {:.6e} 7.8e-03 {:.6e}".format(
+                len(particles), random_state.uniform(0.1, 1.0), random_state.uniform(50.0, 200.0), 0.1
+            )
+        )
+        for pdgid, status, px, py, pz in particles:
+            mass = 125.0 if pdgid == 25 else 0.0
+            energy = (px ** 2 + py ** 2 + pz ** 2 + mass ** 2) ** 0.5
+            lines.append(
+                " {} {} 0 0 0 0 {:+.10e} {:+.10e} {:+.10e} {:.10e} {:.10e} 0.0 {:.1f}".format(
+                    pdgid, status, px, py, pz, energy, mass, random_state.choice([-1.0, 1.0])
+                )
+            )
+        lines += ["<mgrwt>", "<rscale> 0 0.1 </rscale>", "</mgrwt>", "<rwgt>"]
+        for benchmark in BENCHMARKS:
+            lines.append("<wgt id='{}'> {:.6e} </wgt>".format(benchmark, random_state.uniform(0.0, 1.0)))
+        lines += ["</rwgt>", "</event>"]
+
+    lines.append("</LesHouchesEvents>")
+
+    with open(filename, "w") as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def parse(filename, **kwargs):
+    return parse_lhe_file(
+        filename,
+        "sm",
+        OBSERVABLES,
+        cuts=list(CUTS),
+        cuts_default_pass=[False for _ in CUTS],
+        efficiencies=list(EFFICIENCIES),
+        efficiencies_default_pass=[1.0 for _ in EFFICIENCIES],
+        benchmark_names=BENCHMARKS,
+        systematics_dict=OrderedDict(),
+        **kwargs
+    )
+
+
+def assert_same_results(results, other_results):
+    observations, weights = results
+    other_observations, other_weights = other_results
+
+    assert list(observations.keys()) == list(other_observations.keys())
+    for key in observations:
+        assert np.allclose(observations[key], other_observations[key], rtol=1.0e-6, atol=1.0e-6, equal_nan=True)
+
+    assert list(weights.keys()) == list(other_weights.keys())
+    for key in weights:
+        assert np.allclose(weights[key], other_weights[key], rtol=1.0e-9)
+
+
+def test_columnar_lhe_parsing(tmpdir):
+    filename = str(tmpdir.join("events.lhe"))
+    write_lhe_file(filename)
+
+    reference = parse(filename)
+    assert 0 < len(reference[0]["n_j"]) < 200
+    assert np.all(np.isfinite(reference[0]["scale"]))
+    assert np.all(np.isfinite(reference[0]["ht"]))
+    assert np.all(np.isfinite(reference[0]["n_j_above_met"]))
+
+    for parse_events_as_xml in [True, False]:
+        assert_same_results(parse(filename, parse_events_as_xml=parse_events_as_xml), reference)
+        for batch_size in [1, 64, 10000]:
+            assert_same_results(
+                parse(filename, parse_events_as_xml=parse_events_as_xml, columnar=True, batch_size=batch_size),
+                reference,
+            )
+
+
+def make_setup_file(filename):
+    miner = MadMiner()
+    miner.add_parameter(lha_block="no one cares", lha_id=12345, parameter_name="theta", parameter_range=(-1.0, 1.0))
+    for i, benchmark in enumerate(BENCHMARKS):
+        miner.add_benchmark({"theta": -1.0 + i}, benchmark)
+    miner.set_morphing(include_existing_benchmarks=True, max_overall_power=2)
+    miner.save(filename)
+
+
+def analyse_samples(setup_filename, lhe_filenames, **kwargs):
+    reader = LHEReader(setup_filename)
+    for lhe_filename in lhe_filenames:
+        reader.add_sample(lhe_filename, "sm")
+    for name, definition in six.iteritems(OBSERVABLES):
+        reader.add_observable(name, definition)
+    for cut in CUTS:
+        reader.add_cut(cut)
+    for efficiency in EFFICIENCIES:
+        reader.add_efficiency(efficiency)
+    reader.analyse_samples(**kwargs)
+    return reader.observations, reader.weights
+
+
+def test_parallel_sample_analysis(tmpdir):
+    setup_filename = str(tmpdir.join("setup.h5"))
+    make_setup_file(setup_filename)
+    lhe_filenames = [str(tmpdir.join("events_{}.lhe".format(i))) for i in range(3)]
+    for i, lhe_filename in enumerate(lhe_filenames):
+        write_lhe_file(lhe_filename, n_events=100, seed=i)
+
+    reference = analyse_samples(setup_filename, lhe_filenames)
+    assert 0 < len(reference[0]["n_j"]) < 300
+    assert_same_results(analyse_samples(setup_filename, lhe_filenames, n_processes=2), reference)
+
+
+def test_byte_range_parallel_lhe_parsing(tmpdir):
+    filename = str(tmpdir.join("events.lhe"))
+    write_lhe_file(filename)
+
+    # The byte ranges start at events and cover all of them
+    with open(filename, "rb") as file:
+        content = file.read()
+    byte_ranges = _find_event_byte_ranges(filename, 3)
+    assert len(byte_ranges) == 3
+    assert byte_ranges[0][0] == content.find(b"<event>")
+    assert byte_ranges[-1][1] == content.rfind(b"</event>") + len(b"</event>")
+    for (_, end), (start, _) in zip(byte_ranges[:-1], byte_ranges[1:]):
+        assert end == start
+        assert content[start : start + len(b"<event>")] == b"<event>"
+
+    for parse_events_as_xml in [True, False]:
+        for columnar in [False, True]:
+            kwargs = dict(parse_events_as_xml=parse_events_as_xml, columnar=columnar, batch_size=64)
+            reference = parse(filename, **kwargs)
+            assert_same_results(parse(filename, n_processes=3, **kwargs), reference)
+
+
+def test_gzipped_lhe_parsing(tmpdir):
+    filename = str(tmpdir.join("events.lhe"))
+    write_lhe_file(filename)
+    gzip_dir = tmpdir.mkdir("gzip")
+    gzip_filename = str(gzip_dir.join("events.lhe.gz"))
+    with open(filename, "rb") as file, gzip.open(gzip_filename, "wb") as gzip_file:
+        gzip_file.write(file.read())
+
+    for parse_events_as_xml in [True, False]:
+        for columnar in [False, True]:
+            kwargs = dict(parse_events_as_xml=parse_events_as_xml, columnar=columnar, batch_size=64)
+            reference = parse(filename, **kwargs)
+            assert_same_results(parse(gzip_filename, **kwargs), reference)
+            assert_same_results(parse(gzip_filename, n_processes=2, **kwargs), reference)
+
+    # The gzipped file is decompressed while reading, no unzipped copy is written
+    assert [name for name in os.listdir(str(gzip_dir)) if not name.endswith(".json")] == ["events.lhe.gz"]
+
+
+def test_lhe_header_cache(tmpdir, monkeypatch):
+    filename = str(tmpdir.join("events.lhe"))
+    write_lhe_file(filename, n_events=200)
+    reference = parse(filename)
+
+    with open(filename + ".header.json", "r") as file:
+        header = json.load(file)
+    assert header["n_events_runcard"] == header["n_events"] == 200
+    assert header["weight_norm_is_average"]
+
+    # A new process uses the sidecar file instead of reading the header again
+    def fail(self):
+        raise RuntimeError("Header should not be read again")
+
+    monkeypatch.setattr(lhe, "_lhe_file_headers", {})
+    with monkeypatch.context() as context:
+        context.setattr(lhe._LHEFileHeader, "_read", fail)
+        assert_same_results(parse(filename), reference)
+
+    # The sidecar file is updated when the LHE file changes
+    write_lhe_file(filename, n_events=150)
+    parse(filename)
+    with open(filename + ".header.json", "r") as file:
+        header = json.load(file)
+    assert header["n_events_runcard"] == header["n_events"] == 150
+
+
+def test_weight_only_lhe_scan(tmpdir):
+    filename = str(tmpdir.join("events.lhe"))
+    write_lhe_file(filename)
+    gzip_filename = str(tmpdir.join("events_gzip.lhe.gz"))
+    with open(filename, "rb") as file, gzip.open(gzip_filename, "wb") as gzip_file:
+        gzip_file.write(file.read())
+
+    for parse_events_as_xml in [True, False]:
+        _, reference = parse_lhe_file(
+            filename,
+            "sm",
+            OBSERVABLES,
+            benchmark_names=BENCHMARKS,
+            parse_events_as_xml=parse_events_as_xml,
+            systematics_dict=OrderedDict(),
+        )
+        assert len(reference["sm"]) == 200
+
+        for this_filename in [filename, gzip_filename]:
+            weights = extract_weights_from_lhe_file(this_filename, "sm", BENCHMARKS, systematics_dict=OrderedDict())
+            assert list(weights.keys()) == list(reference.keys())
+            for key in weights:
+                assert np.allclose(weights[key], reference[key], rtol=1.0e-9)
+
+
+def test_lhe_event_cache(tmpdir, monkeypatch):
+    filename = str(tmpdir.join("events.lhe"))
+    write_lhe_file(filename)
+    cache_directory = str(tmpdir.join("cache"))
+
+    # Jet pT smearing, all other particles are kept as they are
+    pdgids = [21, 11, -13, 22, 12]
+    smearing = dict(
+        energy_resolutions={pdgid: (None, None) if pdgid == 21 else (0.0, 0.0) for pdgid in pdgids},
+        pt_resolutions={pdgid: (0.0, 0.1) if pdgid == 21 else (None, None) for pdgid in pdgids},
+        eta_resolutions={pdgid: (0.0, 0.0) for pdgid in pdgids},
+        phi_resolutions={pdgid: (0.0, 0.0) for pdgid in pdgids},
+    )
+    smearing["pt_resolutions"]["met"] = (0.0, 0.0)
+
+    np.random.seed(1234)
+    cache_miss = parse(filename, cache_directory=cache_directory, **smearing)
+    assert len(os.listdir(cache_directory)) == 1
+
+    # Cache hits do not parse or smear the events again
+    def fail(*args, **kwargs):
+        raise RuntimeError("Events should be loaded from the cache")
+
+    with monkeypatch.context() as context:
+        context.setattr(lhe, "_parse_event_batches", fail)
+        context.setattr(lhe, "_smear_particle_columns", fail)
+        cache_hit = parse(filename, cache_directory=cache_directory, **smearing)
+    assert_same_results(cache_hit, cache_miss)
+
+    # Other smearing settings are cached separately
+    smearing["pt_resolutions"][21] = (0.0, 0.2)
+    parse(filename, cache_directory=cache_directory, **smearing)
+    assert len(os.listdir(cache_directory)) == 2
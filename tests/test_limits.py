@@ -0,0 +1,189 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+import pytest
+from collections import OrderedDict
+
+from madminer import MadMiner, LHEReader, AsymptoticLimits, ParameterizedRatioEstimator
+
+
+def make_madminer_file(tmpdir, n_events=2000):
+    random_state = np.random.RandomState(1234)
+    setup_filename = str(tmpdir.join("setup.h5"))
+    filename = str(tmpdir.join("data.h5"))
+
+    # Set up MadMiner file
+    miner = MadMiner()
+    miner.add_parameter(
+        lha_block="no one cares",
+        lha_id=12345,
+        parameter_name="theta",
+        morphing_max_power=2,
+        parameter_range=(-1.0, 1.0),
+    )
+    miner.add_benchmark({"theta": 0.0})
+    miner.add_benchmark({"theta": 1.0})
+    miner.add_benchmark({"theta": -1.0})
+    miner.set_morphing(include_existing_benchmarks=True, max_overall_power=2)
+    miner.save(setup_filename)
+
+    # Set up observations: the distribution of x is tilted by theta
+    proc = LHEReader(setup_filename)
+    proc.add_observable("x", "no one cares")
+    proc.add_observable("y", "no one cares")
+    proc.reference_benchmark = "benchmark_0"
+    proc.nuisance_parameters = OrderedDict()
+    proc.observations = OrderedDict()
+    proc.observations["x"] = random_state.normal(size=n_events)
+    proc.observations["y"] = random_state.normal(size=n_events)
+    proc.weights = OrderedDict()
+    proc.weights["benchmark_0"] = 0.01 * np.ones(n_events)
+    proc.weights["benchmark_1"] = 0.01 * np.exp(0.5 * proc.observations["x"] - 0.125)
+    proc.weights["benchmark_2"] = 0.01 * np.exp(-0.5 * proc.observations["x"] - 0.125)
+    proc.save(filename, shuffle=False)
+
+    return filename
+
+
+def train_model(tmpdir, n_samples=1000):
+    theta = np.random.uniform(-1.0, 1.0, size=(n_samples, 1))
+    y = np.random.randint(0, 2, size=(n_samples, 1)).astype(np.float64)
+    x = np.random.normal(loc=np.hstack([0.5 * theta * (1.0 - y), np.zeros((n_samples, 1))]), size=(n_samples, 2))
+
+    estimator = ParameterizedRatioEstimator(n_hidden=(10,))
+    estimator.train(method="carl", x=x, y=y, theta=theta, n_epochs=3, batch_size=64, verbose="none")
+
+    model_filename = str(tmpdir.join("model"))
+    estimator.save(model_filename)
+    return model_filename
+
+
+def make_setup(tmpdir):
+    filename = make_madminer_file(tmpdir)
+    model_filename = train_model(tmpdir)
+    x_observed = np.random.RandomState(42).normal(loc=[0.2, 0.0], size=(500, 2))
+    return filename, model_filename, x_observed
+
+
+def assert_same_limits(limits, other_limits):
+    theta_grid, p_values, i_ml, log_r_kin, log_p_xsec, _ = limits
+    other_theta_grid, other_p_values, other_i_ml, other_log_r_kin, other_log_p_xsec, _ = other_limits
+
+    assert np.allclose(theta_grid, other_theta_grid)
+    assert i_ml == other_i_ml
+    assert np.allclose(log_r_kin, other_log_r_kin, rtol=1.0e-6, atol=1.0e-6)
+    assert np.allclose(log_p_xsec, other_log_p_xsec, rtol=1.0e-9, atol=1.0e-9)
+    assert np.allclose(p_values, other_p_values, rtol=1.0e-6, atol=1.0e-9)
+
+
+def add_not_finite_results(monkeypatch):
+    # Some events have nan results, but only at some of the parameter points
+    calculate_log_likelihood_ratio_kinematics = AsymptoticLimits._calculate_log_likelihood_ratio_kinematics
+
+    def calculate_with_nans(self, x_observed, theta_grid, model, theta1=None):
+        log_r = calculate_log_likelihood_ratio_kinematics(self, x_observed, theta_grid, model, theta1)
+        not_finite = (x_observed[np.newaxis, :, 0] > 1.5) & (theta_grid[:, np.newaxis, 0] > 0.3)
+        return np.where(not_finite, np.nan, log_r)
+
+    monkeypatch.setattr(AsymptoticLimits, "_calculate_log_likelihood_ratio_kinematics", calculate_with_nans)
+
+
+def test_batched_limits(tmpdir):
+    filename, model_filename, x_observed = make_setup(tmpdir)
+    limits = AsymptoticLimits(filename)
+    kwargs = dict(grid_ranges=[(-1.0, 1.0)], grid_resolutions=[21], model_file=model_filename, luminosity=10000.0)
+
+    # One block with all events
+    reference = limits.observed_limits("ml", x_observed, x_batchsize=None, **kwargs)
+    assert len(reference[0]) == 21
+    assert np.all(np.isfinite(reference[3]))
+
+    # Batches of events, also with a last batch that is smaller than the others
+    for x_batchsize in [100, 77, 1]:
+        assert_same_limits(limits.observed_limits("ml", x_observed, x_batchsize=x_batchsize, **kwargs), reference)
+
+
+def test_refined_limits(tmpdir):
+    filename = make_madminer_file(tmpdir)
+    x_observed = np.random.RandomState(42).normal(loc=[0.2, 0.0], size=(500, 2))
+    limits = AsymptoticLimits(filename)
+    kwargs = dict(
+        grid_ranges=[(-1.0, 1.0)],
+        hist_vars=["x"],
+        hist_bins=[[-10.0, -1.0, -0.5, 0.0, 0.5, 1.0, 10.0]],
+        include_xsec=False,
+    )
+
+    # Two refinement steps of a grid with 9 points have the resolution of a regular grid with 33 points
+    fine = limits.observed_limits("histo", x_observed, grid_resolutions=[33], **kwargs)
+    refined = limits.observed_limits("histo", x_observed, grid_resolutions=[9], grid_refinements=2, **kwargs)
+    theta_fine, p_values_fine, i_ml_fine, log_r_kin_fine, _, _ = fine
+    theta_refined, p_values_refined, i_ml_refined, log_r_kin_refined, _, _ = refined
+    assert 0 < i_ml_fine < 32
+
+    # Fewer points, all of them on the fine grid, with the same best fit
+    assert 9 < len(theta_refined) < 33
+    indices = np.round((theta_refined[:, 0] + 1.0) * 16.0).astype(np.int64)
+    assert np.allclose(theta_fine[indices], theta_refined)
+    assert np.allclose(theta_refined[i_ml_refined], theta_fine[i_ml_fine])
+
+    # The refinement resolves the region around the best fit
+    assert all([i in indices for i in range(i_ml_fine - 1, i_ml_fine + 2)])
+    assert np.allclose(log_r_kin_refined, log_r_kin_fine[indices], rtol=1.0e-6, atol=1.0e-6)
+    assert np.allclose(p_values_refined, p_values_fine[indices], rtol=1.0e-6, atol=1.0e-9)
+
+
+def test_parallel_limits(tmpdir, monkeypatch):
+    filename, model_filename, x_observed = make_setup(tmpdir)
+    limits = AsymptoticLimits(filename)
+    kwargs = dict(grid_ranges=[(-1.0, 1.0)], grid_resolutions=[21], luminosity=10000.0)
+    ml_kwargs = dict(model_file=model_filename, x_batchsize=70, **kwargs)
+    histo_kwargs = dict(hist_vars=["x"], hist_bins=[[-10.0, -1.0, -0.5, 0.0, 0.5, 1.0, 10.0]], **kwargs)
+
+    for mode, mode_kwargs in [("ml", ml_kwargs), ("histo", histo_kwargs)]:
+        reference = limits.observed_limits(mode, x_observed, **mode_kwargs)
+        assert_same_limits(limits.observed_limits(mode, x_observed, n_processes=2, **mode_kwargs), reference)
+
+    # Events with inf / nan results at some parameter points are removed at all of them, also if the points are
+    # split between processes
+    x_finite = x_observed[x_observed[:, 0] <= 1.5]
+    log_r_kin_finite = limits.observed_limits("ml", x_finite, n_observed=len(x_finite), **ml_kwargs)[3]
+    add_not_finite_results(monkeypatch)
+
+    reference = limits.observed_limits("ml", x_observed, **ml_kwargs)
+    assert np.allclose(reference[3], log_r_kin_finite, rtol=1.0e-6, atol=1.0e-6)
+    assert_same_limits(limits.observed_limits("ml", x_observed, n_processes=2, **ml_kwargs), reference)
+
+
+def test_cached_limits(tmpdir, monkeypatch):
+    filename, model_filename, x_observed = make_setup(tmpdir)
+    kwargs = dict(grid_ranges=[(-1.0, 1.0)], grid_resolutions=[21], model_file=model_filename, luminosity=10000.0)
+    reference = AsymptoticLimits(filename).observed_limits("ml", x_observed, **kwargs)
+
+    limits = AsymptoticLimits(filename, cache=True)
+    assert_same_limits(limits.observed_limits("ml", x_observed, **kwargs), reference)
+
+    # Repeated calls do not evaluate the estimator again
+    def fail(*args, **kwargs):
+        raise RuntimeError("The kinematic likelihood should be taken from the cache")
+
+    with monkeypatch.context() as context:
+        context.setattr(AsymptoticLimits, "_calculate_log_likelihood_ratio_kinematics", fail)
+        assert_same_limits(limits.observed_limits("ml", x_observed, **kwargs), reference)
+
+        limits.clear_cache()
+        with pytest.raises(RuntimeError):
+            limits.observed_limits("ml", x_observed, **kwargs)
+
+    assert_same_limits(limits.observed_limits("ml", x_observed, **kwargs), reference)
+
+    # Cached parameter points with inf / nan results do not change which events are removed at other points
+    add_not_finite_results(monkeypatch)
+    limits.clear_cache()
+    theta_grid = limits.observed_limits("ml", x_observed, **kwargs)[0]
+    thetas = theta_grid[theta_grid[:, 0] < 0.3]
+    kwargs_subset = dict(grid_resolutions=None, thetas_eval=thetas, model_file=model_filename)
+    reference = AsymptoticLimits(filename).observed_limits("ml", x_observed, **kwargs_subset)
+    n_cached = len(limits._cache)
+    assert_same_limits(limits.observed_limits("ml", x_observed, **kwargs_subset), reference)
+    assert len(limits._cache) == n_cached
@@ -0,0 +1,172 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import numpy as np
+import torch
+
+from madminer.ml import ParameterizedRatioEstimator, ScoreEstimator
+from madminer.utils.ml.models.ratio import DenseSingleParameterizedRatioModel
+from madminer.utils.ml.models.score import DenseLocalScoreModel
+from madminer.utils.ml.eval import evaluate_ratio_model, evaluate_ratio_model_grid, evaluate_local_score_model
+
+
+def make_ratio_model(n_observables=3, n_parameters=2, n_hidden=(20, 20)):
+    torch.manual_seed(1234)
+    return DenseSingleParameterizedRatioModel(n_observables=n_observables, n_parameters=n_parameters, n_hidden=n_hidden)
+
+
+def train_estimators(n_samples=500):
+    theta = np.random.uniform(-1.0, 1.0, size=(n_samples, 2))
+    y = np.random.randint(0, 2, size=(n_samples, 1)).astype(np.float64)
+    x = np.random.normal(loc=theta[:, :1] * (1.0 - y), size=(n_samples, 3))
+    t_xz = np.random.normal(size=(n_samples, 2))
+
+    ratio_estimator = ParameterizedRatioEstimator(n_hidden=(20, 20))
+    ratio_estimator.train(method="carl", x=x, y=y, theta=theta, n_epochs=2, verbose="none")
+    score_estimator = ScoreEstimator(n_hidden=(20, 20))
+    score_estimator.train(method="sally", x=x, t_xz=t_xz, n_epochs=2, verbose="none")
+
+    return ratio_estimator, score_estimator
+
+
+def evaluate_estimators(ratio_estimator, score_estimator, x, theta, evaluate_score=True, quantized=None):
+    log_r_hat, t_hat = ratio_estimator.evaluate_log_likelihood_ratio(
+        x=x, theta=theta, evaluate_score=evaluate_score, quantized=quantized
+    )
+    return log_r_hat, t_hat, score_estimator.evaluate_score(x=x, quantized=quantized)
+
+
+def evaluate_per_theta(model, thetas, xs, evaluate_score):
+    log_r_hats, t_hats = [], []
+    for theta in thetas:
+        _, log_r_hat, t_hat, _ = evaluate_ratio_model(
+            model=model, theta0s=[theta], xs=xs, evaluate_score=evaluate_score, run_on_gpu=False
+        )
+        log_r_hats.append(log_r_hat)
+        t_hats.append(t_hat)
+    return np.array(log_r_hats), (np.array(t_hats) if evaluate_score else None)
+
+
+def test_ratio_model_grid_matches_per_theta_evaluation():
+    model = make_ratio_model()
+    thetas = np.random.uniform(-1.0, 1.0, size=(7, 2))
+    xs = np.random.normal(size=(31, 3))
+
+    for evaluate_score in [False, True]:
+        log_r_ref, t_ref = evaluate_per_theta(model, thetas, xs, evaluate_score)
+
+        # Small batches split both the thetas and the xs
+        for batch_size in [100000, 40, 5]:
+            log_r_hat, t_hat = evaluate_ratio_model_grid(
+                model, thetas=thetas, xs=xs, evaluate_score=evaluate_score, run_on_gpu=False, batch_size=batch_size
+            )
+
+            assert log_r_hat.shape == (7, 31)
+            assert np.allclose(log_r_hat, log_r_ref, rtol=1.0e-5, atol=1.0e-5)
+            if evaluate_score:
+                assert t_hat.shape == (7, 31, 2)
+                assert np.allclose(t_hat, t_ref, rtol=1.0e-4, atol=1.0e-5)
+            else:
+                assert t_hat is None
+
+
+def test_batched_ratio_model_evaluation():
+    model = make_ratio_model()
+    thetas = np.random.uniform(-1.0, 1.0, size=(23, 2))
+    xs = np.random.normal(size=(23, 3))
+
+    # Reference: one forward pass for all samples
+    theta_tensor = torch.tensor(thetas, dtype=torch.float, requires_grad=True)
+    s_ref, log_r_ref, t_ref = model(theta_tensor, torch.tensor(xs, dtype=torch.float), track_score=True)
+
+    for batch_size in [100000, 10, 1]:
+        s_hat, log_r_hat, t_hat, _ = evaluate_ratio_model(
+            model=model, theta0s=thetas, xs=xs, evaluate_score=True, run_on_gpu=False, batch_size=batch_size
+        )
+
+        assert np.allclose(s_hat, s_ref.detach().numpy().flatten(), rtol=1.0e-5, atol=1.0e-6)
+        assert np.allclose(log_r_hat, log_r_ref.detach().numpy().flatten(), rtol=1.0e-5, atol=1.0e-6)
+        assert np.allclose(t_hat, t_ref.detach().numpy(), rtol=1.0e-4, atol=1.0e-6)
+
+
+def test_batched_local_score_model_evaluation():
+    torch.manual_seed(1234)
+    model = DenseLocalScoreModel(n_observables=3, n_parameters=2, n_hidden=(20, 20))
+    xs = np.random.normal(size=(23, 3))
+
+    with torch.no_grad():
+        t_ref = model(torch.tensor(xs, dtype=torch.float)).numpy()
+
+    for batch_size in [100000, 10, 1]:
+        t_hat = evaluate_local_score_model(model, xs=xs, run_on_gpu=False, batch_size=batch_size)
+        assert t_hat.shape == (23, 2)
+        assert np.allclose(t_hat, t_ref, rtol=1.0e-5, atol=1.0e-6)
+
+        # Non-contiguous inputs are converted as well
+        t_hat = evaluate_local_score_model(
+            model, xs=np.asfortranarray(xs), run_on_gpu=False, double_precision=False, batch_size=batch_size
+        )
+        assert np.allclose(t_hat, t_ref, rtol=1.0e-5, atol=1.0e-6)
+
+
+def test_compiled_estimators(tmpdir):
+    ratio_estimator, score_estimator = train_estimators()
+    x = np.random.normal(size=(30, 3))
+    theta = np.random.uniform(-1.0, 1.0, size=(4, 2))
+    log_r_ref, t_ref, score_ref = evaluate_estimators(ratio_estimator, score_estimator, x, theta)
+
+    # Compiled models give the same results
+    assert ratio_estimator.compile() is not None
+    assert score_estimator.compile() is not None
+    log_r_hat, t_hat, score = evaluate_estimators(ratio_estimator, score_estimator, x, theta)
+    assert np.allclose(log_r_hat, log_r_ref, rtol=1.0e-5, atol=1.0e-6)
+    assert np.allclose(t_hat, t_ref, rtol=1.0e-4, atol=1.0e-6)
+    assert np.allclose(score, score_ref, rtol=1.0e-5, atol=1.0e-6)
+
+    # Saving and loading compiled models
+    filename = str(tmpdir.join("ratio"))
+    ratio_estimator.save(filename, save_compiled=True)
+    assert os.path.exists(filename + "_compiled.pt")
+    loaded_estimator = ParameterizedRatioEstimator()
+    loaded_estimator.load(filename)
+    assert loaded_estimator.compiled_model is not None
+    log_r_hat, _ = loaded_estimator.evaluate_log_likelihood_ratio(x=x, theta=theta)
+    assert np.allclose(log_r_hat, log_r_ref, rtol=1.0e-5, atol=1.0e-6)
+
+    # Saving again without the compiled model removes the outdated one
+    ratio_estimator.save(filename, save_compiled=False)
+    assert not os.path.exists(filename + "_compiled.pt")
+    loaded_estimator.load(filename)
+    assert loaded_estimator.compiled_model is None
+
+
+def test_quantized_estimators():
+    ratio_estimator, score_estimator = train_estimators()
+    x = np.random.normal(size=(30, 3))
+    theta = np.random.uniform(-1.0, 1.0, size=(4, 2))
+    log_r_ref, _, score_ref = evaluate_estimators(
+        ratio_estimator, score_estimator, x, theta, evaluate_score=False, quantized=False
+    )
+
+    for estimator in [ratio_estimator, score_estimator]:
+        deviation = estimator.quantize(tolerance=1.0)
+        assert deviation is not None and deviation < 0.1
+        assert estimator.quantized_model is not None
+
+    # quantized=False still evaluates the original networks, quantized=None the int8 networks
+    log_r_hat, _, score = evaluate_estimators(
+        ratio_estimator, score_estimator, x, theta, evaluate_score=False, quantized=False
+    )
+    assert np.array_equal(log_r_hat, log_r_ref)
+    assert np.array_equal(score, score_ref)
+
+    log_r_hat, _, score = evaluate_estimators(
+        ratio_estimator, score_estimator, x, theta, evaluate_score=False, quantized=None
+    )
+    assert not np.array_equal(log_r_hat, log_r_ref)
+    assert np.mean(np.abs(log_r_hat - log_r_ref)) < 0.1 * np.std(log_r_ref)
+    assert np.mean(np.abs(score - score_ref)) < 0.1 * np.std(score_ref)
+
+    # Tolerance check
+    assert ratio_estimator.quantize(tolerance=0.0) > 0.0
+    assert ratio_estimator.quantized_model is None
@@ -0,0 +1,193 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import socket
+import time
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+
+from madminer.ml import ParameterizedRatioEstimator
+from madminer.utils.ml import distributed
+from madminer.utils.ml.trainer import TensorBatchLoader, BlockShuffledLoader, NumpyDataset, TrainingCallback
+
+
+def generate_data(n_samples=500):
+    theta = np.random.uniform(-1.0, 1.0, size=(n_samples, 1))
+    y = np.random.randint(0, 2, size=(n_samples, 1)).astype(np.float64)
+    x = np.random.normal(loc=theta * (1.0 - y), size=(n_samples, 1))
+    return dict(method="carl", x=x, y=y, theta=theta, batch_size=64, verbose="none")
+
+
+class InterruptTraining(TrainingCallback):
+    def __init__(self, i_epoch):
+        self.i_epoch = i_epoch
+
+    def on_epoch_end(self, trainer, i_epoch, epoch_profile):
+        if i_epoch == self.i_epoch:
+            raise KeyboardInterrupt()
+
+
+class CountingCallback(TrainingCallback):
+    def __init__(self):
+        self.n_samples = []
+        self.epochs = []
+
+    def on_batch_end(self, trainer, i_epoch, i_batch, n_samples, loss):
+        self.n_samples.append(n_samples)
+
+    def on_epoch_end(self, trainer, i_epoch, epoch_profile):
+        self.epochs.append(epoch_profile)
+
+
+def train_data_parallel(data):
+    estimator = ParameterizedRatioEstimator(n_hidden=(10,))
+    losses_train, losses_val = estimator.train(n_epochs=3, **data)
+
+    # Parameters of all processes
+    parameters = torch.cat([parameter.detach().reshape(-1) for parameter in estimator.model.parameters()])
+    all_parameters = [torch.zeros_like(parameters) for _ in range(distributed.get_world_size())]
+    dist.all_gather(all_parameters, parameters)
+
+    return distributed.get_world_size(), losses_train, losses_val, [tensor.numpy() for tensor in all_parameters]
+
+
+def exit_in_second_process():
+    if distributed.get_rank() == 1:
+        os._exit(1)
+    time.sleep(600.0)
+
+
+def test_tensor_batch_loader():
+    n_samples, batch_size = 103, 10
+    x = torch.arange(n_samples, dtype=torch.float).reshape(-1, 1)
+    y = 2.0 * x
+
+    for shuffle in [True, False]:
+        loader = TensorBatchLoader([x, y], batch_size=batch_size, shuffle=shuffle)
+        batches = list(loader)
+
+        assert len(batches) == len(loader) == 11
+        assert all([len(x_batch) == batch_size for x_batch, _ in batches[:-1]])
+
+        # Every sample appears exactly once per epoch, and the arrays stay aligned
+        x_epoch = torch.cat([x_batch for x_batch, _ in batches]).numpy().flatten()
+        y_epoch = torch.cat([y_batch for _, y_batch in batches]).numpy().flatten()
+        assert np.array_equal(np.sort(x_epoch), np.arange(n_samples))
+        assert np.array_equal(y_epoch, 2.0 * x_epoch)
+        assert np.array_equal(x_epoch, np.arange(n_samples)) != shuffle
+
+
+def test_block_shuffled_loader(tmpdir):
+    n_samples, batch_size = 1000, 32
+    filename = str(tmpdir.join("x.npy"))
+    np.save(filename, np.arange(2 * n_samples, dtype=np.float64).reshape(n_samples, 2))
+    x = np.load(filename, mmap_mode="r")
+    y = np.arange(n_samples, dtype=np.float64).reshape(-1, 1)
+
+    dataset = NumpyDataset(x, y)
+    assert dataset.memmap == [True, False]
+
+    blocks = BlockShuffledLoader.make_blocks(n_samples, block_size=64)
+    loader = BlockShuffledLoader(dataset, batch_size=batch_size, blocks=blocks, n_buffer_blocks=3)
+
+    epochs = []
+    for _ in range(2):
+        batches = list(loader)
+        assert all([len(x_batch) == batch_size for x_batch, _ in batches[:-1]])
+
+        # Every sample appears exactly once per epoch, and the memory-mapped and in-memory arrays stay aligned
+        x_epoch = torch.cat([x_batch for x_batch, _ in batches]).numpy()
+        y_epoch = torch.cat([y_batch for _, y_batch in batches]).numpy().flatten()
+        assert np.array_equal(np.sort(y_epoch), np.arange(n_samples))
+        assert np.array_equal(x_epoch[:, 0], 2.0 * y_epoch)
+        epochs.append(y_epoch)
+
+    assert not np.array_equal(epochs[0], epochs[1])
+
+
+def test_resume_from_checkpoint(tmpdir):
+    data = generate_data()
+    x_test = np.random.normal(size=(20, 1))
+    theta_test = np.random.uniform(-1.0, 1.0, size=(20, 1))
+    checkpoint = str(tmpdir.join("checkpoint.pt"))
+
+    # Uninterrupted training
+    np.random.seed(1234)
+    torch.manual_seed(1234)
+    estimator = ParameterizedRatioEstimator(n_hidden=(10,))
+    losses_train, losses_val = estimator.train(n_epochs=5, **data)
+    log_r_ref, _ = estimator.evaluate_log_likelihood_ratio(x=x_test, theta=theta_test, test_all_combinations=False)
+
+    # Training that is interrupted in the third epoch, after the checkpoint of the second one was saved
+    np.random.seed(1234)
+    torch.manual_seed(1234)
+    estimator = ParameterizedRatioEstimator(n_hidden=(10,))
+    with pytest.raises(KeyboardInterrupt):
+        estimator.train(n_epochs=5, checkpoint_path=checkpoint, callbacks=[InterruptTraining(2)], **data)
+
+    # Continue with a new estimator and a different random state
+    np.random.seed(42)
+    torch.manual_seed(42)
+    estimator = ParameterizedRatioEstimator(n_hidden=(10,))
+    losses_train_resumed, losses_val_resumed = estimator.train(n_epochs=5, resume_from=checkpoint, **data)
+    log_r, _ = estimator.evaluate_log_likelihood_ratio(x=x_test, theta=theta_test, test_all_combinations=False)
+
+    assert np.allclose(losses_train_resumed, losses_train, rtol=1.0e-5)
+    assert np.allclose(losses_val_resumed, losses_val, rtol=1.0e-5)
+    assert np.allclose(log_r, log_r_ref, rtol=1.0e-5, atol=1.0e-6)
+
+
+def test_training_profile_and_callbacks():
+    data = generate_data()
+    callback = CountingCallback()
+
+    estimator = ParameterizedRatioEstimator(n_hidden=(10,))
+    losses_train, losses_val, profile = estimator.train(
+        n_epochs=3, validation_split=0.2, early_stopping=False, callbacks=[callback], return_profile=True, **data
+    )
+
+    # 400 training samples in batches of 64 per epoch
+    assert callback.n_samples == 3 * ([64] * 6 + [16])
+    assert len(callback.epochs) == len(profile["epochs"]) == 3
+
+    for i_epoch, epoch_profile in enumerate(profile["epochs"]):
+        assert epoch_profile is callback.epochs[i_epoch]
+        assert epoch_profile["epoch"] == i_epoch + 1
+        assert epoch_profile["n_samples"] == 400
+        assert np.isclose(epoch_profile["loss_train"], losses_train[i_epoch])
+        assert np.isclose(epoch_profile["loss_val"], losses_val[i_epoch])
+        assert 0.0 <= epoch_profile["stall_fraction"] <= 1.0
+
+    assert profile["timers"]["ALL"] > 0.0
+
+
+def test_data_parallel_training():
+    data = generate_data()
+    world_size, losses_train, losses_val, all_parameters = distributed.launch_local(
+        train_data_parallel, n_processes=2, args=(data,)
+    )
+
+    assert world_size == 2
+    assert len(losses_train) == len(losses_val) == 3
+    assert np.all(np.isfinite(losses_train)) and np.all(np.isfinite(losses_val))
+
+    # Gradients are averaged over the processes, so all of them end up with the same model
+    assert np.allclose(all_parameters[0], all_parameters[1], rtol=1.0e-5, atol=1.0e-6)
+
+
+def test_failed_training_processes():
+    # A process that is killed raises an error instead of blocking forever
+    with pytest.raises(RuntimeError, match="exited with code 1"):
+        distributed.launch_local(exit_in_second_process, n_processes=2, poll_interval=0.1)
+
+    # So does a process group that cannot be set up
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1)
+        with pytest.raises(RuntimeError, match="Training process 0 failed"):
+            distributed.launch_local(distributed.get_rank, n_processes=2, master_port=sock.getsockname()[1])
+    finally:
+        sock.close()